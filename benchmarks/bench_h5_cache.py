@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of repeated cluster selections with the HDF5 chunk cache.
+
+A compressed features_masks-like dataset with 1.5 MB chunks (larger than
+the default 1 MB chunk cache of HDF5) is created in a temporary directory.
+Five clusters are then selected three times in a row through a
+PartialArray, with the default chunk cache and with the defaults used by
+KwikModel for the .kwx file.
+
+Usage:
+
+    python benchmarks/bench_h5_cache.py
+
+"""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import os.path as op
+import time
+
+import numpy as np
+import h5py
+
+from phy.io.h5 import open_h5
+from phy.io.kwik_model import _kwik_h5_options
+from phy.utils.array import PartialArray
+from phy.utils.tempdir import TemporaryDirectory
+
+
+#------------------------------------------------------------------------------
+# Benchmark
+#------------------------------------------------------------------------------
+
+n_spikes = 60000
+n_features = 32 * 3
+n_clusters = 50
+n_selected = 5
+n_repeats = 3
+
+
+def _create_dataset(filename):
+    data = np.random.rand(n_spikes, n_features, 2).astype(np.float32)
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('features_masks', data=data,
+                         chunks=(2000, n_features, 2),
+                         compression='gzip', compression_opts=1)
+
+
+def _select(filename, selections, **options):
+    with open_h5(filename, **options) as f:
+        features = PartialArray(f.read('/features_masks'), (slice(None), 0))
+        t0 = time.time()
+        for _ in range(n_repeats):
+            for spikes in selections:
+                features[spikes]
+        return time.time() - t0
+
+
+def main():
+    np.random.seed(0)
+    spike_clusters = np.random.randint(0, n_clusters, n_spikes)
+    selections = [np.nonzero(spike_clusters == cluster)[0]
+                  for cluster in range(n_selected)]
+    with TemporaryDirectory() as tempdir:
+        filename = op.join(tempdir, 'bench.kwx')
+        _create_dataset(filename)
+        for name, options in (('default cache', {}),
+                              ('kwx defaults', _kwik_h5_options('kwx'))):
+            print("{0:<16s}{1:.2f} s".format(name,
+                                             _select(filename, selections,
+                                                     **options)))
+
+
+if __name__ == '__main__':
+    main()
@@ -106,6 +106,10 @@ class Clustering(object):
         self._undo_stack = History(base_item=(None, None))
         # Spike -> cluster mapping.
         self._spike_clusters = _as_array(spike_clusters)
+        # Read-only arrays (like memory-mapped files) are copied in memory
+        # since the assignements are done in-place.
+        if not self._spike_clusters.flags.writeable:
+            self._spike_clusters = self._spike_clusters.copy()
         self._n_spikes = len(self._spike_clusters)
         self._spike_ids = np.arange(self._n_spikes).astype(np.int64)
         # Create the spikes per cluster structure.
@@ -10,6 +10,7 @@ import os
 import os.path as op
 from functools import partial
 import shutil
+import zlib
 
 import numpy as np
 
@@ -19,8 +20,12 @@ from ...utils._misc import (_phy_user_dir,
 from ...ext.slugify import slugify
 from ...utils.event import EventEmitter
 from ...utils.logging import set_level, warn
+from ...utils.array import _as_array
+from ...utils._bunch import Bunch
 from ...io.kwik_model import KwikModel
 from ...io.base_model import BaseModel
+from ...stats.ccg import CorrelogramCache
+from ...stats.waveforms import cluster_waveform_stats, merge_waveform_stats
 from ._history import GlobalHistory
 from ._utils import _concatenate_per_cluster_arrays
 from .cluster_info import ClusterMetadata
@@ -81,12 +86,101 @@ class FeatureMasks(StoreItem):
 
     def store_from_model(self, cluster, spikes):
         # Load all features and masks for that cluster in memory.
+        # The masks are either a dense array or a SparseCSR array, which
+        # are both supported by the store.
         masks = self.model.masks[spikes]
         # Store the masks, features, and mean masks.
         self.store.store(cluster, masks=masks,
                          mean_masks=masks.mean(axis=0))
 
 
+def _spikes_checksum(spikes):
+    """Return a checksum of the spikes of a cluster."""
+    spikes = np.ascontiguousarray(spikes, dtype=np.int64)
+    return zlib.crc32(spikes.tobytes()) & 0xffffffff
+
+
+def _params_checksum(params):
+    """Return a checksum of a dictionary of parameters."""
+    s = ';'.join('{0}={1}'.format(name, params[name])
+                 for name in sorted(params))
+    return zlib.crc32(s.encode('utf-8')) & 0xffffffff
+
+
+class Waveforms(StoreItem):
+    fields = [('n_spikes_waveforms', 'disk'),
+              ('mean_waveforms', 'disk'),
+              ('std_waveforms', 'disk'),
+              ('peak_channel', 'disk'),
+              ('waveforms_checksum', 'disk'),
+              ('waveforms_params', 'disk')]
+
+    @property
+    def _params_checksum(self):
+        return _params_checksum(self.model.waveform_params)
+
+    def _store_stats(self, cluster, stats, spikes):
+        checksum = _spikes_checksum(spikes)
+        self.store.store(cluster,
+                         n_spikes_waveforms=np.array(stats.n_spikes),
+                         mean_waveforms=stats.mean,
+                         std_waveforms=stats.std,
+                         peak_channel=np.array(stats.peak_channel),
+                         waveforms_checksum=np.array(checksum,
+                                                     dtype=np.int64),
+                         waveforms_params=np.array(self._params_checksum,
+                                                   dtype=np.int64))
+
+    def _load_stats(self, cluster):
+        data = self.store.load(cluster, [name for name, _ in self.fields])
+        if data['mean_waveforms'] is None:
+            return None
+        return Bunch(n_spikes=int(data['n_spikes_waveforms']),
+                     mean=data['mean_waveforms'],
+                     std=data['std_waveforms'],
+                     peak_channel=int(data['peak_channel']))
+
+    def is_stored(self, cluster, spikes):
+        # The statistics stored on disk by a previous session are reused if
+        # the cluster has the same spikes, and if the waveforms are loaded
+        # with the same parameters (data type, scaling, traces, filter and
+        # channel group).
+        data = self.store.load(cluster, ['waveforms_checksum',
+                                         'waveforms_params'])
+        checksum, params = data['waveforms_checksum'], data['waveforms_params']
+        if checksum is None or params is None:
+            return False
+        return (checksum == _spikes_checksum(spikes) and
+                params == self._params_checksum)
+
+    def store_all_from_model(self, spikes_per_cluster):
+        # The waveforms of all clusters are loaded in a single pass.
+        waveforms = self.model.waveforms
+        if waveforms is None:
+            return
+        stats = cluster_waveform_stats(waveforms, spikes_per_cluster)
+        for cluster in sorted(stats):
+            self._store_stats(cluster, stats[cluster],
+                              spikes_per_cluster[cluster])
+
+    def store_from_model(self, cluster, spikes):
+        self.store_all_from_model({cluster: spikes})
+
+    def merge(self, up):
+        # The statistics of the merged cluster are computed from the
+        # statistics of the deleted clusters, without loading the waveforms.
+        stats = [self._load_stats(cluster) for cluster in up.deleted]
+        if any(item is None for item in stats):
+            return self.assign(up)
+        cluster = up.added[0]
+        self._store_stats(cluster, merge_waveform_stats(stats),
+                          up.new_spikes_per_cluster[cluster])
+
+    def assign(self, up):
+        self.store_all_from_model({cluster: up.new_spikes_per_cluster[cluster]
+                                   for cluster in up.added})
+
+
 #------------------------------------------------------------------------------
 # Session class
 #------------------------------------------------------------------------------
@@ -110,6 +204,21 @@ def _ensure_disk_store_exists(dir_name, root_path=None):
     return path
 
 
+# Default sample rate, bin size and window size of the correlograms (in
+# seconds).
+_DEFAULT_SAMPLE_RATE = 20000.
+_CCG_BINSIZE = .001
+_CCG_WINSIZE = .05
+
+
+def _ccg_params(sample_rate):
+    """Return the bin size and number of bins of the correlograms."""
+    binsize = max(1, int(sample_rate * _CCG_BINSIZE))
+    winsize_samples = int(sample_rate * _CCG_WINSIZE)
+    winsize_bins = 2 * ((winsize_samples // 2) // binsize) + 1
+    return binsize, winsize_bins
+
+
 def _process_ups(ups):
     """This function processes the UpdateInfo instances of the two
     undo stacks (clustering and cluster metadata) and concatenates them
@@ -135,12 +244,24 @@ class Session(BaseSession):
         Path to a .kwik file, to be used if 'model' is not used.
     model : instance of BaseModel
         A Model instance, to be used if 'filename' is not used.
+    lazy_store : bool
+        Whether the sparse arrays of the cluster store are loaded lazily
+        from the disk.
+    waveform_stats : bool
+        Whether the mean and standard deviation of the waveforms of every
+        cluster are computed in the cluster store. This requires a pass
+        over the waveforms of all clusters when the session opens. Defaults
+        to False.
 
     """
-    def __init__(self, store_path=None):
+    def __init__(self, store_path=None, lazy_store=False,
+                 waveform_stats=False):
         super(Session, self).__init__()
         self.model = None
+        self.store = None
         self._store_path = store_path
+        self._lazy_store = lazy_store
+        self._waveform_stats = waveform_stats
 
         # self.action and self.connect are decorators.
         self.action(self.open, title='Open')
@@ -150,6 +271,7 @@ class Session(BaseSession):
         self.action(self.move, title='Move clusters to a group')
         self.action(self.undo, title='Undo')
         self.action(self.redo, title='Redo')
+        self.action(self.save, title='Save')
 
         self.connect(self.on_open)
         self.connect(self.on_cluster)
@@ -157,9 +279,19 @@ class Session(BaseSession):
     # Public actions
     # -------------------------------------------------------------------------
 
-    def open(self, filename=None, model=None):
+    def open(self, filename=None, model=None, **kwargs):
+        """Open a kwik file, or a model. The keyword arguments are passed
+        to KwikModel.
+
+        With `waveform_stats=True`, the waveform statistics of the clusters
+        which are not in the store yet are computed before this method
+        returns, with a pass over the waveforms of all these clusters. This
+        may take a while with a large recording, but the statistics are
+        reused by the next sessions.
+
+        """
         if model is None:
-            model = KwikModel(filename)
+            model = KwikModel(filename, **kwargs)
         self.model = model
         self.emit('open')
 
@@ -187,34 +319,87 @@ class Session(BaseSession):
         up = self._global_history.redo()
         self.emit('cluster', up=up, add_to_stack=False)
 
+    def save(self):
+        """Save the changes made since the last save to the model."""
+        if self._spikes_to_save:
+            spikes = np.unique(np.concatenate(self._spikes_to_save))
+        else:
+            spikes = np.array([], dtype=np.int64)
+        # Groups of the changed clusters, None for the deleted clusters.
+        cluster_ids = set(self.clustering.cluster_ids)
+        groups = {cluster: (self.cluster_metadata.group(cluster)
+                            if cluster in cluster_ids else None)
+                  for cluster in self._clusters_to_save}
+        self.model.save(self.clustering.spike_clusters,
+                        spikes=spikes,
+                        cluster_groups=groups)
+        self._spikes_to_save = []
+        self._clusters_to_save = set()
+        self.emit('save')
+
+    def close(self):
+        """Close the cluster store and the model."""
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        if self.model is not None:
+            self.model.close()
+
     # Event callbacks
     # -------------------------------------------------------------------------
 
     def on_open(self):
         """Update the session after new data has been loaded."""
         self._global_history = GlobalHistory(process_ups=_process_ups)
+        # Spikes and clusters changed since the last save.
+        self._spikes_to_save = []
+        self._clusters_to_save = set()
         # TODO: call this after the channel groups has changed.
         # Update the Selector and Clustering instances using the Model.
         spike_clusters = self.model.spike_clusters
         self.clustering = Clustering(spike_clusters)
         self.cluster_metadata = self.model.cluster_metadata
         # TODO: n_spikes_max in a user parameter
-        self.selector = Selector(spike_clusters, n_spikes_max=100)
+        self.selector = Selector(self.clustering.spike_clusters,
+                                 n_spikes_max=100)
 
         # Kwik store.
+        if self.store is not None:
+            self.store.close()
         path = _ensure_disk_store_exists(self.model.name,
                                          root_path=self._store_path)
-        self.store = ClusterStore(model=self.model, path=path)
+        self.store = ClusterStore(model=self.model, path=path,
+                                  lazy=self._lazy_store)
         self.store.register_item(FeatureMasks)
-        # TODO: do not reinitialize the store every time the dataset
-        # is loaded! Check if the store exists and check consistency.
+        if self._waveform_stats:
+            self.store.register_item(Waveforms)
+        # The items may reuse the data stored on disk by a previous session
+        # for the clusters which have not changed.
         self.store.generate(self.clustering.spikes_per_cluster)
 
+        # Correlograms, computed when first needed.
+        sample_rate = (self.model.metadata or {}).get('sample_rate',
+                                                      _DEFAULT_SAMPLE_RATE)
+        binsize, winsize_bins = _ccg_params(sample_rate)
+        self.correlograms = CorrelogramCache(
+            self.model.spike_times,
+            self.clustering.spike_clusters,
+            binsize=binsize,
+            winsize_bins=winsize_bins,
+            spikes_per_cluster=lambda: self.clustering.spikes_per_cluster)
+
         @self.connect
         def on_cluster(up=None, add_to_stack=None):
             self.store.update(up)
+            self.correlograms.update(up)
 
     def on_cluster(self, up=None, add_to_stack=True):
+        if up is not None:
+            if len(up.spikes):
+                self._spikes_to_save.append(_as_array(up.spikes))
+            self._clusters_to_save.update(up.added)
+            self._clusters_to_save.update(up.deleted)
+            self._clusters_to_save.update(up.metadata_changed)
         if add_to_stack:
             self._global_history.action(self.clustering)
             # TODO: if metadata
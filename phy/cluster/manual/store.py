@@ -6,6 +6,7 @@
 # Imports
 #------------------------------------------------------------------------------
 
+from collections import OrderedDict
 import os
 import os.path as op
 
@@ -22,6 +23,10 @@ from ...ext.six import string_types
 # Data stores
 #------------------------------------------------------------------------------
 
+# Maximum number of cluster files kept open in lazy mode.
+_MAX_OPEN_FILES = 32
+
+
 class MemoryStore(object):
     """Store cluster-related data in memory."""
     def __init__(self):
@@ -62,10 +67,22 @@ class MemoryStore(object):
 
 
 class DiskStore(object):
-    """Store cluster-related data in HDF5 files."""
-    def __init__(self, directory):
+    """Store cluster-related data in HDF5 files.
+
+    In lazy mode, sparse arrays are loaded as LazySparseCSR views, and the
+    cluster files stay open until the clusters are modified or deleted, or
+    until the store is closed. At most `max_open_files` files are kept
+    open: the least recently loaded cluster files are closed first, and
+    their views become invalid.
+
+    """
+    def __init__(self, directory, lazy=False, max_open_files=None):
         assert directory is not None
         self._directory = op.realpath(directory)
+        self._lazy = lazy
+        self._max_open_files = max_open_files or _MAX_OPEN_FILES
+        # Cluster files kept open in lazy mode, in access order.
+        self._files = OrderedDict()
 
     # Internal methods
     # -------------------------------------------------------------------------
@@ -85,13 +102,33 @@ class DiskStore(object):
         path = self._cluster_path(cluster)
         return open_h5(path, mode)
 
+    def _lazy_cluster_file(self, cluster):
+        """Return a cluster file which is kept open in read mode."""
+        f = self._files.pop(cluster, None)
+        if f is None:
+            f = self._cluster_file(cluster, 'r')
+        self._files[cluster] = f
+        # Close the least recently used files.
+        while len(self._files) > self._max_open_files:
+            _, evicted = self._files.popitem(last=False)
+            evicted.close()
+        return f
+
+    def _close_cluster_file(self, cluster):
+        """Close a cluster file kept open in lazy mode."""
+        f = self._files.pop(cluster, None)
+        if f is not None:
+            f.close()
+
     # Data get/set methods
     # -------------------------------------------------------------------------
 
     def _get(self, f, key):
-        """Return the data for a given key."""
+        """Return the data for a given key, or None if it does not exist."""
         path = '/{0:s}'.format(key)
-        return load_h5(f, path)
+        if path not in f.h5py_file:
+            return None
+        return load_h5(f, path, lazy=self._lazy)
 
     def _set(self, f, key, value):
         """Set the data for a given key."""
@@ -103,33 +140,42 @@ class DiskStore(object):
 
     def store(self, cluster, **data):
         """Store cluster-related data."""
+        # The lazy views of that cluster become invalid.
+        self._close_cluster_file(cluster)
         with self._cluster_file(cluster, 'a') as f:
             for key, value in data.items():
                 self._set(f, key, value)
 
+    def _load(self, f, keys):
+        # If a single key is requested, return the value.
+        if isinstance(keys, string_types):
+            return self._get(f, keys)
+        # All keys are requested if None: datasets and sparse arrays.
+        if keys is None:
+            datasets = f.datasets()
+            keys = [key for key in f.children()
+                    if key in datasets or
+                    f.has_attr('/' + key, 'sparse_type')]
+        assert isinstance(keys, (list, tuple))
+        # Fetch the values for all requested keys.
+        return {key: self._get(f, key) for key in keys}
+
     def load(self, cluster, keys=None):
         """Load cluster-related data."""
         # The cluster doesn't exist: return None for all keys.
         if not self._cluster_file_exists(cluster):
             if keys is None:
                 return {}
+            elif isinstance(keys, string_types):
+                return None
             else:
                 return {key: None for key in keys}
-        # Create the output dictionary.
-        out = {}
+        # In lazy mode, the file stays open for the returned views.
+        if self._lazy:
+            return self._load(self._lazy_cluster_file(cluster), keys)
         # Open the cluster file in read mode.
         with self._cluster_file(cluster, 'r') as f:
-            # If a single key is requested, return the value.
-            if isinstance(keys, string_types):
-                return self._get(f, keys)
-            # All keys are requested if None.
-            if keys is None:
-                keys = f.datasets()
-            assert isinstance(keys, (list, tuple))
-            # Fetch the values for all requested keys.
-            for key in keys:
-                out[key] = self._get(f, key)
-        return out
+            return self._load(f, keys)
 
     @property
     def clusters(self):
@@ -143,6 +189,7 @@ class DiskStore(object):
     def delete(self, clusters):
         """Delete some clusters from the store."""
         for cluster in clusters:
+            self._close_cluster_file(cluster)
             if self._cluster_file_exists(cluster):
                 os.remove(self._cluster_path(cluster))
 
@@ -150,6 +197,11 @@ class DiskStore(object):
         """Clear the store completely by deleting all clusters."""
         self.delete(self.clusters)
 
+    def close(self):
+        """Close all cluster files kept open in lazy mode."""
+        for cluster in list(self._files):
+            self._close_cluster_file(cluster)
+
 
 #------------------------------------------------------------------------------
 # Store
@@ -158,14 +210,14 @@ class DiskStore(object):
 class Store(object):
     """Wrap a MemoryStore and a DiskStore."""
 
-    def __init__(self, store_path):
+    def __init__(self, store_path, lazy=False):
         assert store_path is not None
 
         # Create the memory store.
         self._memory_store = MemoryStore()
 
         # Create the disk store.
-        self._disk_store = DiskStore(store_path)
+        self._disk_store = DiskStore(store_path, lazy=lazy)
 
         # Where the info are stored: a {'field' => ('memory' or 'disk')} dict.
         self._dispatch = {}
@@ -245,18 +297,22 @@ class Store(object):
         self._memory_store.delete(clusters)
         self._disk_store.delete(clusters)
 
+    def close(self):
+        """Close the disk store."""
+        self._disk_store.close()
+
 
 #------------------------------------------------------------------------------
 # Cluster store
 #------------------------------------------------------------------------------
 
 class ClusterStore(object):
-    def __init__(self, model=None, path=None):
+    def __init__(self, model=None, path=None, lazy=False):
         assert model is not None
         assert path is not None
 
         self._model = model
-        self._store = Store(path)
+        self._store = Store(path, lazy=lazy)
         self._items = []
 
     def register_item(self, item_cls):
@@ -271,17 +327,22 @@ class ClusterStore(object):
         # Create the self.<name>(cluster) method for loading.
         for name, _ in item.fields:
             setattr(self, name,
-                    lambda cluster: self._store.load(cluster, name))
+                    lambda cluster, name=name: self._store.load(cluster,
+                                                                name))
 
     def update(self, up):
-        # Delete the deleted clusters from the store.
-        self._store.delete(up.deleted)
         if up.description == 'merge':
             self.merge(up)
         elif up.description == 'assign':
             self.assign(up)
+        elif up.description.startswith('metadata'):
+            # Cluster metadata changes do not affect the stored data.
+            pass
         else:
             raise NotImplementedError()
+        # Delete the deleted clusters from the store. This happens after the
+        # update so that the items can use the data of the deleted clusters.
+        self._store.delete(up.deleted)
 
     def merge(self, up):
         for item in self._items:
@@ -291,15 +352,22 @@ class ClusterStore(object):
         for item in self._items:
             item.assign(up)
 
+    def close(self):
+        """Close the cluster files kept open in lazy mode."""
+        self._store.close()
+
     def generate(self, spikes_per_cluster):
         """Populate the cache for all registered fields and the specified
-        clusters."""
+        clusters. The clusters already stored by an item are skipped."""
         assert isinstance(spikes_per_cluster, dict)
         clusters = sorted(spikes_per_cluster.keys())
-        self._store.delete(clusters)
         for item in self._items:
-            for cluster in clusters:
-                item.store_from_model(cluster, spikes_per_cluster[cluster])
+            spc = {cluster: spikes_per_cluster[cluster]
+                   for cluster in clusters
+                   if not item.is_stored(cluster,
+                                         spikes_per_cluster[cluster])}
+            if spc:
+                item.store_all_from_model(spc)
 
 
 class StoreItem(object):
@@ -318,6 +386,21 @@ class StoreItem(object):
         for cluster in up.added:
             self.store_from_model(cluster, up.new_spikes_per_cluster[cluster])
 
+    def is_stored(self, cluster, spikes):
+        """Whether the data of a cluster is already in the store.
+
+        May be overridden, for example to reuse data stored on disk by a
+        previous session.
+
+        """
+        return False
+
+    def store_all_from_model(self, spikes_per_cluster):
+        """May be overridden, for example to load the data of all clusters
+        in a single pass."""
+        for cluster in sorted(spikes_per_cluster):
+            self.store_from_model(cluster, spikes_per_cluster[cluster])
+
     def store_from_model(self, cluster, spikes):
         """Must be overridden."""
         raise NotImplementedError()
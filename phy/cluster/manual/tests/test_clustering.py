@@ -226,6 +226,18 @@ def test_clustering_descendants_split():
     _check_spikes_per_cluster(clustering)
 
 
+def test_clustering_read_only():
+    n_spikes = 100
+    n_clusters = 10
+    spike_clusters = artificial_spike_clusters(n_spikes, n_clusters)
+    spike_clusters.flags.writeable = False
+
+    clustering = Clustering(spike_clusters)
+    clustering.merge([0, 1])
+    assert clustering.spike_clusters.flags.writeable
+    ae(spike_clusters, clustering._spike_clusters_base)
+
+
 def test_clustering_merge():
     n_spikes = 1000
     n_clusters = 10
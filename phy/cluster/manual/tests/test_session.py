@@ -17,6 +17,8 @@ from ..session import BaseSession, Session
 from ....utils.tempdir import TemporaryDirectory
 from ....io.mock.artificial import MockModel
 from ....io.mock.kwik import create_mock_kwik
+from ....io.kwik_model import KwikModel
+from ....stats.ccg import correlograms
 from ....plot.waveforms import add_waveform_view
 
 
@@ -216,6 +218,65 @@ def test_session_kwik():
         view.close()
 
 
+def test_session_save():
+
+    n_clusters = 5
+    n_spikes = 50
+    n_channels = 28
+    n_fets = 2
+    n_samples_traces = 3000
+
+    with TemporaryDirectory() as tempdir:
+
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=n_clusters,
+                                    n_spikes=n_spikes,
+                                    n_channels=n_channels,
+                                    n_features_per_channel=n_fets,
+                                    n_samples_traces=n_samples_traces)
+
+        session = Session(store_path=tempdir)
+        session.open(filename)
+        session.merge([3, 4])
+        session.move([5], 1)
+        spike_clusters = session.clustering.spike_clusters.copy()
+        session.save()
+        session.model.close()
+
+        session = Session(store_path=tempdir)
+        session.open(filename)
+        ae(session.model.spike_clusters, spike_clusters)
+        clusters = session.model._clusters
+        assert 5 in clusters
+        assert 3 not in clusters
+        assert 4 not in clusters
+        path = '/channel_groups/1/clusters/main/5'
+        assert session.model._kwik.read_attr(path, 'cluster_group') == 1
+        assert session.cluster_metadata.group(5) == 1
+        assert session.cluster_metadata.group(0) == 3
+
+        # Undo the merge and save again.
+        session.merge([0, 1])
+        session.undo()
+        session.save()
+        ae(session.model.spike_clusters, spike_clusters)
+        session.model.close()
+
+
+def test_session_lazy_store():
+    with TemporaryDirectory() as tempdir:
+        session = Session(store_path=tempdir, lazy_store=True)
+        session.open(model=MockModel())
+        store = session.store
+        assert store._store._disk_store._lazy
+        session.merge([3, 4])
+        assert session.store.masks(5) is not None
+        session.close()
+        assert session.store is None
+        assert not store._store._disk_store._files
+
+
 def test_session_stats():
 
     n_clusters = 5
@@ -250,3 +311,123 @@ def test_session_stats():
 
         # masks = session.stats.cluster_masks(n_clusters)
         # assert masks.shape == (n_channels,)
+
+
+def test_session_waveform_stats():
+
+    n_clusters = 5
+    n_spikes = 50
+    n_channels = 28
+    n_fets = 2
+    n_samples_traces = 3000
+
+    with TemporaryDirectory() as tempdir:
+
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=n_clusters,
+                                    n_spikes=n_spikes,
+                                    n_channels=n_channels,
+                                    n_features_per_channel=n_fets,
+                                    n_samples_traces=n_samples_traces)
+
+        # With pre-filtered traces, the waveforms do not depend on the
+        # spikes loaded together.
+        model = KwikModel(filename)
+        model.prefilter_traces()
+        model.close()
+
+        # The waveform statistics are not computed by default.
+        session = Session(store_path=tempdir)
+        session.open(filename)
+        assert not hasattr(session.store, 'mean_waveforms')
+        session.close()
+
+        session = Session(store_path=tempdir, waveform_stats=True)
+        session.open(filename)
+        waveforms = session.model.waveforms[:]
+
+        def _check(cluster):
+            spikes = session.clustering.spikes_per_cluster[cluster]
+            mean = session.store.mean_waveforms(cluster)
+            assert np.allclose(mean, waveforms[spikes].mean(axis=0),
+                               atol=1e-5)
+            assert np.allclose(session.store.std_waveforms(cluster),
+                               waveforms[spikes].std(axis=0), atol=1e-5)
+            assert session.store.n_spikes_waveforms(cluster) == len(spikes)
+            ptp = mean.max(axis=0) - mean.min(axis=0)
+            assert session.store.peak_channel(cluster) == np.argmax(ptp)
+
+        for cluster in session.clustering.cluster_ids:
+            _check(cluster)
+
+        # The statistics of merged clusters are combined.
+        session.merge([3, 4])
+        _check(5)
+        assert session.store.mean_waveforms(3) is None
+
+        # Undo and split.
+        session.undo()
+        _check(3)
+        _check(4)
+        session.split(np.arange(10))
+        for cluster in session.clustering.cluster_ids:
+            _check(cluster)
+        session.close()
+
+        # Mark the stored statistics of two clusters. The checksum of the
+        # spikes of the second one does not match anymore.
+        session = Session(store_path=tempdir, waveform_stats=True)
+        session.open(filename)
+        mean_1 = session.store.mean_waveforms(1)
+        session.store._store.store(1, mean_waveforms=mean_1 + 1)
+        mean_2 = session.store.mean_waveforms(2)
+        session.store._store.store(2, mean_waveforms=mean_2 + 1,
+                                   waveforms_checksum=np.array(0))
+        session.close()
+
+        # The next session reuses the statistics of the unchanged clusters
+        # stored on disk, and computes the others again.
+        session = Session(store_path=tempdir, waveform_stats=True)
+        session.open(filename)
+        ae(session.store.mean_waveforms(1), mean_1 + 1)
+        for cluster in session.clustering.cluster_ids:
+            if cluster != 1:
+                _check(cluster)
+        session.close()
+
+        # The statistics are computed again when the waveforms are loaded
+        # with another data type.
+        session = Session(store_path=tempdir, waveform_stats=True)
+        session.open(filename, waveform_dtype=np.int16)
+        assert session.model.waveform_scale_factor is not None
+        session.close()
+
+        session = Session(store_path=tempdir, waveform_stats=True)
+        session.open(filename)
+        for cluster in session.clustering.cluster_ids:
+            _check(cluster)
+        session.close()
+
+
+def test_session_correlograms():
+    with TemporaryDirectory() as tempdir:
+        session = Session(store_path=tempdir)
+        session.open(model=MockModel())
+        cache = session.correlograms
+        assert cache.binsize == 20
+        assert cache.winsize_bins == 51
+
+        def _check():
+            ae(cache.correlograms,
+               correlograms(session.model.spike_times,
+                            session.clustering.spike_clusters,
+                            binsize=20, winsize_bins=51))
+
+        _check()
+        session.merge([3, 4])
+        _check()
+        session.split(np.arange(0, 1000, 3))
+        _check()
+        session.undo()
+        _check()
@@ -13,6 +13,7 @@ from numpy.testing import assert_array_equal as ae
 
 from ....utils.logging import set_level
 from ....utils.tempdir import TemporaryDirectory
+from ....io.sparse import csr_matrix, SparseCSR, LazySparseCSR
 from ..store import MemoryStore, DiskStore, Store, ClusterStore, StoreItem
 from .._utils import _spikes_per_cluster
 from .._update_info import UpdateInfo
@@ -94,6 +95,61 @@ def test_disk_store():
         assert ds.clusters == []
 
 
+def test_disk_store_lazy():
+
+    dense = np.random.rand(10, 4, 2)
+    dense[dense < .5] = 0
+    sparse = csr_matrix(dense)
+    a = np.random.rand(2, 4)
+
+    with TemporaryDirectory() as tempdir:
+        ds = DiskStore(tempdir, lazy=True)
+        ds.store(3, key=a, sparse=sparse)
+
+        # Sparse arrays are lazily loaded.
+        lazy = ds.load(3, 'sparse')
+        assert isinstance(lazy, LazySparseCSR)
+        assert lazy.shape == (10, 4, 2)
+        loaded = lazy[[5, 1, 1]]
+        assert isinstance(loaded, SparseCSR)
+        ae(loaded.to_dense(), dense[[5, 1, 1]])
+        ae(lazy.load().to_dense(), dense)
+
+        # Dense arrays are loaded in memory.
+        d = ds.load(3)
+        assert sorted(d.keys()) == ['key', 'sparse']
+        ae(d['key'], a)
+
+        # The cluster file can be modified while views are open.
+        ds.store(3, key=a + 1)
+        ae(ds.load(3, 'key'), a + 1)
+        ae(ds.load(3, 'sparse')[2:4].to_dense(), dense[2:4])
+
+        ds.delete([3])
+        assert ds.clusters == []
+        ds.close()
+
+
+def test_disk_store_lazy_max_open_files():
+
+    sparse = csr_matrix(np.eye(4)[:, :, np.newaxis])
+
+    with TemporaryDirectory() as tempdir:
+        ds = DiskStore(tempdir, lazy=True, max_open_files=2)
+        for cluster in range(5):
+            ds.store(cluster, sparse=sparse)
+        for cluster in range(5):
+            ds.load(cluster, 'sparse')
+        # Only the most recently loaded files are kept open.
+        assert list(ds._files) == [3, 4]
+        ds.load(3, 'sparse')
+        ds.load(0, 'sparse')
+        assert list(ds._files) == [3, 0]
+        ae(ds.load(0, 'sparse').load().to_dense(), sparse.to_dense())
+        ds.close()
+        assert not ds._files
+
+
 def test_store():
     with TemporaryDirectory() as tempdir:
         cs = Store(tempdir)
@@ -195,6 +195,17 @@ class BaseModel(object):
         """
         raise NotImplementedError()
 
+    @property
+    def waveform_params(self):
+        """A dictionary with the parameters which determine the waveforms
+        of the current channel group, for example their data type and
+        their filter.
+
+        May be implemented by child classes.
+
+        """
+        return {'channel_group': getattr(self, '_channel_group', None)}
+
     @property
     def probe(self):
         """A Probe instance.
@@ -204,8 +215,13 @@ class BaseModel(object):
         """
         raise NotImplementedError()
 
-    def save(self):
-        """Save the data.
+    def save(self, spike_clusters=None, spikes=None, cluster_groups=None):
+        """Save the spike clusters and the groups of the clusters.
+
+        `spikes` are the spikes which have changed since the last save, and
+        `cluster_groups` is a `{cluster: group}` dictionary with the groups
+        of the new or changed clusters, where a None group deletes the
+        cluster.
 
         May be implemented by child classes.
 
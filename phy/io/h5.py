@@ -57,12 +57,52 @@ def _check_hdf5_path(h5_file, path):
 # File class
 #------------------------------------------------------------------------------
 
+# Options passed to h5py.File() when opening a file.
+_H5PY_OPTIONS = ('driver',
+                 'rdcc_nbytes',
+                 'rdcc_nslots',
+                 'rdcc_w0',
+                 'page_buf_size',
+                 )
+
+
 class File(object):
-    def __init__(self, filename, mode=None):
+    """An HDF5 file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the HDF5 file.
+    mode : str
+        Opening mode ('r' by default).
+    driver : str
+        HDF5 file driver, like 'sec2' (default), 'stdio' or 'core'.
+    rdcc_nbytes : int
+        Size in bytes of the raw data chunk cache of every dataset
+        (1 MB by default).
+    rdcc_nslots : int
+        Number of slots of the chunk cache hash table. This should be a
+        prime number about 100 times larger than the number of chunks
+        fitting in the cache.
+    rdcc_w0 : float
+        Chunk preemption policy, between 0 (least recently used chunks are
+        evicted first) and 1 (fully read chunks are evicted first).
+    page_buf_size : int
+        Size in bytes of the page buffer. The file must have been created
+        with the paged file space strategy.
+
+    """
+    def __init__(self, filename, mode=None, **options):
         if mode is None:
             mode = 'r'
+        for name in options:
+            if name not in _H5PY_OPTIONS:
+                raise ValueError("Unknown HDF5 option '{0:s}'.".format(name))
         self.filename = filename
         self.mode = mode
+        # Only pass the specified options to h5py.
+        self.options = {name: value for name, value in options.items()
+                        if value is not None}
         self._h5py_file = None
 
     # Open and close
@@ -78,7 +118,19 @@ class File(object):
 
     def open(self):
         if not self.is_open():
-            self._h5py_file = h5py.File(self.filename, self.mode)
+            self._h5py_file = h5py.File(self.filename, self.mode,
+                                        **self.options)
+
+    def flush(self):
+        """Write the buffered data to disk."""
+        if self.is_open():
+            self._h5py_file.flush()
+
+    def reopen(self, mode):
+        """Close the file and open it again in another mode."""
+        self.close()
+        self.mode = mode
+        self.open()
 
     def close(self):
         if self.is_open():
@@ -93,6 +145,29 @@ class File(object):
         _check_hdf5_path(self._h5py_file, path)
         return self._h5py_file[path]
 
+    def mmap(self, path):
+        """Return a read-only memory map of an HDF5 dataset.
+
+        This only works with contiguous, uncompressed datasets: None is
+        returned otherwise.
+
+        """
+        dataset = self.read(path)
+        # Chunked (and thus compressed) datasets are not stored in a
+        # single block on disk.
+        if dataset.chunks is not None or dataset.dtype.hasobject:
+            return None
+        # Empty arrays cannot be memory-mapped.
+        if dataset.size == 0:
+            return None
+        # The offset is undefined if the data has not been allocated yet.
+        offset = dataset.id.get_offset()
+        if offset is None:
+            return None
+        return np.memmap(self.filename, mode='r',
+                         shape=dataset.shape, offset=offset,
+                         dtype=dataset.dtype)
+
     def write(self, path, array, overwrite=False):
         """Write a NumPy array in the file.
 
@@ -141,6 +216,11 @@ class File(object):
             raise KeyError("The attribute '{0:s}'".format(attr_name) +
                            " doesn't exist.")
 
+    def delete(self, path):
+        """Delete a group or a dataset if it exists."""
+        if path in self._h5py_file:
+            del self._h5py_file[path]
+
     def write_attr(self, path, attr_name, value):
         """Write an attribute of an HDF5 group."""
         # If the parent group doesn't already exist, create it.
@@ -209,7 +289,12 @@ class File(object):
         self.close()
 
 
-def open_h5(filename, mode=None):
-    file = File(filename, mode=mode)
+def open_h5(filename, mode=None, **options):
+    """Open an HDF5 file and return a File instance.
+
+    The keyword arguments are HDF5 driver and chunk cache options (see File).
+
+    """
+    file = File(filename, mode=mode, **options)
     file.open()
     return file
@@ -6,6 +6,7 @@
 # Imports
 #------------------------------------------------------------------------------
 
+from collections import OrderedDict
 import os.path as op
 
 import numpy as np
@@ -15,10 +16,15 @@ from .base_model import BaseModel
 from ..cluster.manual.cluster_info import ClusterMetadata
 from .h5 import open_h5, _check_hdf5_path
 from ..waveform.loader import WaveformLoader
-from ..waveform.filter import bandpass_filter, apply_filter
+from ..waveform.filter import (Filter, filter_traces, _int16_scale,
+                               _filtered_amplitude)
+from ..waveform.pca import pca_features
 from ..electrode.mea import MEA, linear_positions
-from ..utils.logging import debug
-from ..utils.array import PartialArray
+from ..utils.logging import debug, info, warn
+from ..utils.array import PartialArray, _as_array, _index_runs
+from .sparse import LazySparseCSR
+from .sidecar import SidecarCache
+from ..utils._bunch import Bunch
 
 
 #------------------------------------------------------------------------------
@@ -127,7 +133,34 @@ _COLOR_MAP = np.array([[1., 1., 1.],
                        [0.9, 0.876, 0.45]])
 
 
-_KWIK_EXTENSIONS = ('kwik', 'kwx', 'raw.kwd')
+_KWIK_EXTENSIONS = ('kwik', 'kwx', 'raw.kwd', 'filtered.kwd')
+
+
+# Default HDF5 options for the different Kwik files (see phy.io.h5.File).
+# The features and traces are randomly accessed when selecting clusters, so
+# their chunks are kept in a large cache.
+_KWIK_H5_OPTIONS = {
+    'kwik': {},
+    'kwx': {'rdcc_nbytes': 64 * 1024 * 1024,
+            'rdcc_nslots': 10007,
+            'rdcc_w0': 0.,
+            },
+    'raw.kwd': {'rdcc_nbytes': 32 * 1024 * 1024,
+                'rdcc_nslots': 10007,
+                'rdcc_w0': 0.,
+                },
+    'filtered.kwd': {'rdcc_nbytes': 32 * 1024 * 1024,
+                     'rdcc_nslots': 10007,
+                     'rdcc_w0': 0.,
+                     },
+}
+
+
+def _kwik_h5_options(ext, h5_options=None):
+    """Return the HDF5 options for a given type of Kwik file."""
+    options = dict(_KWIK_H5_OPTIONS[ext])
+    options.update((h5_options or {}).get(ext, {}))
+    return options
 
 
 def _kwik_filenames(filename):
@@ -138,6 +171,96 @@ def _kwik_filenames(filename):
             for ext in _KWIK_EXTENSIONS}
 
 
+def _in_memory_size(obj):
+    """Return the number of bytes held in memory by arrays in a
+    (possibly nested) dictionary. Memory-mapped arrays are not counted."""
+    if isinstance(obj, dict):
+        return sum(_in_memory_size(value) for value in obj.values())
+    elif isinstance(obj, np.ndarray) and not isinstance(obj, np.memmap):
+        return obj.nbytes
+    else:
+        return 0
+
+
+class _LRUCache(object):
+    """Least-recently-used cache with a bounded total size in bytes.
+
+    If specified, `on_evict(value)` is called when an item is evicted or
+    when the cache is cleared.
+
+    """
+    def __init__(self, max_size=None, size=None, on_evict=None):
+        self._max_size = max_size
+        self._size = size or _in_memory_size
+        self._on_evict = on_evict
+        # A mapping {key: (value, size)} in access order.
+        self._items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def total_size(self):
+        """Total size of the cached items, in bytes."""
+        return sum(size for (_, size) in self._items.values())
+
+    def get(self, key):
+        """Return a cached item, or None if it is not in the cache."""
+        if key not in self._items:
+            return None
+        value, size = self._items.pop(key)
+        self._items[key] = (value, size)
+        return value
+
+    def set(self, key, value):
+        """Add or update an item, evicting the least recently used items
+        if the cache exceeds its maximum size.
+
+        The item which is set is never evicted, as it is the one in use,
+        even if it is larger than the maximum size.
+
+        """
+        self._items.pop(key, None)
+        self._items[key] = (value, self._size(value))
+        if self._max_size is None:
+            return
+        # The item which is set is the most recently used one: it is last.
+        while len(self._items) > 1 and self.total_size > self._max_size:
+            evicted, (value, _) = self._items.popitem(last=False)
+            debug("Evict {0} from the cache.".format(evicted))
+            if self._on_evict is not None:
+                self._on_evict(value)
+
+    def clear(self):
+        """Remove all items from the cache."""
+        if self._on_evict is not None:
+            for value, _ in self._items.values():
+                self._on_evict(value)
+        self._items.clear()
+
+
+def _close_channel_group(state):
+    """Release the resources of a cached channel group."""
+    if state.waveform_loader is not None:
+        state.waveform_loader.close()
+
+
+def _lazy_array(f, path):
+    """Return an on-disk view of a dataset, without loading it in memory.
+
+    Contiguous datasets are memory-mapped, whereas chunked datasets are
+    wrapped into a PartialArray proxy.
+
+    """
+    arr = f.mmap(path)
+    if arr is None:
+        arr = PartialArray(f.read(path))
+    return arr
+
+
 class SpikeLoader(object):
     """Translate selection with spike ids into selection with
     absolute times."""
@@ -145,21 +268,296 @@ class SpikeLoader(object):
         self._spike_times = spike_times
         self._waveforms = waveforms
 
+    def _spikes(self, item):
+        """Convert a slice of spike ids to an array of spike ids."""
+        if isinstance(item, slice):
+            return np.arange(*item.indices(len(self)))
+        return item
+
     def __getitem__(self, item):
-        times = self._spike_times[item]
+        """Load the waveforms of a spike, an array or a slice of spike
+        ids."""
+        times = self._spike_times[self._spikes(item)]
         return self._waveforms[times]
 
+    def __len__(self):
+        return len(self._spike_times)
+
+    def iter_batches(self, spikes, batch_size=None):
+        """Yield (indices, waveforms) batches in time order, where `indices`
+        are the positions of the loaded spikes in `spikes`, an array or a
+        slice of spike ids."""
+        times = self._spike_times[_as_array(self._spikes(spikes))]
+        return self._waveforms.iter_batches(times, batch_size=batch_size)
+
+
+#------------------------------------------------------------------------------
+# Sparse features and masks
+#------------------------------------------------------------------------------
+
+# Sparse features and masks are stored in the kwx file in a SparseCSR
+# structure with shape (n_spikes, n_channels, n_features_per_channel + 1),
+# where the last item contains the mask. Only unmasked channels are stored.
+_SPARSE_FEATURES_MASKS = 'features_masks_sparse'
+
+
+def _dense_features_masks(fm, start, end, n_channels, n_features_per_channel):
+    """Return (features, masks) arrays with shapes (n, n_channels, k) and
+    (n, n_channels) from a chunk of a dense features_masks dataset."""
+    k = n_features_per_channel
+    chunk = fm[start:end, :n_channels * k, :]
+    features = chunk[:, :, 0].reshape((-1, n_channels, k))
+    masks = chunk[:, ::k, 1]
+    return features, masks
+
+
+def _convert_features_masks(kwx, channel_group, n_channels,
+                            n_features_per_channel, chunk_size=None):
+    """Write the sparse features and masks of a channel group in a kwx file
+    from its dense features_masks dataset."""
+    if chunk_size is None:
+        chunk_size = 10000
+    k = n_features_per_channel
+    path = '/channel_groups/{0:d}'.format(channel_group)
+    fm = kwx.read(path + '/features_masks')
+    n_spikes = fm.shape[0]
+    if n_spikes == 0:
+        return
+    chunks = [(start, min(start + chunk_size, n_spikes))
+              for start in range(0, n_spikes, chunk_size)]
+
+    # First pass: count the unmasked channels of every spike.
+    counts = np.zeros(n_spikes, dtype=np.int64)
+    for start, end in chunks:
+        _, masks = _dense_features_masks(fm, start, end, n_channels, k)
+        counts[start:end] = (masks > 0).sum(axis=1)
+    spikes_ptr = np.r_[0, np.cumsum(counts)]
+    nnz = spikes_ptr[-1]
+
+    # Second pass: write the features and masks of the unmasked channels.
+    sparse_path = '{0:s}/{1:s}'.format(path, _SPARSE_FEATURES_MASKS)
+    kwx.delete(sparse_path)
+    kwx.write_attr(sparse_path, 'sparse_type', 'csr')
+    kwx.write_attr(sparse_path, 'shape', (n_spikes, n_channels, k + 1))
+    group = kwx.h5py_file[sparse_path]
+    data = group.create_dataset('data', shape=(nnz, k + 1),
+                                dtype=fm.dtype)
+    channels = group.create_dataset('channels', shape=(nnz,),
+                                    dtype=np.int32)
+    kwx.write(sparse_path + '/spikes_ptr', spikes_ptr)
+    for start, end in chunks:
+        features, masks = _dense_features_masks(fm, start, end, n_channels, k)
+        unmasked = masks > 0
+        i, j = spikes_ptr[start], spikes_ptr[end]
+        data[i:j, :k] = features[unmasked]
+        data[i:j, k] = masks[unmasked]
+        channels[i:j] = np.nonzero(unmasked)[1]
+    kwx.flush()
+
+
+def convert_features_masks(filename, chunk_size=None):
+    """Add sparse features and masks to the kwx file of an experiment.
+
+    The dense features_masks dataset of every channel group is converted,
+    chunk by chunk, to a sparse structure where only the unmasked channels
+    are stored. The features of masked channels are not kept.
+
+    """
+    filenames = _kwik_filenames(filename)
+    with open_h5(filename) as kwik:
+        k = kwik.read_attr('/application_data/spikedetekt',
+                           'nfeatures_per_channel')
+        channel_groups = _list_channel_groups(kwik.h5py_file)
+        n_channels = {channel_group: len(_list_channels(kwik.h5py_file,
+                                                        channel_group))
+                      for channel_group in channel_groups}
+    with open_h5(filenames['kwx'], 'a') as kwx:
+        for channel_group in channel_groups:
+            info("Converting the features and masks of channel group "
+                 "{0:d}.".format(channel_group))
+            _convert_features_masks(kwx, channel_group,
+                                    n_channels[channel_group], k,
+                                    chunk_size=chunk_size)
+
+
+#------------------------------------------------------------------------------
+# Filtered traces
+#------------------------------------------------------------------------------
+
+# The filtered traces are written in a filtered.kwd file, with the same
+# structure as the raw.kwd file, by chunks of this number of samples.
+_FILTER_CHUNK_SIZE = 200000
+# Number of overlapping samples between successive chunks.
+_FILTER_OVERLAP = 2000
+
+
+def _filter_attrs(metadata):
+    """Return the parameters of the filter, which are saved in the
+    filtered.kwd file."""
+    return {name: metadata[name] for name in ('sample_rate',
+                                              'filter_low',
+                                              'filter_high',
+                                              'filter_butter_order')}
+
+
+def _has_attrs(f, attrs, path='/'):
+    """Return whether a file has some attributes with the given values."""
+    return all(f.has_attr(path, name) and f.read_attr(path, name) == value
+               for name, value in attrs.items())
+
+
+#------------------------------------------------------------------------------
+# Journaled saving
+#------------------------------------------------------------------------------
+
+# HDF5 group in the kwik file where the pending changes are written before
+# being applied.
+_JOURNAL_PATH = '/_journal'
+
+
+def _write_journal(kwik, channel_group, clustering,
+                   spikes, spike_clusters, cluster_groups):
+    """Write clustering changes to the journal of a kwik file, and commit
+    them with an atomic marker.
+
+    cluster_groups is a {cluster: group} dictionary, where the group is None
+    for deleted clusters.
+
+    """
+    kwik.delete(_JOURNAL_PATH)
+    kwik.flush()
+    clusters = sorted(cluster_groups)
+    groups = [-1 if cluster_groups[cluster] is None
+              else cluster_groups[cluster] for cluster in clusters]
+    kwik.write_attr(_JOURNAL_PATH, 'channel_group', channel_group)
+    kwik.write_attr(_JOURNAL_PATH, 'clustering', clustering)
+    kwik.write(_JOURNAL_PATH + '/spikes', _as_array(spikes).astype(np.int64))
+    kwik.write(_JOURNAL_PATH + '/spike_clusters', _as_array(spike_clusters))
+    kwik.write(_JOURNAL_PATH + '/clusters',
+               np.array(clusters, dtype=np.int64))
+    kwik.write(_JOURNAL_PATH + '/cluster_groups',
+               np.array(groups, dtype=np.int64))
+    kwik.flush()
+    # The changes are only applied once this marker has been written.
+    kwik.write_attr(_JOURNAL_PATH, 'committed', True)
+    kwik.flush()
+
+
+def _apply_journal(kwik):
+    """Apply the committed changes of the journal of a kwik file, or discard
+    them if they were not committed."""
+    if _JOURNAL_PATH not in kwik.h5py_file:
+        return
+    if not kwik.has_attr(_JOURNAL_PATH, 'committed'):
+        warn("Discarding an incomplete save of the clustering.")
+        kwik.delete(_JOURNAL_PATH)
+        kwik.flush()
+        return
+    channel_group = int(kwik.read_attr(_JOURNAL_PATH, 'channel_group'))
+    clustering = kwik.read_attr(_JOURNAL_PATH, 'clustering')
+    if isinstance(clustering, bytes):
+        clustering = clustering.decode('utf8')
+    spikes = kwik.read(_JOURNAL_PATH + '/spikes')[...]
+    spike_clusters = kwik.read(_JOURNAL_PATH + '/spike_clusters')[...]
+    clusters = kwik.read(_JOURNAL_PATH + '/clusters')[...]
+    groups = kwik.read(_JOURNAL_PATH + '/cluster_groups')[...]
+
+    # Write the spike clusters by contiguous runs of spikes.
+    path = '/channel_groups/{0:d}/spikes/clusters/{1:s}'
+    dataset = kwik.read(path.format(channel_group, clustering))
+    for i, j in _index_runs(spikes):
+        dataset[spikes[i]:spikes[j] + 1] = spike_clusters[i:j + 1]
+
+    # Write the cluster groups.
+    path = '/channel_groups/{0:d}/clusters/{1:s}'.format(channel_group,
+                                                         clustering)
+    for cluster, group in zip(clusters, groups):
+        cluster_path = '{0:s}/{1:d}'.format(path, cluster)
+        if group < 0:
+            kwik.delete(cluster_path)
+        else:
+            kwik.write_attr(cluster_path, 'cluster_group', group)
+    kwik.flush()
+
+    # The journal is deleted once all changes have been applied. Applying it
+    # again after a crash is harmless.
+    kwik.delete(_JOURNAL_PATH)
+    kwik.flush()
+
 
 #------------------------------------------------------------------------------
 # KwikModel class
 #------------------------------------------------------------------------------
 
+# Default memory budget for the per-channel-group cache.
+_CHANNEL_GROUP_CACHE_SIZE = 1024 ** 3
+
+# Per-channel-group attributes which are cached when switching between
+# channel groups.
+_CHANNEL_GROUP_FIELDS = ('channels',
+                         'spike_times',
+                         'features',
+                         'masks',
+                         'probe',
+                         'waveform_loader',
+                         'clusterings',
+                         )
+
+
 class KwikModel(BaseModel):
-    """Holds data contained in a kwik file."""
+    """Holds data contained in a kwik file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the .kwik file.
+    lazy : bool
+        If True, the spike times and spike clusters are not loaded in memory:
+        they are memory-mapped when possible, or accessed through a proxy
+        otherwise. Defaults to False.
+    channel_group_cache_size : int
+        Maximum number of bytes held in memory by the data of the recently
+        visited channel groups, which are kept to switch back to them
+        quickly. Defaults to 1 GB.
+    h5_options : dict
+        A dictionary {ext: options} with HDF5 driver and chunk cache options
+        for the 'kwik', 'kwx' and 'raw.kwd' files (see phy.io.h5.File). These
+        options override the defaults for every type of file.
+    sparse : bool
+        If True, the features and masks are read from the sparse structure
+        of the kwx file (see `convert_features_masks()`), and selections
+        return SparseCSR arrays, with the same shapes as the dense features
+        and masks. Defaults to False.
+    traces : array-like or dict
+        A (n_samples, n_channels) array with the raw traces, for example a
+        memory-mapped raw binary file (see `phy.io.traces.read_dat()`).
+        If specified, it is used instead of the raw.kwd file. With several
+        recordings, a `{recording: traces}` dictionary is required.
+    cache_dir : str
+        Path to a directory where the spike times, spike clusters, channel
+        positions, structure and metadata of the kwik file are cached as
+        .npy files and a JSON manifest. The cache is rebuilt when the kwik
+        file changes, and cached arrays are memory-mapped.
+    n_workers : int
+        Number of threads used to load the waveforms. Defaults to 1.
+    waveform_dtype : dtype
+        Data type of the waveforms. Defaults to float32. With int16 or
+        float16, the waveforms are not scaled: the scale factor is given
+        by `waveform_scale_factor`.
+
+    """
     def __init__(self, filename=None,
                  channel_group=None,
                  recording=None,
-                 clustering=None):
+                 clustering=None,
+                 lazy=False,
+                 channel_group_cache_size=_CHANNEL_GROUP_CACHE_SIZE,
+                 h5_options=None,
+                 sparse=False,
+                 traces=None,
+                 cache_dir=None,
+                 n_workers=None,
+                 waveform_dtype=None):
         super(KwikModel, self).__init__()
 
         # Initialize fields.
@@ -175,13 +573,26 @@ class KwikModel(BaseModel):
         self._cluster_metadata = None
         self._traces = None
         self._waveform_loader = None
+        self._waveform_filter = None
+        self._n_workers = n_workers
+        self._waveform_dtype = waveform_dtype
+        self._clusterings = []
+        self._lazy = lazy
+        self._sparse = sparse
+        # External traces used instead of the raw.kwd file, set once the
+        # recordings are known.
+        self._raw_traces = None
+        # Data of the recently visited channel groups.
+        self._channel_group_cache = _LRUCache(
+            channel_group_cache_size, on_evict=_close_channel_group)
 
         if filename is None:
             raise ValueError("No filename specified.")
 
         # Open the file.
         self.name = op.splitext(op.basename(filename))[0]
-        self._kwik = open_h5(filename)
+        self._kwik = open_h5(filename,
+                             **_kwik_h5_options('kwik', h5_options))
         if not self._kwik.is_open():
             raise ValueError("File {0} failed to open.".format(filename))
 
@@ -192,23 +603,59 @@ class KwikModel(BaseModel):
 
         # Open the Kwx file if it exists.
         filenames = _kwik_filenames(filename)
+        self._filenames = filenames
+        self._h5_options = h5_options
         if op.exists(filenames['kwx']):
-            self._kwx = open_h5(filenames['kwx'])
+            self._kwx = open_h5(filenames['kwx'],
+                                **_kwik_h5_options('kwx', h5_options))
         else:
             self._kwx = None
 
-        # Open the Kwd file if it exists.
-        if op.exists(filenames['raw.kwd']):
-            self._kwd = open_h5(filenames['raw.kwd'])
+        # Open the Kwd file if it exists and no traces were specified.
+        if traces is None and op.exists(filenames['raw.kwd']):
+            self._kwd = open_h5(filenames['raw.kwd'],
+                                **_kwik_h5_options('raw.kwd', h5_options))
         else:
             self._kwd = None
 
+        # Finish or discard an interrupted save, and reopen the kwik file
+        # in its original mode.
+        if _JOURNAL_PATH in self._kwik.h5py_file:
+            mode = self._kwik.mode
+            self._ensure_writable()
+            _apply_journal(self._kwik)
+            if self._kwik.mode != mode:
+                self._kwik.reopen(mode)
+
+        # Open the sidecar cache, which is cleared if the file has changed.
+        if cache_dir is not None:
+            self._cache = SidecarCache(cache_dir, filename)
+        else:
+            self._cache = None
+
         # Load global information about the file.
         self._load_meta()
 
+        # Open the filtered traces if they have been computed.
+        self._kwd_filtered = None
+        self._open_filtered_traces()
+
         # List channel groups and recordings.
-        self._channel_groups = _list_channel_groups(self._kwik.h5py_file)
-        self._recordings = _list_recordings(self._kwik.h5py_file)
+        h5py_file = self._kwik.h5py_file
+        self._channel_groups = self._cached_value(
+            'channel_groups', lambda: _list_channel_groups(h5py_file))
+        self._recordings = self._cached_value(
+            'recordings', lambda: _list_recordings(h5py_file))
+
+        # External traces: {recording: traces}.
+        if traces is not None and not isinstance(traces, dict):
+            if len(self._recordings) > 1:
+                raise ValueError("The traces of the {0:d} recordings "
+                                 "should be given in a {{recording: "
+                                 "traces}} dictionary.".format(
+                                     len(self._recordings)))
+            traces = {recording: traces for recording in self._recordings}
+        self._raw_traces = traces
 
         # Choose the default channel group if not specified.
         if channel_group is None and self.channel_groups:
@@ -222,9 +669,6 @@ class KwikModel(BaseModel):
         # Load the recording.
         self.recording = recording
 
-        # Once the channel group is loaded, list the clusterings.
-        self._clusterings = _list_clusterings(self._kwik.h5py_file,
-                                              self.channel_group)
         # Choose the first clustering (should always be 'main').
         if clustering is None and self.clusterings:
             clustering = self.clusterings[0]
@@ -254,8 +698,43 @@ class KwikModel(BaseModel):
     def _clustering_path(self):
         return '{0:s}/{1:s}'.format(self._clusters_path, self._clustering)
 
-    def _load_meta(self):
-        """Load metadata from kwik file."""
+    @property
+    def _spike_clusters_cache_name(self):
+        return 'spike_clusters_{0:d}_{1:s}'.format(self._channel_group,
+                                                   self._clustering)
+
+    @property
+    def _cluster_groups_cache_name(self):
+        return 'cluster_groups_{0:d}_{1:s}'.format(self._channel_group,
+                                                   self._clustering)
+
+    def _read_array(self, path):
+        """Read a dataset from the kwik file, either in memory or lazily."""
+        if self._lazy:
+            return _lazy_array(self._kwik, path)
+        else:
+            return self._kwik.read(path)[:]
+
+    def _cached_value(self, name, load):
+        """Return a value from the sidecar cache, or call `load()` and cache
+        the result."""
+        if self._cache is None:
+            return load()
+        if name not in self._cache:
+            self._cache.save_value(name, load())
+        return self._cache.load_value(name)
+
+    def _cached_array(self, name, load):
+        """Return a memory-mapped array from the sidecar cache, or call
+        `load()` and cache the result."""
+        if self._cache is None:
+            return load()
+        if name not in self._cache:
+            self._cache.save_array(name, load())
+        return self._cache.load_array(name)
+
+    def _read_meta(self):
+        """Read metadata from kwik file."""
         metadata = {}
         # Automatically load all metadata from spikedetekt group.
         path = '/application_data/spikedetekt/'
@@ -266,7 +745,11 @@ class KwikModel(BaseModel):
                     metadata[field] = self._kwik.read_attr(path, field)
                 except TypeError:
                     debug("Unable to load metadata field {0:s}".format(field))
-        self._metadata = metadata
+        return metadata
+
+    def _load_meta(self):
+        """Load metadata from kwik file."""
+        self._metadata = self._cached_value('metadata', self._read_meta)
 
     # Channel group
     # -------------------------------------------------------------------------
@@ -281,18 +764,53 @@ class KwikModel(BaseModel):
             raise ValueError("The channel group {0} is invalid.".format(value))
         self._channel_group = value
 
+        state = self._channel_group_cache.get(value)
+        if state is None:
+            state = self._load_channel_group()
+            self._channel_group_cache.set(value, state)
+        else:
+            debug("Load channel group {0} from the cache.".format(value))
+        for name in _CHANNEL_GROUP_FIELDS:
+            setattr(self, '_' + name, state[name])
+
+        # The waveform loader of the channel group uses the current traces.
+        if self._traces is not None:
+            self._waveform_loader.traces = self._loader_traces
+
+        # Reload the spike clusters if we switch from another channel group.
+        if self._spike_clusters is not None:
+            if self._clustering not in self._clusterings:
+                self._clustering = self._clusterings[0]
+            self._clustering_changed(self._clustering)
+
+    def _load_channel_group(self):
+        """Load the data of the current channel group from the files."""
+        channel_group = self._channel_group
+        h5py_file = self._kwik.h5py_file
+
         # Load channels.
-        self._channels = _list_channels(self._kwik.h5py_file,
-                                        self._channel_group)
+        self._channels = self._cached_value(
+            'channels_{0:d}'.format(channel_group),
+            lambda: _list_channels(h5py_file, channel_group))
 
         # Load spike times.
         path = '{0:s}/time_samples'.format(self._spikes_path)
-        self._spike_times = self._kwik.read(path)[:]
+        self._spike_times = self._cached_array(
+            'spike_times_{0:d}'.format(channel_group),
+            lambda: self._read_array(path))
 
         # Load features masks.
         path = '{0:s}/features_masks'.format(self._channel_groups_path)
-
-        if self._kwx is not None:
+        if (self._kwx is not None and path not in self._kwx.h5py_file and
+                path + '_old' in self._kwx.h5py_file):
+            warn("Using the previous features of an interrupted "
+                 "recompute_features().")
+            path += '_old'
+
+        self._features = self._masks = None
+        if self._kwx is not None and self._sparse:
+            self._load_sparse_features_masks()
+        elif self._kwx is not None:
             fm = self._kwx.read(path)
             self._features = PartialArray(fm, 0)
 
@@ -303,14 +821,10 @@ class KwikModel(BaseModel):
                                        (slice(0, k * self.n_channels, k), 1))
             assert self._masks.shape == (self.n_spikes, self.n_channels)
 
-        self._cluster_metadata = ClusterMetadata()
-
-        @self._cluster_metadata.default
-        def group(cluster):
-            return 3
-
         # Load probe.
-        positions = self._load_channel_positions()
+        positions = self._cached_array(
+            'channel_positions_{0:d}'.format(channel_group),
+            self._load_channel_positions)
 
         # TODO: support multiple channel groups.
         self._probe = MEA(positions=positions,
@@ -318,6 +832,64 @@ class KwikModel(BaseModel):
 
         self._create_waveform_loader()
 
+        # List the clusterings.
+        self._clusterings = self._cached_value(
+            'clusterings_{0:d}'.format(channel_group),
+            lambda: _list_clusterings(h5py_file, channel_group))
+
+        state = Bunch({name: getattr(self, '_' + name)
+                       for name in _CHANNEL_GROUP_FIELDS})
+        # The spike clusters and cluster metadata are cached per clustering.
+        state.spike_clusters = {}
+        state.cluster_metadata = {}
+        return state
+
+    def _load_sparse_features_masks(self):
+        """Create the proxies to the sparse features and masks."""
+        path = '{0:s}/{1:s}'.format(self._channel_groups_path,
+                                    _SPARSE_FEATURES_MASKS)
+        if path not in self._kwx.h5py_file:
+            raise ValueError("There are no sparse features and masks in the "
+                             "kwx file: use convert_features_masks() "
+                             "first.")
+        k = self._metadata['nfeatures_per_channel']
+        # The last item of the sparse data is the mask. The features have
+        # the same (n_spikes, n_channels * k) shape as the dense features.
+        self._features = LazySparseCSR(self._kwx, path,
+                                       trailing_index=(slice(0, k, None),),
+                                       flatten=True)
+        self._masks = LazySparseCSR(self._kwx, path, trailing_index=(k,))
+        assert self._features.shape == (self.n_spikes, self.n_channels * k)
+        assert self._masks.shape == (self.n_spikes, self.n_channels)
+
+    def _read_cluster_groups(self):
+        """Read the {cluster: group} dictionary of the current clustering
+        from the kwik file."""
+        groups = {}
+        for cluster in self._clusters:
+            path = '{0:s}/{1:d}'.format(self._clustering_path, cluster)
+            if self._kwik.has_attr(path, 'cluster_group'):
+                groups[cluster] = int(self._kwik.read_attr(path,
+                                                           'cluster_group'))
+        return groups
+
+    def _load_cluster_metadata(self):
+        """Load the cluster groups of the current clustering from the kwik
+        file or the sidecar cache. The clusters without a group are in the
+        unsorted group."""
+        groups = self._cached_value(self._cluster_groups_cache_name,
+                                    self._read_cluster_groups)
+        # The keys of the cached dictionary are strings.
+        data = {int(cluster): {'group': int(group)}
+                for cluster, group in groups.items()}
+        cluster_metadata = ClusterMetadata(data=data)
+
+        @cluster_metadata.default
+        def group(cluster):
+            return 3
+
+        return cluster_metadata
+
     def _load_channel_positions(self):
         """Load the channel positions from the kwik file."""
         positions = []
@@ -332,19 +904,266 @@ class KwikModel(BaseModel):
         n_samples = (self._metadata['extract_s_before'],
                      self._metadata['extract_s_after'])
         order = self._metadata['filter_butter_order']
-        b_filter = bandpass_filter(rate=self._metadata['sample_rate'],
-                                   low=self._metadata['filter_low'],
-                                   high=self._metadata['filter_high'],
-                                   order=order)
 
-        def filter(x):
-            return apply_filter(x, b_filter)
+        # The waveforms are not filtered with pre-filtered traces.
+        if self._kwd_filtered is not None:
+            scale = self._kwd_filtered.read_attr('/', 'scale')
+            self._waveform_loader = WaveformLoader(n_samples=n_samples,
+                                                   channels=self._channels,
+                                                   scale_factor=.01 / scale,
+                                                   n_workers=self._n_workers,
+                                                   dtype=self._waveform_dtype)
+            return
 
         self._waveform_loader = WaveformLoader(n_samples=n_samples,
                                                channels=self._channels,
-                                               filter=filter,
+                                               filter=self._filter,
                                                filter_margin=order * 3,
-                                               scale_factor=.01)
+                                               scale_factor=.01,
+                                               n_workers=self._n_workers,
+                                               dtype=self._waveform_dtype)
+
+    @property
+    def _filter(self):
+        """The zero-phase filter of the waveforms, created once."""
+        if self._waveform_filter is None:
+            metadata = self._metadata
+            self._waveform_filter = Filter(
+                rate=metadata['sample_rate'],
+                low=metadata['filter_low'],
+                high=metadata['filter_high'],
+                order=metadata['filter_butter_order'])
+        return self._waveform_filter
+
+    def _open_filtered_traces(self):
+        """Open the filtered traces if they are complete, and if they have
+        been computed with the current filter."""
+        path = self._filenames['filtered.kwd']
+        if not op.exists(path):
+            return
+        options = _kwik_h5_options('filtered.kwd', self._h5_options)
+        f = open_h5(path, **options)
+        attrs = _filter_attrs(self._metadata)
+        attrs['complete'] = True
+        if _has_attrs(f, attrs):
+            self._kwd_filtered = f
+        else:
+            debug("Ignore the incomplete or outdated filtered traces.")
+            f.close()
+
+    def _recording_traces(self, recording):
+        """Return the raw traces of a recording."""
+        if self._raw_traces is not None:
+            return self._raw_traces.get(recording)
+        elif self._kwd is not None:
+            path = '/recordings/{0:d}/data'.format(recording)
+            return self._kwd.read(path)
+
+    @property
+    def _loader_traces(self):
+        """Traces used by the waveform loader: the filtered traces of the
+        current recording if they exist, or the raw traces."""
+        if self._kwd_filtered is not None:
+            path = '/recordings/{0:d}/data'.format(self._recording)
+            return self._kwd_filtered.read(path)
+        return self._traces
+
+    def _filtered_scale(self, chunk_size):
+        """Return the factor applied to the filtered traces before the
+        conversion to int16, estimated on chunks regularly spaced across
+        all recordings."""
+        amplitudes = []
+        for recording in self.recordings:
+            traces = self._recording_traces(recording)
+            if traces is None:
+                continue
+            if np.issubdtype(traces.dtype, np.integer):
+                return 1.
+            amplitudes.append(_filtered_amplitude(traces,
+                                                  filter=self._filter,
+                                                  chunk_size=chunk_size))
+        return _int16_scale(np.array(amplitudes))
+
+    def prefilter_traces(self, chunk_size=None, overlap=None,
+                         progress_reporter=None):
+        """Filter the traces of all recordings in a filtered.kwd file.
+
+        The traces are streamed through the filter by overlapping chunks and
+        saved as int16. The waveforms are then loaded from the filtered
+        traces without filtering. An interrupted pass is resumed where it
+        stopped the next time this method is called.
+
+        Parameters
+        ----------
+        chunk_size : int
+            Number of samples in every chunk.
+        overlap : int
+            Number of overlapping samples between successive chunks.
+        progress_reporter : ProgressReporter
+            If specified, the progress is reported on one channel per
+            recording named `recording_<n>`.
+
+        """
+        if chunk_size is None:
+            chunk_size = _FILTER_CHUNK_SIZE
+        if overlap is None:
+            overlap = _FILTER_OVERLAP
+        if self._kwd_filtered is not None:
+            self._kwd_filtered.close()
+            self._kwd_filtered = None
+
+        filter = self._filter
+        attrs = _filter_attrs(self._metadata)
+        attrs.update(chunk_size=chunk_size, overlap=overlap)
+        with open_h5(self._filenames['filtered.kwd'], 'a') as f:
+            # Restart from scratch if the parameters have changed.
+            if not _has_attrs(f, attrs):
+                f.delete('/recordings')
+                for name in ('complete', 'scale'):
+                    if f.has_attr('/', name):
+                        del f.h5py_file['/'].attrs[name]
+                for name, value in attrs.items():
+                    f.write_attr('/', name, value)
+            for recording in self.recordings:
+                traces = self._recording_traces(recording)
+                if traces is None:
+                    continue
+                n_samples = traces.shape[0]
+                path = '/recordings/{0:d}'.format(recording)
+                if path not in f.h5py_file:
+                    f.write_attr(path, 'n_samples_done', 0)
+                out = f.h5py_file[path].require_dataset('data',
+                                                        traces.shape,
+                                                        np.int16)
+                # The scaling factor to int16 is computed once.
+                if not f.has_attr('/', 'scale'):
+                    f.write_attr('/', 'scale',
+                                 self._filtered_scale(chunk_size))
+                scale = f.read_attr('/', 'scale')
+                start = f.read_attr(path, 'n_samples_done')
+                channel = 'recording_{0:d}'.format(recording)
+                if progress_reporter is not None:
+                    progress_reporter.set_max(**{channel: n_samples})
+                    progress_reporter.set(**{channel: start})
+                info("Filtering the traces of recording {0:d}.".format(
+                     recording))
+                for done in filter_traces(traces, out, filter=filter,
+                                          chunk_size=chunk_size,
+                                          overlap=overlap,
+                                          scale=scale,
+                                          start=start):
+                    f.write_attr(path, 'n_samples_done', done)
+                    f.flush()
+                    if progress_reporter is not None:
+                        progress_reporter.set(**{channel: done})
+            f.write_attr('/', 'complete', True)
+
+        # Use the filtered traces from now on.
+        self._open_filtered_traces()
+        self._channel_group_cache.clear()
+        self.channel_group = self._channel_group
+        self.recording = self._recording
+
+    def recompute_features(self, n_spikes_fit=None, batch_size=None,
+                           progress_reporter=None):
+        """Recompute the features of the current channel group from the
+        waveforms.
+
+        The principal components of the waveforms on every channel are
+        computed on a subsample of the spikes. All spikes are then
+        projected by batches, in time order, and the features_masks dataset
+        of the kwx file is replaced. The masks are kept. The sparse features
+        and masks are converted again if they exist.
+
+        The waveforms are loaded and projected with `n_workers` threads.
+        The new features are written to a temporary dataset, and the
+        previous dataset is only deleted once the new one is in place.
+
+        Parameters
+        ----------
+        n_spikes_fit : int
+            Maximum number of spikes used to compute the principal
+            components. Defaults to 10000.
+        batch_size : int
+            Number of waveforms loaded at once.
+        progress_reporter : ProgressReporter
+            If specified, the progress is reported on the `features`
+            channel.
+
+        """
+        if self._kwx is None:
+            raise ValueError("There is no kwx file.")
+        waveforms = self.waveforms
+        if waveforms is None:
+            raise ValueError("There are no traces to load the waveforms.")
+        n_spikes, n_channels = self.n_spikes, self.n_channels
+        k = self._metadata['nfeatures_per_channel']
+
+        path = '{0:s}/features_masks'.format(self._channel_groups_path)
+        tmp_path = path + '_tmp'
+        old_path = path + '_old'
+        sparse_path = '{0:s}/{1:s}'.format(self._channel_groups_path,
+                                           _SPARSE_FEATURES_MASKS)
+        mode = self._kwx.mode
+        self._kwx.reopen('a')
+        # The proxies to the datasets of the closed file are invalid.
+        self._channel_group_cache.clear()
+        self.channel_group = self._channel_group
+        masks = self._masks
+        kwx = self._kwx.h5py_file
+        kwx.require_group(self._channel_groups_path)
+        # Recover from an interrupted replacement.
+        if path not in kwx and old_path in kwx:
+            kwx.move(old_path, path)
+        for leftover in (tmp_path, old_path):
+            if leftover in kwx:
+                del kwx[leftover]
+        out = kwx.create_dataset(tmp_path, shape=(n_spikes, n_channels * k, 2),
+                                 dtype=np.float32)
+        if progress_reporter is not None:
+            progress_reporter.set_max(features=n_spikes)
+            progress_reporter.set(features=0)
+        info("Computing the features of channel group {0:d}.".format(
+             self._channel_group))
+        n_done = 0
+        for spikes, features in pca_features(waveforms, n_pcs=k,
+                                             n_spikes_fit=n_spikes_fit,
+                                             batch_size=batch_size,
+                                             n_workers=self._n_workers):
+            order = np.argsort(spikes)
+            spikes, features = spikes[order], features[order]
+            # HDF5 selections must be increasing: use slices when possible.
+            if spikes[-1] - spikes[0] + 1 == len(spikes):
+                spikes = slice(spikes[0], spikes[-1] + 1)
+            fm = np.empty((len(features), n_channels * k, 2),
+                          dtype=np.float32)
+            fm[..., 0] = features.reshape((len(features), -1))
+            if masks is None:
+                fm[..., 1] = 1.
+            else:
+                batch_masks = masks[spikes]
+                if hasattr(batch_masks, 'to_dense'):
+                    batch_masks = batch_masks.to_dense()
+                fm[..., 1] = np.repeat(batch_masks, k, axis=1)
+            out[spikes, ...] = fm
+            n_done += len(features)
+            if progress_reporter is not None:
+                progress_reporter.set(features=n_done)
+
+        # Replace the features_masks dataset. The previous dataset is moved
+        # aside first, so that it is never lost.
+        if path in kwx:
+            kwx.move(path, old_path)
+        kwx.move(tmp_path, path)
+        if old_path in kwx:
+            del kwx[old_path]
+        if sparse_path in kwx:
+            _convert_features_masks(self._kwx, self._channel_group,
+                                    n_channels, k)
+        self._kwx.reopen(mode)
+        self._channel_group_cache.clear()
+        self.channel_group = self._channel_group
+        self.recording = self._recording
 
     @property
     def channels(self):
@@ -366,13 +1185,14 @@ class KwikModel(BaseModel):
             raise ValueError("The recording {0} is invalid.".format(value))
         self._recording = value
         # Traces.
-        if self._kwd is not None:
-            path = '/recordings/{0:d}/data'.format(self._recording)
-            self._traces = self._kwd.read(path)
+        traces = self._recording_traces(value)
+        if traces is not None:
+            self._traces = traces
+        if self._traces is not None:
             # Create a new WaveformLoader if needed.
             if self._waveform_loader is None:
                 self._create_waveform_loader()
-            self._waveform_loader.traces = self._traces
+            self._waveform_loader.traces = self._loader_traces
 
     @property
     def clusterings(self):
@@ -384,10 +1204,24 @@ class KwikModel(BaseModel):
             raise ValueError("The clustering {0} is invalid.".format(value))
         self._clustering = value
         # NOTE: we are ensured here that self._channel_group is valid.
+        state = self._channel_group_cache.get(self._channel_group)
+        if state is not None and value in state.cluster_metadata:
+            self._cluster_metadata = state.cluster_metadata[value]
+        else:
+            self._cluster_metadata = self._load_cluster_metadata()
+            if state is not None:
+                state.cluster_metadata[value] = self._cluster_metadata
+        if state is not None and value in state.spike_clusters:
+            self._spike_clusters = state.spike_clusters[value]
+            return
         path = '{0:s}/clusters/{1:s}'.format(self._spikes_path,
                                              self._clustering)
-        self._spike_clusters = self._kwik.read(path)[:]
-        # TODO: cluster metadata
+        self._spike_clusters = self._cached_array(
+            self._spike_clusters_cache_name, lambda: self._read_array(path))
+        # Update the cached channel group.
+        if state is not None:
+            state.spike_clusters[value] = self._spike_clusters
+            self._channel_group_cache.set(self._channel_group, state)
 
     # Data
     # -------------------------------------------------------------------------
@@ -436,9 +1270,36 @@ class KwikModel(BaseModel):
 
     @property
     def waveforms(self):
-        """Waveforms from the current channel_group (may be memory-mapped)."""
+        """Waveforms from the current channel_group (may be memory-mapped),
+        or None if there are no traces."""
+        if self._waveform_loader.traces is None:
+            return None
         return SpikeLoader(self._waveform_loader, self.spike_times)
 
+    @property
+    def waveform_scale_factor(self):
+        """Scale factor to apply to the int16 or float16 waveforms, or None
+        if the waveforms are already scaled."""
+        return self._waveform_loader.scale_factor
+
+    @property
+    def waveform_params(self):
+        """A dictionary with the parameters which determine the waveforms
+        of the current channel group: data type, scale factor, traces and
+        filter."""
+        params = _filter_attrs(self._metadata)
+        params.update(channel_group=self._channel_group,
+                      recording=self._recording,
+                      dtype=self._waveform_loader.dtype.str,
+                      scale_factor=self.waveform_scale_factor,
+                      traces=('external' if self._raw_traces is not None
+                              else 'raw.kwd'))
+        # The waveforms of the pre-filtered traces depend on their scaling.
+        if self._kwd_filtered is not None:
+            params['filtered_scale'] = self._kwd_filtered.read_attr('/',
+                                                                    'scale')
+        return params
+
     @property
     def spike_clusters(self):
         """Spike clusters from the current channel_group."""
@@ -450,14 +1311,95 @@ class KwikModel(BaseModel):
         # TODO
         return self._cluster_metadata
 
-    def save(self):
-        """Commits all in-memory changes to disk."""
-        raise NotImplementedError()
+    def _ensure_writable(self):
+        """Reopen the kwik file in read-write mode if needed."""
+        if self._kwik.mode != 'r':
+            return
+        self._kwik.reopen('r+')
+        # The proxies to the datasets of the closed file are invalid.
+        # The cluster metadata in memory is kept, as it may have changed.
+        if self._lazy and self._channel_group is not None:
+            cluster_metadata = self._cluster_metadata
+            self._channel_group_cache.clear()
+            self._channel_group_changed(self._channel_group)
+            self._cluster_metadata = cluster_metadata
+            state = self._channel_group_cache.get(self._channel_group)
+            if state is not None:
+                state.cluster_metadata[self._clustering] = cluster_metadata
+
+    def save(self, spike_clusters=None, spikes=None, cluster_groups=None):
+        """Save the clustering of the current channel group to the kwik file.
+
+        Only the changes are written: they are first written to a journal
+        in the kwik file, which is committed with an atomic marker and then
+        applied. If the process is interrupted, the changes are either
+        applied completely or discarded the next time the file is opened.
+
+        Parameters
+        ----------
+        spike_clusters : array-like
+            The spike-cluster assignements to save. By default, this is the
+            current `spike_clusters` array of the model.
+        spikes : array-like
+            The spikes that have changed since the last save. If None, the
+            changed spikes are found by comparing the spike clusters with
+            the ones in the file.
+        cluster_groups : dict
+            A `{cluster: group}` dictionary with the groups of the new or
+            changed clusters. A None group deletes the cluster.
+
+        """
+        if spike_clusters is None:
+            spike_clusters = self._spike_clusters
+        spike_clusters = _as_array(spike_clusters)
+        if cluster_groups is None:
+            cluster_groups = {}
+        path = '{0:s}/clusters/{1:s}'.format(self._spikes_path,
+                                             self._clustering)
+        if spikes is None:
+            old_spike_clusters = self._kwik.read(path)[:]
+            spikes = np.nonzero(old_spike_clusters != spike_clusters)[0]
+        else:
+            spikes = np.unique(_as_array(spikes)).astype(np.int64)
+        self._ensure_writable()
+        info("Saving {0:d} spikes and {1:d} clusters.".format(
+             len(spikes), len(cluster_groups)))
+        _write_journal(self._kwik, self._channel_group, self._clustering,
+                       spikes, spike_clusters[spikes], cluster_groups)
+        _apply_journal(self._kwik)
+        # Update the spike clusters in memory.
+        if (self._spike_clusters is not spike_clusters and
+                isinstance(self._spike_clusters, np.ndarray) and
+                self._spike_clusters.flags.writeable):
+            self._spike_clusters[spikes] = spike_clusters[spikes]
+        # Update the sidecar cache so that it remains valid. Only the
+        # changed spikes are written, and the memory-mapped spike clusters
+        # see the new values.
+        if self._cache is not None:
+            self._kwik.flush()
+            name = self._spike_clusters_cache_name
+            if name in self._cache:
+                self._cache.update_array(name, spikes, spike_clusters[spikes])
+            name = self._cluster_groups_cache_name
+            if name in self._cache:
+                groups = self._cache.load_value(name)
+                for cluster, group in cluster_groups.items():
+                    if group is None:
+                        groups.pop(str(cluster), None)
+                    else:
+                        groups[str(cluster)] = int(group)
+                self._cache.save_value(name, groups)
+            self._cache.update_source()
 
     def close(self):
         """Close all opened files."""
+        self._channel_group_cache.clear()
+        if self._waveform_loader is not None:
+            self._waveform_loader.close()
         if self._kwx is not None:
             self._kwx.close()
         if self._kwd is not None:
             self._kwd.close()
+        if self._kwd_filtered is not None:
+            self._kwd_filtered.close()
         self._kwik.close()
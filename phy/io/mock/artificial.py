@@ -61,7 +61,7 @@ class MockModel(BaseModel):
     n_clusters = 10
 
     def __init__(self):
-        super(BaseModel, self).__init__()
+        super(MockModel, self).__init__()
         self.name = 'mock'
         self._metadata = {'description': 'A mock model.'}
         self._cluster_metadata = ClusterMetadata()
@@ -108,7 +108,7 @@ def create_mock_kwik(dir_path, n_clusters=None, n_spikes=None,
         with open_h5(kwd_filename, 'w') as f:
             f.write_attr('/', 'kwik_version', 2)
             traces = artificial_traces(n_samples_traces, n_channels)
-            # TODO: int16 traces
-            f.write('/recordings/0/data', traces.astype(np.float32))
+            traces = (traces * 1000).astype(np.int16)
+            f.write('/recordings/0/data', traces)
 
     return filename
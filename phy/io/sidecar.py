@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""Sidecar cache of NumPy arrays for fast reopening of data files."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import json
+import os
+import os.path as op
+
+import numpy as np
+
+from ..utils.logging import debug
+
+
+#------------------------------------------------------------------------------
+# Utility functions
+#------------------------------------------------------------------------------
+
+_MANIFEST = 'manifest.json'
+
+# os.replace() is atomic on all platforms but only exists in Python 3.
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _file_signature(filename):
+    """Return the real path, size and modification time of a file."""
+    stat = os.stat(filename)
+    return {'path': op.realpath(filename),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime}
+
+
+def _to_json(value):
+    """Convert NumPy values and bytes to JSON-serializable objects."""
+    if isinstance(value, (np.ndarray, np.generic)):
+        value = value.tolist()
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _to_json(item) for key, item in value.items()}
+    return value
+
+
+#------------------------------------------------------------------------------
+# Sidecar cache
+#------------------------------------------------------------------------------
+
+class SidecarCache(object):
+    """Cache of arrays and JSON values associated to a source file.
+
+    The arrays are saved in .npy files, and the values in a JSON manifest,
+    in a directory next to the source file. The cache is cleared when the
+    size or the modification time of the source file changes, or when the
+    directory is used with another source file. The arrays are loaded as
+    read-only memory-mapped arrays.
+
+    Parameters
+    ----------
+
+    directory : str
+        Path to the cache directory, created if needed.
+    source : str
+        Path to the source file.
+
+    """
+    def __init__(self, directory, source):
+        self._directory = op.realpath(directory)
+        self._source = op.realpath(source)
+        if not op.exists(self._directory):
+            os.makedirs(self._directory)
+        self._manifest = self._load_manifest()
+        if not self.is_valid():
+            debug("Clearing the outdated cache {0:s}.".format(directory))
+            self.clear()
+
+    # Internal methods
+    # -------------------------------------------------------------------------
+
+    @property
+    def _manifest_path(self):
+        return op.join(self._directory, _MANIFEST)
+
+    def _array_path(self, name):
+        return op.join(self._directory, '{0:s}.npy'.format(name))
+
+    def _load_manifest(self):
+        if not op.exists(self._manifest_path):
+            return None
+        try:
+            with open(self._manifest_path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def _save_manifest(self):
+        # The manifest is written atomically.
+        path = self._manifest_path + '.tmp'
+        with open(path, 'w') as f:
+            json.dump(self._manifest, f)
+        _replace(path, self._manifest_path)
+
+    # Public methods
+    # -------------------------------------------------------------------------
+
+    def is_valid(self):
+        """Whether the cache corresponds to the current source file."""
+        return (self._manifest is not None and
+                self._manifest.get('source') ==
+                _file_signature(self._source))
+
+    def clear(self):
+        """Delete all cached data."""
+        for name in (self._manifest or {}).get('arrays', []):
+            path = self._array_path(name)
+            if op.exists(path):
+                os.remove(path)
+        self._manifest = {'source': _file_signature(self._source),
+                          'arrays': [],
+                          'values': {}}
+        self._save_manifest()
+
+    def update_source(self):
+        """Mark the cache as valid for the current source file.
+
+        This must be called after the source file has been modified and the
+        cached data has been updated accordingly.
+
+        """
+        self._manifest['source'] = _file_signature(self._source)
+        self._save_manifest()
+
+    def load_array(self, name):
+        """Load a cached array as a memory-mapped array, or return None."""
+        if name not in self._manifest['arrays']:
+            return None
+        return np.load(self._array_path(name), mmap_mode='r')
+
+    def save_array(self, name, arr):
+        """Save an array in the cache."""
+        path = self._array_path(name)
+        # Write to a temporary file first, so that memory-mapped arrays of a
+        # previous version remain valid.
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, np.asarray(arr))
+        _replace(path + '.tmp', path)
+        if name not in self._manifest['arrays']:
+            self._manifest['arrays'].append(name)
+        self._save_manifest()
+
+    def update_array(self, name, indices, values):
+        """Write some items of a cached array in place.
+
+        Only the modified items are written, and the memory-mapped arrays
+        returned by `load_array()` see the new values.
+
+        """
+        arr = np.load(self._array_path(name), mmap_mode='r+')
+        arr[indices] = values
+        arr.flush()
+        del arr
+
+    def load_value(self, name, default=None):
+        """Load a cached JSON value."""
+        return self._manifest['values'].get(name, default)
+
+    def save_value(self, name, value):
+        """Save a value in the cache. NumPy values are converted to
+        standard Python types."""
+        self._manifest['values'][name] = _to_json(value)
+        self._save_manifest()
+
+    def __contains__(self, name):
+        return (name in self._manifest['arrays'] or
+                name in self._manifest['values'])
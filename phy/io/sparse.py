@@ -9,7 +9,7 @@
 import numpy as np
 
 from ..ext import six
-from ..utils.array import _as_array
+from ..utils.array import _as_array, _fancy_read
 
 
 #------------------------------------------------------------------------------
@@ -17,9 +17,27 @@ from ..utils.array import _as_array
 #------------------------------------------------------------------------------
 
 def _csr_from_dense(dense):
-    """Create a CSR structure from a dense NumPy array."""
-    raise NotImplementedError(("Creating CSR from dense matrix is not "
-                               "implemented yet."))
+    """Create a CSR structure from a dense NumPy array.
+
+    The array has a shape (n_spikes, n_channels, ...). An item is stored
+    if any of its values along the trailing dimensions is non-zero.
+
+    """
+    if dense.ndim < 2:
+        raise ValueError("The dense array should have at least two "
+                         "dimensions.")
+    nonzero = dense != 0
+    if dense.ndim > 2:
+        nonzero = nonzero.reshape(dense.shape[:2] + (-1,)).any(axis=2)
+    # np.nonzero() returns the indices in row-major order, so that the
+    # items are sorted by spike, then by channel.
+    spikes, channels = np.nonzero(nonzero)
+    spikes_ptr = np.zeros(dense.shape[0] + 1, dtype=np.int64)
+    np.cumsum(nonzero.sum(axis=1), out=spikes_ptr[1:])
+    return SparseCSR(shape=dense.shape,
+                     data=dense[spikes, channels],
+                     channels=channels,
+                     spikes_ptr=spikes_ptr)
 
 
 def _check_sparse_components(shape=None, data=None,
@@ -36,16 +54,15 @@ def _check_sparse_components(shape=None, data=None,
         raise ValueError("'channels' should be a 1D array.")
     if spikes_ptr.ndim != 1:
         raise ValueError("'spikes_ptr' should be a 1D array.")
-    nitems = data.shape[-1]
-    if nitems > np.prod(shape):
+    nitems = data.shape[0]
+    if nitems > shape[0] * shape[1]:
         raise ValueError("'data' is too large (n={0:d}) ".format(nitems) +
                          " for the specified shape "
                          "{shape}.".format(shape=shape))
-    if len(channels) != (shape[1]):
-        raise ValueError(("'channels' should have "
-                          "{nexp} elements, "
-                          "not {nact}.").format(nexp=(shape[1]),
-                                                nact=len(channels)))
+    if tuple(data.shape[1:]) != tuple(shape[2:]):
+        raise ValueError("The trailing dimensions of 'data' {0} ".format(
+                         data.shape[1:]) + "should be "
+                         "{0}.".format(tuple(shape[2:])))
     if len(spikes_ptr) != (shape[0] + 1):
         raise ValueError(("'spikes_ptr' should have "
                           "{nexp} elements, "
@@ -58,6 +75,71 @@ def _check_sparse_components(shape=None, data=None,
     return True
 
 
+def _concatenate_ranges(starts, stops):
+    """Return the concatenation of the integer ranges [start, stop[."""
+    starts = _as_array(starts).astype(np.int64)
+    lengths = _as_array(stops).astype(np.int64) - starts
+    n = lengths.sum()
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Position of the first item of every range in the output array.
+    offsets = np.cumsum(lengths) - lengths
+    # Every output item is its range start, plus its position in the range.
+    out = np.repeat(starts - offsets, lengths)
+    out += np.arange(n)
+    return out
+
+
+def _spike_ranges(spikes_ptr, spikes):
+    """Return the indices of the stored items of some spikes, and the
+    spikes_ptr array of the selection."""
+    starts = spikes_ptr[spikes]
+    stops = spikes_ptr[spikes + 1]
+    indices = _concatenate_ranges(starts, stops)
+    out_ptr = np.zeros(len(spikes) + 1, dtype=np.int64)
+    np.cumsum(stops - starts, out=out_ptr[1:])
+    return indices, out_ptr
+
+
+def _flatten_trailing(csr):
+    """Flatten the trailing dimensions of a SparseCSR array with its
+    channel dimension.
+
+    Every item of the trailing dimensions of a channel becomes a column of
+    a (n_spikes, n_channels * n_trailing) array.
+
+    """
+    n_spikes, n_channels = csr.shape[:2]
+    k = int(np.prod(csr.shape[2:]))
+    data = csr._data.reshape((len(csr._data), k)).ravel()
+    channels = (csr._channels[:, np.newaxis] * k + np.arange(k)).ravel()
+    return SparseCSR(shape=(n_spikes, n_channels * k),
+                     data=data,
+                     channels=channels,
+                     spikes_ptr=csr._spikes_ptr * k)
+
+
+def _spike_indices(item, n_spikes):
+    """Return the array of spikes selected by an index.
+
+    Negative indices count from the end, as with NumPy arrays.
+
+    """
+    if isinstance(item, slice):
+        return np.arange(*item.indices(n_spikes))
+    spikes = np.atleast_1d(_as_array(item))
+    if spikes.dtype == bool:
+        spikes = np.nonzero(spikes)[0]
+    if spikes.ndim != 1:
+        raise ValueError("Only 1D spike selections are supported.")
+    spikes = spikes.astype(np.int64)
+    invalid = (spikes < -n_spikes) | (spikes >= n_spikes)
+    if np.any(invalid):
+        raise IndexError("Index {0:d} is out of bounds for {1:d} "
+                         "spikes.".format(spikes[invalid][0], n_spikes))
+    return spikes % n_spikes if n_spikes else spikes
+
+
 class SparseCSR(object):
     """Sparse CSR matrix data structure."""
     def __init__(self, shape=None, data=None, channels=None, spikes_ptr=None):
@@ -70,7 +152,7 @@ class SparseCSR(object):
                                         data=data,
                                         channels=channels,
                                         spikes_ptr=spikes_ptr)
-        nitems = data.shape[-1]
+        nitems = data.shape[0]
         # Structure info.
         self._nitems = nitems
         # Create the structure.
@@ -84,10 +166,82 @@ class SparseCSR(object):
         """Shape of the array."""
         return self._shape
 
+    @property
+    def dtype(self):
+        """Data type of the array."""
+        return self._data.dtype
+
+    def __len__(self):
+        return self._shape[0]
+
     def __eq__(self, other):
-        return np.all((self._data == other._data) &
-                      (self._channels == other._channels) &
-                      (self._spikes_ptr == other._spikes_ptr))
+        return (tuple(self._shape) == tuple(other._shape) and
+                np.array_equal(self._data, other._data) and
+                np.array_equal(self._channels, other._channels) and
+                np.array_equal(self._spikes_ptr, other._spikes_ptr))
+
+    # Selection methods
+    # -------------------------------------------------------------------------
+
+    def __getitem__(self, item):
+        """Select some spikes with an index array or a slice.
+
+        Return a SparseCSR array with the selected rows.
+
+        """
+        spikes = _spike_indices(item, self._shape[0])
+        indices, spikes_ptr = _spike_ranges(self._spikes_ptr, spikes)
+        return SparseCSR(shape=(len(spikes),) + tuple(self._shape[1:]),
+                         data=self._data[indices],
+                         channels=self._channels[indices],
+                         spikes_ptr=spikes_ptr)
+
+    def _spikes(self):
+        """Return the spike index of every stored item."""
+        return np.repeat(np.arange(self._shape[0]),
+                         np.diff(self._spikes_ptr))
+
+    def to_dense(self):
+        """Return the dense NumPy array."""
+        out = np.zeros(self._shape, dtype=self._data.dtype)
+        out[self._spikes(), self._channels] = self._data
+        return out
+
+    # Reductions
+    # -------------------------------------------------------------------------
+
+    def _check_axis(self, axis):
+        if axis != 0:
+            raise NotImplementedError("Only reductions along the spike "
+                                      "axis are implemented currently.")
+
+    def sum(self, axis=0):
+        """Sum of the array along the spike axis.
+
+        Return a dense array with shape (n_channels, ...).
+
+        """
+        self._check_axis(axis)
+        n_channels = self._shape[1]
+        data = self._data.reshape((len(self._data), -1))
+        out = np.empty((n_channels, data.shape[1]))
+        for i in range(data.shape[1]):
+            out[:, i] = np.bincount(self._channels, weights=data[:, i],
+                                    minlength=n_channels)
+        return out.reshape(tuple(self._shape[1:]))
+
+    def mean(self, axis=0):
+        """Mean of the array along the spike axis.
+
+        Masked items count as zeros. Return a dense array with shape
+        (n_channels, ...).
+
+        """
+        self._check_axis(axis)
+        n_spikes = self._shape[0]
+        if n_spikes == 0:
+            return np.zeros(tuple(self._shape[1:]))
+        return self.sum(axis=axis) / float(n_spikes)
 
     # I/O methods
     # -------------------------------------------------------------------------
@@ -101,8 +255,15 @@ class SparseCSR(object):
         f.write(path + '/spikes_ptr', self._spikes_ptr)
 
     @staticmethod
-    def load_h5(f, path):
-        """Load a SparseCSR array from an HDF5 file."""
+    def load_h5(f, path, lazy=False):
+        """Load a SparseCSR array from an HDF5 file.
+
+        If lazy is True, return a LazySparseCSR view: the file needs to
+        stay open while the view is used.
+
+        """
+        if lazy:
+            return LazySparseCSR(f, path)
         f.read_attr(path, 'sparse_type') == 'csr'
         shape = f.read_attr(path, 'shape')
         data = f.read(path + '/data')[...]
@@ -114,6 +275,74 @@ class SparseCSR(object):
                          spikes_ptr=spikes_ptr)
 
 
+class LazySparseCSR(object):
+    """View of a SparseCSR array stored in an HDF5 file.
+
+    The spikes_ptr array is loaded in memory, but the data and channels
+    of the spikes are only read when they are selected. Selections return
+    SparseCSR arrays.
+
+    Parameters
+    ----------
+
+    f : File
+        The open HDF5 file.
+    path : str
+        Path to the sparse array in the file.
+    trailing_index : tuple
+        Optional selection of the trailing dimensions of the data.
+    flatten : bool
+        If True, the selected trailing dimensions are flattened with the
+        channel dimension, so that the array has a 2D shape
+        (n_spikes, n_channels * n_trailing) like the dense features.
+
+    """
+    def __init__(self, f, path, trailing_index=(), flatten=False):
+        if f.read_attr(path, 'sparse_type') != 'csr':
+            raise ValueError("{0:s} is not a SparseCSR array.".format(path))
+        self._data = f.read(path + '/data')
+        self._channels = f.read(path + '/channels')
+        self._spikes_ptr = f.read(path + '/spikes_ptr')[...]
+        self._trailing_index = tuple(trailing_index)
+        shape = tuple(int(n) for n in f.read_attr(path, 'shape'))
+        trailing_shape = np.empty(shape[2:])[self._trailing_index].shape
+        self._shape = shape[:2] + trailing_shape
+        self._flatten = flatten
+
+    @property
+    def shape(self):
+        """Shape of the array."""
+        if self._flatten:
+            return self._shape[:1] + (int(np.prod(self._shape[1:])),)
+        return self._shape
+
+    @property
+    def dtype(self):
+        """Data type of the array."""
+        return self._data.dtype
+
+    def __len__(self):
+        return self._shape[0]
+
+    def __getitem__(self, item):
+        """Select some spikes with an index array or a slice, and return
+        a SparseCSR array."""
+        spikes = _spike_indices(item, self._shape[0])
+        indices, spikes_ptr = _spike_ranges(self._spikes_ptr, spikes)
+        # The ranges are read with as few HDF5 requests as possible.
+        data = _fancy_read(self._data, indices, self._trailing_index)
+        channels = _fancy_read(self._channels, indices)
+        out = SparseCSR(shape=(len(spikes),) + self._shape[1:],
+                        data=data,
+                        channels=channels,
+                        spikes_ptr=spikes_ptr)
+        return _flatten_trailing(out) if self._flatten else out
+
+    def load(self):
+        """Load the whole array in memory."""
+        return self[:]
+
+
 def csr_matrix(dense=None, shape=None,
                data=None, channels=None, spikes_ptr=None):
     """Create a CSR matrix from a dense matrix, or from sparse data."""
@@ -138,12 +367,18 @@ def save_h5(f, path, arr, overwrite=False):
                          "dense NumPy array.")
 
 
-def load_h5(f, path):
-    """Load a sparse array from an HDF5 file."""
+def load_h5(f, path, lazy=False):
+    """Load a sparse array from an HDF5 file.
+
+    If lazy is True, sparse arrays are returned as LazySparseCSR views, and
+    the file needs to stay open while they are used. Dense arrays are
+    always loaded in memory.
+
+    """
     # Sparse array.
     if f.has_attr(path, 'sparse_type'):
         if f.read_attr(path, 'sparse_type') == 'csr':
-            return SparseCSR.load_h5(f, path)
+            return SparseCSR.load_h5(f, path, lazy=lazy)
         else:
             raise NotImplementedError("Only SparseCSR arrays are implemented "
                                       "currently.")
@@ -124,6 +124,46 @@ def test_h5_read():
         assert not f.is_open()
 
 
+def test_h5_mmap():
+    with TemporaryDirectory() as tempdir:
+        filename = op.join(tempdir, '_test.h5')
+        arr = np.random.rand(100, 3)
+        with open_h5(filename, 'w') as f:
+            f.write('/contiguous', arr)
+            f.h5py_file.create_dataset('/chunked', data=arr, chunks=(10, 3))
+            f.h5py_file.create_dataset('/empty', (0,), dtype=np.int64)
+
+        with open_h5(filename) as f:
+            mm = f.mmap('/contiguous')
+            assert isinstance(mm, np.memmap)
+            ae(mm, arr)
+            with raises(ValueError):
+                mm[0, 0] = 0.
+
+            assert f.mmap('/chunked') is None
+            assert f.mmap('/empty') is None
+
+
+def test_h5_options():
+    with TemporaryDirectory() as tempdir:
+        filename = _create_test_file(tempdir)
+
+        with raises(ValueError):
+            open_h5(filename, unknown_option=1)
+
+        with open_h5(filename, rdcc_nbytes=2 ** 24, rdcc_nslots=1009,
+                     rdcc_w0=0., driver='core') as f:
+            assert f.h5py_file.driver == 'core'
+            cache = f.h5py_file.id.get_access_plist().get_cache()
+            assert cache[1:] == (1009, 2 ** 24, 0.)
+            assert f.read('/ds1').shape == (10,)
+
+        # Unspecified options are not passed to h5py.
+        f = open_h5(filename, rdcc_nbytes=None)
+        assert f.options == {}
+        f.close()
+
+
 def test_h5_write():
     with TemporaryDirectory() as tempdir:
         # Create the test HDF5 file in the temporary directory.
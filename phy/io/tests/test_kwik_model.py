@@ -25,8 +25,14 @@ from ...utils.tempdir import TemporaryDirectory
 from ..h5 import open_h5
 from ..kwik_model import (KwikModel, _list_channel_groups, _list_channels,
                           _list_recordings,
-                          _list_clusterings, _kwik_filenames)
+                          _list_clusterings, _kwik_filenames,
+                          _LRUCache, _kwik_h5_options,
+                          _write_journal, _JOURNAL_PATH,
+                          convert_features_masks)
 from ..mock.kwik import create_mock_kwik
+from ..traces import read_dat
+from ...utils.event import ProgressReporter
+from ...waveform.filter import bandpass_filter, apply_filter
 
 
 #------------------------------------------------------------------------------
@@ -116,10 +122,635 @@ def test_kwik_open():
         assert kwik.probe.positions.shape == (_N_CHANNELS, 2)
         ae(kwik.probe.positions, staggered_positions(_N_CHANNELS))
 
-        # Not implemented yet.
-        with raises(NotImplementedError):
-            kwik.save()
+        kwik.close()
+
+
+def test_kwik_lazy():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+
+        kwik = KwikModel(filename)
+        spike_times = kwik.spike_times
+        spike_clusters = kwik.spike_clusters
+        kwik.close()
+
+        # Contiguous datasets are memory-mapped.
+        kwik = KwikModel(filename, lazy=True)
+        assert isinstance(kwik.spike_times, np.memmap)
+        assert isinstance(kwik.spike_clusters, np.memmap)
+        assert kwik.n_spikes == _N_SPIKES
+        ae(kwik.spike_times, spike_times)
+        ae(kwik.spike_clusters, spike_clusters)
+        kwik.close()
+
+        # Rewrite the spike times as a chunked dataset.
+        path = '/channel_groups/1/spikes/time_samples'
+        with open_h5(filename, 'a') as f:
+            del f.h5py_file[path]
+            f.h5py_file.create_dataset(path, data=spike_times, chunks=(8,))
+
+        kwik = KwikModel(filename, lazy=True)
+        assert not isinstance(kwik.spike_times, np.ndarray)
+        assert kwik.n_spikes == _N_SPIKES
+        ae(kwik.spike_times[[10, 2, 2]], spike_times[[10, 2, 2]])
+        ae(kwik.spike_times[5:7], spike_times[5:7])
+        assert kwik.waveforms[[20, 10]].shape == (2, 40, _N_CHANNELS)
+        kwik.close()
+
+
+def test_kwik_n_workers():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+
+        kwik = KwikModel(filename)
+        waveforms = kwik.waveforms[:]
+        kwik.close()
+
+        # Load the waveforms with several threads.
+        kwik = KwikModel(filename, n_workers=2)
+        ae(kwik.waveforms[:], waveforms)
+        loader = kwik._waveform_loader
+        assert loader._pool is not None
+        kwik.close()
+        # The worker threads are shut down.
+        assert loader._thread_pool is None
+
+
+def test_kwik_iter_batches():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+
+        kwik = KwikModel(filename)
+
+        # Slices of spike ids.
+        expected = kwik.waveforms[::2]
+        ae(expected, kwik.waveforms[np.arange(0, _N_SPIKES, 2)])
+
+        # Batches of spikes in time order.
+        out = np.zeros_like(expected)
+        batches = kwik.waveforms.iter_batches(slice(None, None, 2),
+                                              batch_size=8)
+        for indices, batch in batches:
+            out[indices] = batch
+        ae(out, expected)
+        kwik.close()
+
+
+def test_kwik_waveform_int16():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+
+        kwik = KwikModel(filename)
+        waveforms = kwik.waveforms[:]
+        assert kwik.waveform_scale_factor is None
+        kwik.close()
+
+        # Unscaled int16 waveforms.
+        kwik = KwikModel(filename, waveform_dtype=np.int16)
+        waveforms_int16 = kwik.waveforms[:]
+        assert waveforms_int16.dtype == np.int16
+        assert kwik.waveform_scale_factor == .01
+        assert np.allclose(waveforms_int16 * kwik.waveform_scale_factor,
+                           waveforms, atol=.01)
+        kwik.close()
+
+
+def test_kwik_sparse():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+
+        # The sparse structure needs to be created first.
+        with raises(ValueError):
+            KwikModel(filename, sparse=True)
+
+        kwik = KwikModel(filename)
+        features = kwik.features[:, :].reshape((_N_SPIKES, _N_CHANNELS,
+                                                _N_FETS))
+        masks = kwik.masks[:]
+        kwik.close()
+
+        # Mask some channels.
+        masks[masks < .5] = 0
+        path = '/channel_groups/1/features_masks'
+        with open_h5(_kwik_filenames(filename)['kwx'], 'a') as f:
+            fm = f.read(path)
+            fm[:, ::_N_FETS, 1] = masks
+        convert_features_masks(filename, chunk_size=7)
+
+        kwik = KwikModel(filename, sparse=True)
+        # The shapes are the same as with the dense features and masks.
+        assert kwik.features.shape == (_N_SPIKES, _N_CHANNELS * _N_FETS)
+        assert kwik.masks.shape == (_N_SPIKES, _N_CHANNELS)
+
+        spikes = [10, 2, 3, 3, 49]
+        sparse_features = kwik.features[spikes]
+        sparse_masks = kwik.masks[spikes]
+        assert sparse_features.shape == (5, _N_CHANNELS * _N_FETS)
+        assert sparse_masks.shape == (5, _N_CHANNELS)
+        assert len(sparse_masks._data) == (masks[spikes] > 0).sum()
+
+        # Compare with the dense arrays.
+        ae(sparse_masks.to_dense(), masks[spikes])
+        dense_features = sparse_features.to_dense().reshape((5, _N_CHANNELS,
+                                                             _N_FETS))
+        unmasked = masks[spikes] > 0
+        ae(dense_features[unmasked], features[spikes][unmasked])
+        ae(dense_features[~unmasked], 0)
+
+        # Slices.
+        assert kwik.masks[5:10].shape == (5, _N_CHANNELS)
+        assert kwik.masks[[]].shape == (0, _N_CHANNELS)
+        kwik.close()
+
+
+def test_kwik_recompute_features():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+        convert_features_masks(filename)
+
+        kwik = KwikModel(filename)
+        masks = kwik.masks[:]
+        waveforms = kwik.waveforms[:]
+
+        reports = []
+        pr = ProgressReporter()
+
+        @pr.connect
+        def on_report(value, value_max):
+            reports.append(value)
+
+        kwik.recompute_features(batch_size=8, progress_reporter=pr)
+        assert reports[-1] == _N_SPIKES
+
+        # The features are the projections of the waveforms on the
+        # principal components of every channel.
+        features = kwik.features[:, :].reshape((_N_SPIKES, _N_CHANNELS,
+                                                _N_FETS))
+        for channel in (0, 5):
+            w = waveforms[:, :, channel]
+            w = w - w.mean(axis=0)
+            _, _, v = np.linalg.svd(w, full_matrices=False)
+            f = features[:, channel, :] - features[:, channel, :].mean(axis=0)
+            proj = np.dot(w, v[:_N_FETS].T)
+            assert np.allclose(np.abs(f), np.abs(proj), atol=1e-3)
+        # The masks are kept.
+        ae(kwik.masks[:], masks)
+        kwik.close()
+
+        # The new features are saved, and the sparse structure is updated.
+        kwik = KwikModel(filename)
+        ae(kwik.features[:, :], features.reshape((_N_SPIKES, -1)))
+        kwik.close()
+        kwik = KwikModel(filename, sparse=True)
+        unmasked = masks > 0
+        sparse_features = kwik.features[:].to_dense().reshape(
+            (_N_SPIKES, _N_CHANNELS, _N_FETS))
+        assert np.allclose(sparse_features[unmasked], features[unmasked])
+        kwik.close()
+
+        # Interrupted replacement of the features.
+        path = '/channel_groups/1/features_masks'
+        with open_h5(_kwik_filenames(filename)['kwx'], 'a') as f:
+            f.h5py_file.move(path, path + '_old')
+            f.write(path + '_tmp', np.zeros(3))
+        kwik = KwikModel(filename)
+        ae(kwik.features[:, :], features.reshape((_N_SPIKES, -1)))
+        kwik.recompute_features()
+        assert np.allclose(np.abs(kwik.features[:, :]),
+                           np.abs(features.reshape((_N_SPIKES, -1))),
+                           atol=1e-3)
+        kwik.close()
+        with open_h5(_kwik_filenames(filename)['kwx'], 'r') as f:
+            assert f.datasets('/channel_groups/1') == ['features_masks']
+
+
+def test_kwik_dat_traces():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+
+        kwik = KwikModel(filename)
+        traces = kwik.traces[...]
+        waveforms = kwik.waveforms[[3, 10]]
+        kwik.close()
+
+        # Write the traces in a raw binary file.
+        path = op.join(tempdir, 'test.dat')
+        traces.tofile(path)
+        dat = read_dat(path, dtype=traces.dtype,
+                       n_channels=traces.shape[1])
+
+        kwik = KwikModel(filename, traces=dat)
+        assert kwik._kwd is None
+        assert kwik.traces is dat
+        assert kwik._waveform_loader.traces is dat
+        ae(kwik.waveforms[[3, 10]], waveforms)
+        kwik.close()
+
+        # The traces of every recording.
+        kwik = KwikModel(filename, traces={0: dat})
+        assert kwik.traces is dat
+        kwik.close()
+
+        # With several recordings, a single array is ambiguous.
+        with open_h5(filename, 'a') as f:
+            f.write_attr('/recordings/1', 'name', 'recording_1')
+        with raises(ValueError):
+            KwikModel(filename, traces=dat)
+        kwik = KwikModel(filename, traces={0: dat, 1: dat[:100]})
+        kwik.recording = 1
+        assert kwik.traces.shape == (100, traces.shape[1])
+        kwik.close()
+        del dat
+
+
+def test_kwik_sidecar_cache():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+        cache_dir = op.join(tempdir, 'cache')
+
+        kwik = KwikModel(filename)
+        spike_times = kwik.spike_times
+        spike_clusters = kwik.spike_clusters
+        positions = kwik.probe.positions
+        metadata = kwik.metadata
+        kwik.close()
+
+        def _check(kwik):
+            assert isinstance(kwik.spike_times, np.memmap)
+            assert isinstance(kwik.spike_clusters, np.memmap)
+            ae(kwik.spike_times, spike_times)
+            ae(kwik.spike_clusters, spike_clusters)
+            ae(kwik.probe.positions, positions)
+            assert kwik.metadata['sample_rate'] == metadata['sample_rate']
+            assert kwik.channel_groups == [1]
+            assert kwik.clusterings == ['main']
+
+        # Create the cache.
+        kwik = KwikModel(filename, cache_dir=cache_dir)
+        _check(kwik)
+        kwik.close()
+        assert op.exists(op.join(cache_dir, 'spike_times_1.npy'))
+
+        # Reopen from the cache.
+        kwik = KwikModel(filename, cache_dir=cache_dir)
+        assert 'spike_times_1' in kwik._cache
+        _check(kwik)
+
+        assert 'cluster_groups_1_main' in kwik._cache
+
+        # Saving updates the cache in place.
+        path = op.join(cache_dir, 'spike_clusters_1_main.npy')
+        inode = os.stat(path).st_ino
+        spike_clusters = spike_clusters.copy()
+        spike_clusters[[1, 3]] = 100
+        kwik.save(spike_clusters, cluster_groups={100: 2})
+        assert os.stat(path).st_ino == inode
+        ae(kwik.spike_clusters[[1, 3]], [100, 100])
+        kwik.clustering = 'main'
+        ae(kwik.spike_clusters, spike_clusters)
+        kwik.close()
+        kwik = KwikModel(filename, cache_dir=cache_dir)
+        assert 'spike_times_1' in kwik._cache
+        assert kwik.cluster_metadata.group(100) == 2
+        _check(kwik)
+        kwik.close()
+
+        # The cache is cleared when the file changes.
+        with open_h5(filename, 'a') as f:
+            path = '/channel_groups/1/spikes/time_samples'
+            f.write(path, spike_times + 1, overwrite=True)
+        spike_times = spike_times + 1
+        kwik = KwikModel(filename, cache_dir=cache_dir)
+        _check(kwik)
+        kwik.close()
+
+
+def test_kwik_prefilter():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+
+        kwik = KwikModel(filename)
+        assert kwik._kwd_filtered is None
+        traces = kwik.traces[...]
+        spikes = [3, 10, 20]
+        times = kwik.spike_times[spikes]
+
+        # Interrupt the filtering after the first chunk.
+        pr = ProgressReporter()
+
+        @pr.connect
+        def on_report(value, value_max):
+            if 0 < value < value_max:
+                raise RuntimeError()
+
+        with raises(RuntimeError):
+            kwik.prefilter_traces(chunk_size=1000, overlap=200,
+                                  progress_reporter=pr)
+        assert kwik._kwd_filtered is None
+        kwik.close()
+
+        # The incomplete filtered traces are ignored.
+        kwik = KwikModel(filename)
+        assert kwik._kwd_filtered is None
+        pr = ProgressReporter()
+        reports = []
+
+        @pr.connect
+        def on_report(value, value_max):
+            reports.append(value)
+
+        kwik.prefilter_traces(chunk_size=1000, overlap=200,
+                              progress_reporter=pr)
+        # The pass was resumed after the first chunk.
+        assert reports[0] > 0
+        assert reports[-1] == _N_SAMPLES_TRACES
+        assert kwik._kwd_filtered is not None
+        waveforms = kwik.waveforms[spikes]
+        kwik.close()
+
+        # Compare with the filtered traces.
+        b_filter = bandpass_filter(rate=20000., low=500., high=9500.,
+                                   order=3)
+        filtered = apply_filter(traces, b_filter)
+        for i, t in enumerate(times):
+            assert np.allclose(waveforms[i], .01 * filtered[t - 15:t + 25],
+                               atol=1e-2)
+
+        # The filtered traces are used when reopening the file.
+        kwik = KwikModel(filename)
+        assert kwik._kwd_filtered is not None
+        assert kwik._waveform_loader._filter is None
+        ae(kwik.waveforms[spikes], waveforms)
+        # The raw traces are still available.
+        ae(kwik.traces[...], traces)
+        kwik.close()
+
+
+def test_kwik_h5_options():
+    assert _kwik_h5_options('kwik') == {}
+    assert _kwik_h5_options('kwx')['rdcc_nbytes'] > 2 ** 20
+    options = _kwik_h5_options('kwx', {'kwx': {'rdcc_nbytes': 2 ** 20},
+                                       'kwik': {'driver': 'core'}})
+    assert options['rdcc_nbytes'] == 2 ** 20
+    assert 'driver' not in options
+
+    with TemporaryDirectory() as tempdir:
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+        kwik = KwikModel(filename, h5_options={'kwik': {'driver': 'core'},
+                                               'kwx': {'rdcc_nslots': 1009}})
+        assert kwik._kwik.h5py_file.driver == 'core'
+        cache = kwik._kwx.h5py_file.id.get_access_plist().get_cache()
+        assert cache[1] == 1009
+        assert kwik.features[[3, 1], :].shape == (2, _N_CHANNELS * _N_FETS)
+        kwik.close()
+
+
+def test_lru_cache():
+    evicted = []
+    cache = _LRUCache(max_size=250, on_evict=evicted.append)
+    cache.set('a', {'x': np.zeros(100, dtype=np.uint8)})
+    cache.set('b', {'x': np.zeros(100, dtype=np.uint8)})
+    assert cache.total_size == 200
+    assert cache.get('a') is not None
+
+    # 'b' is the least recently used item.
+    b = cache.get('b')
+    cache.get('a')
+    cache.set('c', {'x': np.zeros(100, dtype=np.uint8)})
+    assert evicted == [b]
+    assert 'b' not in cache
+    assert 'a' in cache
+    assert 'c' in cache
+    assert cache.get('b') is None
+
+    # Memory-mapped arrays are not counted.
+    with TemporaryDirectory() as tempdir:
+        mm = np.memmap(op.join(tempdir, 'mm'), mode='w+', dtype=np.uint8,
+                       shape=1000)
+        cache.set('c', {'x': mm})
+        assert cache.total_size == 100
+        del mm
+        cache.set('c', {})
+
+    cache.clear()
+    assert len(cache) == 0
+    assert len(evicted) == 3
+
+    # The item in use is never evicted, even if it is larger than the cache.
+    cache.set('a', {'x': np.zeros(100, dtype=np.uint8)})
+    cache.set('d', {'x': np.zeros(300, dtype=np.uint8)})
+    assert 'a' not in cache
+    assert 'd' in cache
+    assert len(evicted) == 4
+    cache.set('d', {'x': np.zeros(400, dtype=np.uint8)})
+    assert 'd' in cache
+    assert len(evicted) == 4
+
+
+def _add_channel_group(filename, channel_group):
+    """Duplicate the channel group 1 of a mock kwik experiment."""
+    filenames = _kwik_filenames(filename)
+    for path in (filename, filenames['kwx']):
+        with open_h5(path, 'a') as f:
+            f.h5py_file.copy('/channel_groups/1',
+                             '/channel_groups/{0:d}'.format(channel_group))
+
+
+def test_kwik_channel_group_cache():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+        _add_channel_group(filename, 2)
+
+        kwik = KwikModel(filename)
+        assert kwik.channel_groups == [1, 2]
+        spike_times = kwik.spike_times
+        spike_clusters = kwik.spike_clusters
+        probe = kwik.probe
+
+        kwik.channel_group = 2
+        assert kwik.spike_times is not spike_times
+        ae(kwik.spike_times, spike_times)
+        ae(kwik.spike_clusters, spike_clusters)
+        assert kwik.waveforms[[3, 1]].shape == (2, 40, _N_CHANNELS)
+
+        # Switching back to a visited channel group does not reload the data.
+        kwik.channel_group = 1
+        assert kwik.spike_times is spike_times
+        assert kwik.spike_clusters is spike_clusters
+        assert kwik.probe is probe
+        assert kwik.waveforms[[3, 1]].shape == (2, 40, _N_CHANNELS)
+        kwik.close()
+
+        # Disable the cache.
+        kwik = KwikModel(filename, channel_group_cache_size=0)
+        spike_times = kwik.spike_times
+        kwik.channel_group = 2
+        kwik.channel_group = 1
+        assert kwik.spike_times is not spike_times
+        ae(kwik.spike_times, spike_times)
+        # Only the current channel group is kept.
+        assert list(kwik._channel_group_cache._items) == [1]
+        assert kwik.waveforms[[3, 1]].shape == (2, 40, _N_CHANNELS)
+        kwik.close()
 
+
+def test_kwik_save():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+
+        kwik = KwikModel(filename)
+        spike_clusters = kwik.spike_clusters.copy()
+
+        # Merge clusters 1 and 2 into 10.
+        spikes = np.nonzero(np.in1d(spike_clusters, [1, 2]))[0]
+        spike_clusters[spikes] = 10
+        kwik.save(spike_clusters, spikes=spikes,
+                  cluster_groups={1: None, 2: None, 10: 2})
+        ae(kwik.spike_clusters, spike_clusters)
+        assert 10 in kwik._clusters
+        assert 1 not in kwik._clusters
+        assert _JOURNAL_PATH not in kwik._kwik.h5py_file
+
+        # Find the changed spikes automatically.
+        spike_clusters[0] = 11
+        kwik.save(spike_clusters)
+        kwik.close()
+
+        kwik = KwikModel(filename, lazy=True)
+        ae(kwik.spike_clusters, spike_clusters)
+        path = '/channel_groups/1/clusters/main/10'
+        assert kwik._kwik.read_attr(path, 'cluster_group') == 2
+        # The cluster groups are loaded from the file.
+        assert kwik.cluster_metadata.group(10) == 2
+        assert kwik.cluster_metadata.group(0) == 3
+
+        # Save with a lazy model.
+        spike_clusters[1] = 12
+        kwik.save(spike_clusters, spikes=[1])
+        ae(kwik.spike_clusters, spike_clusters)
+        kwik.close()
+
+
+def test_kwik_journal():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+
+        kwik = KwikModel(filename)
+        spike_clusters = kwik.spike_clusters.copy()
+        kwik.close()
+
+        # Simulate a crash before the commit marker has been written.
+        with open_h5(filename, 'a') as f:
+            _write_journal(f, 1, 'main', [0, 1], [20, 20], {20: 1})
+            f.h5py_file[_JOURNAL_PATH].attrs.__delitem__('committed')
+
+        kwik = KwikModel(filename)
+        ae(kwik.spike_clusters, spike_clusters)
+        assert 20 not in kwik._clusters
+        assert _JOURNAL_PATH not in kwik._kwik.h5py_file
+        kwik.close()
+
+        # Simulate a crash after the commit marker has been written.
+        with open_h5(filename, 'a') as f:
+            _write_journal(f, 1, 'main', [0, 1], [20, 20], {20: 1})
+
+        kwik = KwikModel(filename)
+        spike_clusters[[0, 1]] = 20
+        ae(kwik.spike_clusters, spike_clusters)
+        assert 20 in kwik._clusters
+        assert _JOURNAL_PATH not in kwik._kwik.h5py_file
+        # The kwik file is opened read-only again after the recovery.
+        assert kwik._kwik.mode == 'r'
+        assert kwik.cluster_metadata.group(20) == 1
         kwik.close()
 
 
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the sidecar cache."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import os
+import os.path as op
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+
+from ...utils.tempdir import TemporaryDirectory
+from ..sidecar import SidecarCache, _to_json
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_to_json():
+    assert _to_json(np.float64(1.5)) == 1.5
+    assert _to_json(np.arange(3)) == [0, 1, 2]
+    assert _to_json(b'abc') == 'abc'
+    assert _to_json({1: (np.int32(2), b'a')}) == {'1': [2, 'a']}
+
+
+def test_sidecar_cache():
+    with TemporaryDirectory() as tempdir:
+        source = op.join(tempdir, 'source.bin')
+        with open(source, 'wb') as f:
+            f.write(b'abc')
+        directory = op.join(tempdir, 'cache')
+
+        cache = SidecarCache(directory, source)
+        assert cache.is_valid()
+        assert 'arr' not in cache
+        assert cache.load_array('arr') is None
+        assert cache.load_value('val') is None
+
+        arr = np.arange(10)
+        cache.save_array('arr', arr)
+        cache.save_value('val', {'a': np.float32(2.)})
+        loaded = cache.load_array('arr')
+        assert isinstance(loaded, np.memmap)
+        ae(loaded, arr)
+
+        # Overwrite an array which is memory-mapped.
+        cache.save_array('arr', arr + 1)
+        ae(loaded, arr)
+        ae(cache.load_array('arr'), arr + 1)
+
+        # Update some items of an array in place.
+        cache.save_array('arr', arr)
+        loaded_bis = cache.load_array('arr')
+        cache.update_array('arr', [2, 5], [-1, -2])
+        ae(loaded_bis[[2, 5]], [-1, -2])
+        cache.save_array('arr', arr + 1)
+        del loaded_bis
+
+        # Reopen the cache.
+        cache = SidecarCache(directory, source)
+        assert 'arr' in cache
+        ae(cache.load_array('arr'), arr + 1)
+        assert cache.load_value('val') == {'a': 2.}
+
+        # The source file changes.
+        with open(source, 'ab') as f:
+            f.write(b'def')
+        assert not cache.is_valid()
+        cache = SidecarCache(directory, source)
+        assert cache.is_valid()
+        assert 'arr' not in cache
+        assert not op.exists(op.join(directory, 'arr.npy'))
+
+        # The cache is updated with the source.
+        cache.save_value('val', 1)
+        with open(source, 'ab') as f:
+            f.write(b'ghi')
+        cache.update_source()
+        cache = SidecarCache(directory, source)
+        assert cache.load_value('val') == 1
+
+        # Another source file with the same size and modification time.
+        other = op.join(tempdir, 'other.bin')
+        with open(source, 'rb') as f, open(other, 'wb') as g:
+            g.write(f.read())
+        stat = os.stat(source)
+        os.utime(other, (stat.st_atime, stat.st_mtime))
+        cache = SidecarCache(directory, other)
+        assert cache.load_value('val') is None
+        del loaded
@@ -13,7 +13,8 @@ import numpy as np
 from numpy.testing import assert_array_equal as ae
 from pytest import raises
 
-from ..sparse import csr_matrix, SparseCSR, load_h5, save_h5
+from ..sparse import (csr_matrix, SparseCSR, LazySparseCSR, load_h5, save_h5,
+                      _concatenate_ranges, _spike_ranges)
 from ...utils.tempdir import TemporaryDirectory
 from ..h5 import open_h5
 
@@ -51,14 +52,32 @@ def _sparse_matrix_example():
     return shape, data, channels, spikes_ptr
 
 
+def test_concatenate_ranges():
+    ae(_concatenate_ranges([], []), [])
+    ae(_concatenate_ranges([3], [3]), [])
+    ae(_concatenate_ranges([3, 0, 5, 1], [5, 0, 8, 2]), [3, 4, 5, 6, 7, 1])
+
+
+def test_spike_ranges():
+    spikes_ptr = np.array([0, 2, 2, 5])
+    indices, ptr = _spike_ranges(spikes_ptr, np.array([2, 0, 1]))
+    ae(indices, [2, 3, 4, 0, 1])
+    ae(ptr, [0, 3, 5, 5])
+
+
 def test_sparse_csr_check():
     """Test the checks performed when creating a sparse matrix."""
     dense = _dense_matrix_example()
     shape, data, channels, spikes_ptr = _sparse_matrix_example()
 
-    # Dense to sparse conversion not implemented yet.
-    with raises(NotImplementedError):
-        csr_matrix(dense)
+    # Dense to sparse conversion.
+    sparse = csr_matrix(dense)
+    ae(sparse.shape, shape)
+    ae(sparse._data, data)
+    ae(sparse._channels, channels)
+    ae(sparse._spikes_ptr, spikes_ptr)
+    with raises(ValueError):
+        csr_matrix(np.zeros(3))
 
     # Need the three sparse components and the shape.
     with raises(ValueError):
@@ -105,6 +124,54 @@ def test_sparse_csr_check():
     ae(sparse._spikes_ptr, spikes_ptr)
 
 
+def test_sparse_csr_3d():
+    dense = np.zeros((4, 5, 2))
+    dense[0, 1] = [1, 0]
+    dense[1, 3] = [0, 2]
+    dense[1, 4] = [3, 4]
+    sparse = csr_matrix(dense)
+    ae(sparse._channels, [1, 3, 4])
+    ae(sparse._spikes_ptr, [0, 1, 3, 3, 3])
+    assert sparse._data.shape == (3, 2)
+    ae(sparse.to_dense(), dense)
+    ae(sparse[[1, 0, 1]].to_dense(), dense[[1, 0, 1]])
+    ae(sparse.sum(axis=0), dense.sum(axis=0))
+    ae(sparse.mean(axis=0), dense.mean(axis=0))
+
+
+def test_sparse_csr_getitem():
+    dense = _dense_matrix_example()
+    sparse = csr_matrix(dense)
+    assert len(sparse) == 4
+    ae(sparse.to_dense(), dense)
+
+    # Index arrays.
+    for spikes in ([], [2], [3, 0], [1, 1, 2, 0], 1):
+        sub = sparse[spikes]
+        ae(sub.to_dense(), dense[np.atleast_1d(spikes).astype(np.int64)])
+
+    # Negative indices.
+    ae(sparse[-1].to_dense()[0], sparse.to_dense()[-1])
+    ae(sparse[[-1, 0]].to_dense(), dense[[-1, 0]])
+    for spikes in (4, -5, [0, 4]):
+        with raises(IndexError):
+            sparse[spikes]
+
+    # Slices and boolean masks.
+    ae(sparse[1:3].to_dense(), dense[1:3])
+    ae(sparse[::-2].to_dense(), dense[::-2])
+    ae(sparse[:0].to_dense(), dense[:0])
+    ae(sparse[np.array([True, False, False, True])].to_dense(),
+       dense[[0, 3]])
+
+    # Reductions.
+    ae(sparse.sum(axis=0), dense.sum(axis=0))
+    ae(sparse.mean(axis=0), dense.mean(axis=0))
+    ae(sparse[:0].mean(axis=0), np.zeros(5))
+    with raises(NotImplementedError):
+        sparse.mean(axis=1)
+
+
 def test_sparse_hdf5():
     """Test the checks performed when creating a sparse matrix."""
     shape, data, channels, spikes_ptr = _sparse_matrix_example()
@@ -123,3 +190,38 @@ def test_sparse_hdf5():
             save_h5(f, path_dense, dense)
             dense_bis = load_h5(f, path_dense)
             ae(dense, dense_bis)
+
+
+def test_sparse_hdf5_lazy():
+    dense = np.random.rand(20, 5, 3)
+    dense[dense < .5] = 0
+    sparse = csr_matrix(dense)
+
+    with TemporaryDirectory() as tempdir:
+        with open_h5(op.join(tempdir, 'test.h5'), 'w') as f:
+            save_h5(f, '/sparse', sparse)
+            lazy = load_h5(f, '/sparse', lazy=True)
+            assert isinstance(lazy, LazySparseCSR)
+            assert lazy.shape == (20, 5, 3)
+            assert len(lazy) == 20
+            ae(lazy[[3, 10, 3]].to_dense(), dense[[3, 10, 3]])
+            ae(lazy[[-1, 0]].to_dense(), dense[[-1, 0]])
+            ae(lazy[5:].to_dense(), dense[5:])
+            assert lazy.load() == sparse
+
+            # Selection of the trailing dimensions.
+            lazy = LazySparseCSR(f, '/sparse', trailing_index=(2,))
+            assert lazy.shape == (20, 5)
+            ae(lazy[[1, 2]].to_dense(), dense[[1, 2], :, 2])
+
+            # Trailing dimensions flattened with the channel dimension.
+            lazy = LazySparseCSR(f, '/sparse',
+                                 trailing_index=(slice(0, 2, None),),
+                                 flatten=True)
+            assert lazy.shape == (20, 10)
+            ae(lazy[[1, 2]].to_dense(),
+               dense[[1, 2], :, :2].reshape((2, 10)))
+
+            f.write_attr('/dense', 'sparse_type', 'other')
+            with raises(ValueError):
+                LazySparseCSR(f, '/dense')
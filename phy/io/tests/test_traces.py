@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of raw data readers."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import os.path as op
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from pytest import raises
+
+from ...utils.tempdir import TemporaryDirectory
+from ..traces import read_dat, _dat_n_samples
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_read_dat():
+    n_samples, n_channels = 1000, 10
+    arr = np.random.randint(-1000, 1000,
+                            size=(n_samples, n_channels)).astype(np.int16)
+
+    with TemporaryDirectory() as tempdir:
+        path = op.join(tempdir, 'test.dat')
+
+        # Header of 64 bytes.
+        with open(path, 'wb') as f:
+            f.write(b'\0' * 64)
+            arr.tofile(f)
+
+        with raises(ValueError):
+            read_dat(path, dtype=np.int16)
+        with raises(ValueError):
+            read_dat(path, dtype=np.int16, n_channels=n_channels)
+        with raises(ValueError):
+            read_dat(path, dtype=np.int16, n_channels=n_channels,
+                     offset=100000)
+
+        assert _dat_n_samples(path, dtype=np.int16, n_channels=n_channels,
+                              offset=64) == n_samples
+
+        traces = read_dat(path, dtype=np.int16, n_channels=n_channels,
+                          offset=64)
+        assert isinstance(traces, np.memmap)
+        assert traces.shape == (n_samples, n_channels)
+        assert traces.dtype == np.int16
+        ae(traces, arr)
+        ae(traces[10:20, 3], arr[10:20, 3])
+
+        # The memmap is read-only.
+        with raises(ValueError):
+            traces[0, 0] = 0
+        del traces
+
+        # Empty file.
+        path = op.join(tempdir, 'empty.dat')
+        open(path, 'wb').close()
+        traces = read_dat(path, dtype=np.int16, n_channels=n_channels)
+        assert traces.shape == (0, n_channels)
+        assert traces.dtype == np.int16
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""Raw data readers."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import os.path as op
+
+import numpy as np
+
+
+#------------------------------------------------------------------------------
+# Raw binary files
+#------------------------------------------------------------------------------
+
+def _dat_n_samples(filename, dtype=None, n_channels=None, offset=0):
+    """Return the number of samples in a raw binary file."""
+    assert dtype is not None
+    assert n_channels is not None
+    n_bytes = op.getsize(filename) - offset
+    if n_bytes < 0:
+        raise ValueError("The offset {0:d} is larger ".format(offset) +
+                         "than the file size.")
+    frame_size = np.dtype(dtype).itemsize * n_channels
+    if n_bytes % frame_size != 0:
+        raise ValueError("The size of {0:s} ".format(filename) +
+                         "({0:d} bytes after the offset) ".format(n_bytes) +
+                         "is not a multiple of n_channels * itemsize "
+                         "({0:d}).".format(frame_size))
+    return n_bytes // frame_size
+
+
+def read_dat(filename, dtype=None, n_channels=None, offset=0):
+    """Memory-map a raw binary file with interleaved channels.
+
+    Parameters
+    ----------
+
+    filename : str
+        Path to the raw binary file (.dat).
+    dtype : dtype
+        Data type of the samples, for example `np.int16`.
+    n_channels : int
+        Total number of channels in the file.
+    offset : int
+        Size of the header, in bytes. Defaults to 0.
+
+    Returns
+    -------
+
+    traces : memmap
+        A read-only (n_samples, n_channels) memory-mapped array, or an
+        empty array if there are no samples.
+
+    """
+    if dtype is None or n_channels is None:
+        raise ValueError("'dtype' and 'n_channels' must be specified.")
+    n_samples = _dat_n_samples(filename, dtype=dtype,
+                               n_channels=n_channels, offset=offset)
+    # Empty files cannot be memory-mapped.
+    if n_samples == 0:
+        return np.zeros((0, n_channels), dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                     shape=(n_samples, n_channels))
@@ -17,6 +17,7 @@ from vispy.visuals.glsl.color import HSV_TO_RGB, RGB_TO_HSV
 
 from ._vispy_utils import PanZoomCanvas
 from ..utils.array import _unique, _as_array, _index_of, _normalize
+from ..io.sparse import SparseCSR
 from ..utils.logging import debug
 from ..utils._color import _random_color
 
@@ -382,7 +383,10 @@ def add_waveform_view(session, backend=None):
         if view.visual.spike_clusters is None:
             on_open()
         view.visual.waveforms = session.model.waveforms[spikes]
-        view.visual.masks = session.model.masks[spikes]
+        masks = session.model.masks[spikes]
+        if isinstance(masks, SparseCSR):
+            masks = masks.to_dense()
+        view.visual.masks = masks
         view.visual.spike_ids = spikes
         # TODO: how to choose cluster colors?
         view.visual.cluster_colors = [_random_color()
@@ -10,7 +10,12 @@ import numpy as np
 from numpy.testing import assert_array_equal as ae
 from pytest import raises
 
-from ..ccg import _increment, _diff_shifted, correlograms
+from ..ccg import (_increment, _diff_shifted, _correlograms_searchsorted,
+                   _shard_bounds, _correlograms_sharded,
+                   _spikes_in_windows, correlograms, pairwise_correlograms,
+                   CorrelogramCache, SparseCorrelograms)
+from ...cluster.manual.clustering import Clustering
+from ...cluster.manual._utils import _spikes_per_cluster
 
 
 #------------------------------------------------------------------------------
@@ -49,10 +54,16 @@ def test_ccg_1():
     c_expected[0, 1, 1] = 1
     c_expected[0, 0, 2] = 1
 
-    c = correlograms(spike_times, spike_clusters,
-                     binsize=binsize, winsize_bins=winsize_bins)
+    for method in ('searchsorted', 'shift'):
+        c = correlograms(spike_times, spike_clusters,
+                         binsize=binsize, winsize_bins=winsize_bins,
+                         method=method)
+        ae(c, c_expected)
 
-    ae(c, c_expected)
+    with raises(ValueError):
+        correlograms(spike_times, spike_clusters,
+                     binsize=binsize, winsize_bins=winsize_bins,
+                     method='unknown')
 
 
 def test_ccg_2():
@@ -75,3 +86,240 @@ def test_ccg_2():
                      binsize=binsize, winsize_bins=winsize_bins)
 
     assert c.shape == (max_cluster, max_cluster, 26)
+
+
+def test_ccg_engines():
+    sr = 20000
+    nspikes = 5000
+    spike_times = np.cumsum(np.random.exponential(scale=.001, size=nspikes))
+    spike_times = (spike_times * sr).astype(np.int64)
+    # Some spikes occur at the same time.
+    spike_times[100:110] = spike_times[100]
+    spike_times = np.sort(spike_times)
+    spike_clusters = np.random.randint(0, 7, nspikes)
+
+    binsize = 20
+    winsize_bins = 51
+
+    c = correlograms(spike_times, spike_clusters,
+                     binsize=binsize, winsize_bins=winsize_bins,
+                     method='shift')
+    ae(correlograms(spike_times, spike_clusters,
+                    binsize=binsize, winsize_bins=winsize_bins), c)
+
+    # Small blocks.
+    spike_clusters_i = np.searchsorted(np.unique(spike_clusters),
+                                       spike_clusters)
+    ae(_correlograms_searchsorted(spike_times, spike_clusters_i, 7,
+                                  binsize, winsize_bins, block_size=10), c)
+
+
+def test_spikes_in_windows():
+    spike_times = np.array([0, 10, 12, 30, 31, 50, 70])
+    ae(_spikes_in_windows(spike_times, [1], 2), [1, 2])
+    ae(_spikes_in_windows(spike_times, [1, 4], 5), [1, 2, 3, 4])
+    ae(_spikes_in_windows(spike_times, [], 5), [])
+
+
+def test_correlogram_cache():
+    sr = 20000
+    nspikes = 3000
+    spike_times = np.cumsum(np.random.exponential(scale=.002, size=nspikes))
+    spike_times = (spike_times * sr).astype(np.int64)
+    spike_clusters = np.random.randint(0, 10, nspikes)
+    binsize, winsize_bins = 20, 51
+
+    clustering = Clustering(spike_clusters)
+    cache = CorrelogramCache(spike_times, clustering.spike_clusters,
+                             binsize=binsize, winsize_bins=winsize_bins)
+
+    def _check():
+        ae(cache.clusters, clustering.cluster_ids)
+        ae(cache.correlograms,
+           correlograms(spike_times, clustering.spike_clusters,
+                        binsize=binsize, winsize_bins=winsize_bins))
+
+    # Updates before the first computation are ignored.
+    cache.update(clustering.merge([0, 1]))
+    _check()
+
+    # Merges.
+    cache.update(clustering.merge([2, 3, 10]))
+    _check()
+    ae(cache.get([11, 4]),
+       cache.correlograms[[-1, 0]][:, [-1, 0]])
+
+    # Splits.
+    cache.update(clustering.split(np.arange(0, nspikes, 7)))
+    _check()
+    cache.update(clustering.split(np.arange(100, 300)))
+    _check()
+
+    # Undo and redo.
+    cache.update(clustering.undo())
+    _check()
+    cache.update(clustering.undo())
+    _check()
+    cache.update(clustering.redo())
+    _check()
+
+
+def test_pairwise_correlograms():
+    sr = 20000
+    nspikes = 3000
+    spike_times = np.cumsum(np.random.exponential(scale=.002, size=nspikes))
+    spike_times = (spike_times * sr).astype(np.int64)
+    # Some spikes occur at the same time.
+    spike_times[100:110] = spike_times[100]
+    spike_times = np.sort(spike_times)
+    spike_clusters = np.random.randint(0, 10, nspikes)
+    spc = _spikes_per_cluster(np.arange(nspikes), spike_clusters)
+    binsize, winsize_bins = 20, 51
+
+    c = correlograms(spike_times, spike_clusters,
+                     binsize=binsize, winsize_bins=winsize_bins)
+    pairs = [(0, 0), (2, 5), (5, 2), (9, 3)]
+    pc = pairwise_correlograms(spike_times, spc, pairs,
+                               binsize=binsize, winsize_bins=winsize_bins)
+    assert pc.shape == (4, 26)
+    for k, (i, j) in enumerate(pairs):
+        ae(pc[k], c[i, j])
+
+    # Only the spikes of the clusters of the pairs are needed.
+    spc = {3: spc[3], 7: spc[7]}
+    pc = pairwise_correlograms(spike_times, spc, [(3, 7)],
+                               binsize=binsize, winsize_bins=winsize_bins)
+    ae(pc[0], c[3, 7])
+    assert pairwise_correlograms(spike_times, spc, [],
+                                 binsize=binsize,
+                                 winsize_bins=winsize_bins).shape == (0, 26)
+
+    # Correlograms of some clusters in the cache.
+    cache = CorrelogramCache(spike_times, spike_clusters,
+                             binsize=binsize, winsize_bins=winsize_bins)
+    ae(cache.get([4, 1]), c[[4, 1]][:, [4, 1]])
+    ae(cache.get([7, 0, 7]), c[[7, 0, 7]][:, [7, 0, 7]])
+    ae(cache.correlograms, c)
+    ae(cache.get([4, 1]), c[[4, 1]][:, [4, 1]])
+
+    # The spikes of the clusters are given by spikes_per_cluster.
+    spc = _spikes_per_cluster(np.arange(nspikes), spike_clusters)
+    for arg in ({4: spc[4], 1: spc[1]}, lambda: spc):
+        cache = CorrelogramCache(spike_times, spike_clusters,
+                                 binsize=binsize, winsize_bins=winsize_bins,
+                                 spikes_per_cluster=arg)
+        ae(cache.get([4, 1]), c[[4, 1]][:, [4, 1]])
+
+
+def test_shard_bounds():
+    spike_times = np.array([0, 1, 5, 6, 10, 11, 30])
+    assert _shard_bounds(spike_times[:0], 3, 2) == []
+    shards = _shard_bounds(spike_times, 3, 2)
+    # The first spikes of the blocks cover all spikes once.
+    ae(np.concatenate([np.arange(start, end) for start, end, _ in shards]),
+       np.arange(len(spike_times)))
+    assert shards == [(0, 5, 6), (5, 6, 6), (6, 7, 7)]
+    assert _shard_bounds(spike_times, 1, 6) == [(0, 7, 7)]
+    assert _shard_bounds(spike_times, 6, 6)[0] == (0, 3, 5)
+
+
+def test_ccg_sharded():
+    sr = 20000
+    nspikes = 5000
+    spike_times = np.cumsum(np.random.exponential(scale=.001, size=nspikes))
+    spike_times = (spike_times * sr).astype(np.int64)
+    # Some spikes occur at the same time.
+    spike_times[100:110] = spike_times[100]
+    spike_times = np.sort(spike_times)
+    spike_clusters = np.random.randint(0, 7, nspikes)
+    binsize, winsize_bins = 20, 51
+
+    c = correlograms(spike_times, spike_clusters,
+                     binsize=binsize, winsize_bins=winsize_bins)
+    ae(correlograms(spike_times, spike_clusters,
+                    binsize=binsize, winsize_bins=winsize_bins,
+                    n_workers=2), c)
+
+    # Many small blocks.
+    spike_clusters_i = np.searchsorted(np.unique(spike_clusters),
+                                       spike_clusters)
+    ae(_correlograms_sharded(spike_times, spike_clusters_i, np.arange(7),
+                             binsize, winsize_bins, 2, n_shards=100), c)
+
+    # Sparse correlograms.
+    sparse = correlograms(spike_times, spike_clusters,
+                          binsize=binsize, winsize_bins=winsize_bins,
+                          n_workers=2, sparse=True)
+    ae(sparse.to_dense(), c)
+
+    with raises(ValueError):
+        correlograms(spike_times, spike_clusters,
+                     binsize=binsize, winsize_bins=winsize_bins,
+                     method='shift', n_workers=2)
+
+
+def test_ccg_sparse():
+    sr = 20000
+    nspikes = 3000
+    spike_times = np.cumsum(np.random.exponential(scale=.002, size=nspikes))
+    spike_times = (spike_times * sr).astype(np.int64)
+    # Many clusters, so that most pairs are empty.
+    spike_clusters = np.random.randint(0, 200, nspikes)
+    binsize, winsize_bins = 20, 21
+
+    clustering = Clustering(spike_clusters.copy())
+    dense = correlograms(spike_times, spike_clusters,
+                         binsize=binsize, winsize_bins=winsize_bins)
+    sparse = correlograms(spike_times, spike_clusters,
+                          binsize=binsize, winsize_bins=winsize_bins,
+                          sparse=True)
+    assert isinstance(sparse, SparseCorrelograms)
+    assert sparse.shape == dense.shape
+    assert sparse.n_pairs == (dense.sum(axis=2) > 0).sum()
+    ae(sparse.clusters, clustering.cluster_ids)
+    ae(sparse.to_dense(), dense)
+
+    # Row lookups.
+    i = np.argmax(dense.sum(axis=(1, 2)))
+    cluster = sparse.clusters[i]
+    clusters, data = sparse.row(cluster)
+    nonzero = np.nonzero(dense[i].sum(axis=1))[0]
+    ae(clusters, sparse.clusters[nonzero])
+    ae(data, dense[i, nonzero])
+    for j in (nonzero[0], np.nonzero(dense[i].sum(axis=1) == 0)[0][0]):
+        ae(sparse.get(cluster, sparse.clusters[j]), dense[i, j])
+    with raises(ValueError):
+        sparse.get(cluster, 1000)
+
+    # Sums.
+    ae((sparse + sparse).to_dense(), 2 * dense)
+
+    # Merges.
+    for to_merge in ([0, 1], [2, 3, 200]):
+        sparse.merge(clustering.merge(to_merge))
+        ae(sparse.clusters, clustering.cluster_ids)
+        ae(sparse.to_dense(),
+           correlograms(spike_times, clustering.spike_clusters,
+                        binsize=binsize, winsize_bins=winsize_bins))
+
+    # Top pairs.
+    top = correlograms(spike_times, spike_clusters,
+                       binsize=binsize, winsize_bins=winsize_bins,
+                       sparse=True, top_k=2)
+    totals = dense.sum(axis=2)
+    for i, cluster in enumerate(top.clusters):
+        # The autocorrelogram is always kept.
+        ae(top.get(cluster, cluster), dense[i, i])
+        clusters, data = top.row(cluster)
+        kept = np.searchsorted(top.clusters, clusters)
+        kept = kept[kept != i]
+        assert len(kept) == min(2, (totals[i] > 0).sum() - (totals[i, i] > 0))
+        # The kept pairs have the largest totals.
+        dropped = np.setdiff1d(np.arange(len(totals)), np.r_[kept, i])
+        if len(kept):
+            assert totals[i, kept].min() >= totals[i, dropped].max()
+
+    with raises(ValueError):
+        correlograms(spike_times, spike_clusters,
+                     binsize=binsize, winsize_bins=winsize_bins,
+                     method='shift', sparse=True)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of waveform statistics."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+
+from ...io.mock.artificial import (artificial_waveforms,
+                                   artificial_traces,
+                                   artificial_spike_clusters)
+from ...cluster.manual._utils import _spikes_per_cluster
+from ...waveform.loader import WaveformLoader
+from ..waveforms import (_peak_channel, cluster_waveform_stats,
+                         merge_waveform_stats)
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def _check_stats(stats, waveforms, spikes):
+    assert stats.n_spikes == len(spikes)
+    assert np.allclose(stats.mean, waveforms[spikes].mean(axis=0),
+                       atol=1e-6)
+    assert np.allclose(stats.std, waveforms[spikes].std(axis=0),
+                       atol=1e-6)
+    assert stats.peak_channel == _peak_channel(stats.mean)
+
+
+def test_peak_channel():
+    mean = np.zeros((10, 4))
+    mean[3, 2] = -5
+    mean[4, 1] = 3
+    assert _peak_channel(mean) == 2
+
+
+def test_cluster_waveform_stats():
+    n_spikes, n_samples, n_channels = 100, 20, 4
+    n_clusters = 5
+
+    waveforms = artificial_waveforms(n_spikes, n_samples, n_channels)
+    spike_clusters = artificial_spike_clusters(n_spikes, n_clusters)
+    spc = _spikes_per_cluster(np.arange(n_spikes), spike_clusters)
+
+    assert cluster_waveform_stats(waveforms, {}) == {}
+    assert cluster_waveform_stats(waveforms, {0: []}) == {}
+
+    stats = cluster_waveform_stats(waveforms, spc, batch_size=7)
+    assert sorted(stats) == sorted(spc)
+    for cluster, spikes in spc.items():
+        _check_stats(stats[cluster], waveforms, spikes)
+        assert stats[cluster].mean.shape == (n_samples, n_channels)
+
+    # Merge.
+    merged = merge_waveform_stats([stats[0], stats[1], stats[3]])
+    spikes = np.concatenate([spc[0], spc[1], spc[3]])
+    _check_stats(merged, waveforms, spikes)
+
+
+def test_cluster_waveform_stats_loader():
+    n_samples_trace, n_channels = 5000, 4
+    n_spikes, n_clusters = 100, 3
+
+    traces = artificial_traces(n_samples_trace, n_channels)
+    loader = WaveformLoader(traces, n_samples=20)
+    spike_times = np.sort(np.random.randint(low=10, high=n_samples_trace - 10,
+                                            size=n_spikes))
+    spike_clusters = artificial_spike_clusters(n_spikes, n_clusters)
+    spc = _spikes_per_cluster(np.arange(n_spikes), spike_clusters)
+
+    class _SpikeLoader(object):
+        def __getitem__(self, spikes):
+            return loader[spike_times[spikes]]
+
+        def iter_batches(self, spikes, batch_size=None):
+            return loader.iter_batches(spike_times[spikes],
+                                       batch_size=batch_size)
+
+    waveforms = loader[spike_times]
+    stats = cluster_waveform_stats(_SpikeLoader(), spc, batch_size=16)
+    for cluster, spikes in spc.items():
+        _check_stats(stats[cluster], waveforms, spikes)
+    ae(sorted(stats), sorted(spc))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""Per-cluster waveform statistics."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+
+from ..utils.array import _as_array
+from ..utils._bunch import Bunch
+from ..waveform.loader import _iter_waveform_batches
+
+
+#------------------------------------------------------------------------------
+# Utility functions
+#------------------------------------------------------------------------------
+
+def _batch_stats(waveforms, clusters):
+    """Return the clusters, counts, means and sums of squared deviations
+    of a batch of waveforms."""
+    order = np.argsort(clusters, kind='mergesort')
+    clusters = clusters[order]
+    waveforms = np.asarray(waveforms, dtype=np.float64)[order]
+    unique, first, counts = np.unique(clusters, return_index=True,
+                                      return_counts=True)
+    means = np.add.reduceat(waveforms, first, axis=0)
+    means /= counts[:, np.newaxis, np.newaxis]
+    deviations = waveforms - np.repeat(means, counts, axis=0)
+    m2 = np.add.reduceat(deviations * deviations, first, axis=0)
+    return unique, counts, means, m2
+
+
+def _combine(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """Combine the counts, means and sums of squared deviations of two
+    disjoint sets of waveforms."""
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / float(n))
+    m2 = m2_a + m2_b + delta * delta * (n_a * n_b / float(n))
+    return n, mean, m2
+
+
+def _peak_channel(mean):
+    """Return the channel with the largest peak-to-peak amplitude of a
+    (n_samples, n_channels) mean waveform."""
+    return int(np.argmax(mean.max(axis=0) - mean.min(axis=0)))
+
+
+def _stats(n, mean, m2):
+    return Bunch(n_spikes=n,
+                 mean=mean.astype(np.float32),
+                 std=np.sqrt(m2 / n).astype(np.float32),
+                 peak_channel=_peak_channel(mean))
+
+
+#------------------------------------------------------------------------------
+# Waveform statistics
+#------------------------------------------------------------------------------
+
+def cluster_waveform_stats(waveforms, spikes_per_cluster, batch_size=None):
+    """Compute the mean waveform, standard deviation and peak channel of
+    several clusters in a single pass over the waveforms.
+
+    Parameters
+    ----------
+
+    waveforms : array-like
+        A (n_spikes, n_samples, n_channels) array-like object. With a
+        waveform loader, the waveforms are loaded in batches, in time order.
+    spikes_per_cluster : dict
+        A dictionary {cluster: spikes}.
+    batch_size : int
+        Number of waveforms loaded at once.
+
+    Returns
+    -------
+
+    stats : dict
+        A dictionary {cluster: Bunch(n_spikes, mean, std, peak_channel)}.
+        Clusters without spikes are skipped.
+
+    """
+    clusters = sorted(cluster for cluster, spikes in spikes_per_cluster.items()
+                      if len(spikes))
+    if not clusters:
+        return {}
+    spikes = np.concatenate([_as_array(spikes_per_cluster[cluster])
+                             for cluster in clusters])
+    spike_clusters = np.repeat(clusters,
+                               [len(spikes_per_cluster[cluster])
+                                for cluster in clusters])
+    order = np.argsort(spikes, kind='mergesort')
+    spikes, spike_clusters = spikes[order], spike_clusters[order]
+
+    # {cluster: (n, mean, m2)}
+    acc = {}
+    for batch_spikes, batch in _iter_waveform_batches(waveforms, spikes,
+                                                      batch_size=batch_size):
+        batch_clusters = spike_clusters[np.searchsorted(spikes, batch_spikes)]
+        for cluster, n, mean, m2 in zip(*_batch_stats(batch, batch_clusters)):
+            if cluster in acc:
+                acc[cluster] = _combine(*(acc[cluster] + (n, mean, m2)))
+            else:
+                acc[cluster] = (n, mean, m2)
+    return {cluster: _stats(*acc[cluster]) for cluster in clusters}
+
+
+def merge_waveform_stats(stats):
+    """Combine the waveform statistics of several clusters, as returned by
+    `cluster_waveform_stats()`, into the statistics of the merged cluster."""
+    n, mean, m2 = None, None, None
+    for item in stats:
+        item_m2 = item.n_spikes * item.std.astype(np.float64) ** 2
+        item_mean = item.mean.astype(np.float64)
+        if n is None:
+            n, mean, m2 = item.n_spikes, item_mean, item_m2
+        else:
+            n, mean, m2 = _combine(n, mean, m2,
+                                   item.n_spikes, item_mean, item_m2)
+    return _stats(n, mean, m2)
@@ -274,6 +274,102 @@ def _partial_shape(shape, trailing_index):
     return shape[:len_item] + trailing_arr.shape
 
 
+def _is_fancy_index(item):
+    """Return whether an item is an array-like of indices."""
+    if not isinstance(item, (list, np.ndarray)):
+        return False
+    item = np.asarray(item)
+    return item.ndim == 1 and (item.dtype.kind in 'iu' or item.size == 0)
+
+
+# Rows separated by less than this number of bytes are read at once: reading
+# a few unneeded bytes is cheaper than an additional read call.
+_MAX_GAP_SIZE = 64 * 1024
+
+# Maximum number of bytes read at once.
+_MAX_READ_SIZE = 16 * 1024 * 1024
+
+# Maximum number of isolated rows read at once with a point selection.
+_MAX_POINTS_PER_READ = 256
+
+
+def _row_size(arr):
+    """Number of bytes of a row of an array-like structure."""
+    return max(1, int(np.prod(arr.shape[1:])) * np.dtype(arr.dtype).itemsize)
+
+
+def _index_runs(indices, max_gap=1, chunk_rows=None, max_rows=None):
+    """Merge sorted unique indices into runs of rows to read at once.
+
+    Two successive indices are in the same run if they are separated by at
+    most `max_gap` rows, or if they belong to the same chunk of `chunk_rows`
+    rows. Runs do not cross multiples of `max_rows` rows.
+
+    Return a (n_runs, 2) array with the first and last (included) positions
+    of every run in `indices`.
+
+    """
+    indices = _as_array(indices)
+    n = len(indices)
+    if n == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    breaks = np.diff(indices) > max_gap
+    if chunk_rows is not None:
+        breaks &= np.diff(indices // chunk_rows) != 0
+    if max_rows is not None:
+        breaks |= np.diff(indices // max_rows) != 0
+    ends = np.nonzero(breaks)[0]
+    starts = np.r_[0, ends + 1]
+    ends = np.r_[ends, n - 1]
+    return np.c_[starts, ends]
+
+
+def _fancy_read(arr, indices, trailing_index=()):
+    """Select arbitrary indices along the first axis of an array-like
+    structure which only supports slices efficiently (like h5py datasets).
+
+    The indices are sorted and deduplicated, merged into contiguous runs
+    aligned on the chunks of the array, and every run is read at once.
+
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    if len(indices) == 0:
+        return arr[(slice(0, 0, None),) + trailing_index]
+    unique_indices, inverse = np.unique(indices, return_inverse=True)
+    row_size = _row_size(arr)
+    # HDF5 decompresses whole chunks, so that rows in the same chunk
+    # are read together.
+    chunks = getattr(arr, 'chunks', None)
+    chunk_rows = chunks[0] if chunks else None
+    max_rows = max(1, _MAX_READ_SIZE // row_size)
+    if chunk_rows is not None:
+        max_rows = chunk_rows * max(1, max_rows // chunk_rows)
+    runs = _index_runs(unique_indices,
+                       max_gap=max(1, _MAX_GAP_SIZE // row_size),
+                       chunk_rows=chunk_rows,
+                       max_rows=max_rows)
+    out = None
+    # Rows which are alone in their run are read together with a single
+    # point selection (h5py is only efficient with few points at once).
+    single = runs[:, 0] == runs[:, 1]
+    for k in range(0, single.sum(), _MAX_POINTS_PER_READ):
+        pos = runs[single, 0][k:k + _MAX_POINTS_PER_READ]
+        rows = arr[(unique_indices[pos],) + trailing_index]
+        if out is None:
+            out = np.empty((len(unique_indices),) + rows.shape[1:],
+                           dtype=rows.dtype)
+        out[pos, ...] = rows
+    for i, j in runs[~single]:
+        start, stop = unique_indices[i], unique_indices[j] + 1
+        block = arr[(slice(start, stop, None),) + trailing_index]
+        if out is None:
+            out = np.empty((len(unique_indices),) + block.shape[1:],
+                           dtype=block.dtype)
+        out[i:j + 1, ...] = block[unique_indices[i:j + 1] - start, ...]
+    # Put the rows back in the requested order.
+    return out[inverse, ...]
+
+
 class PartialArray(object):
     """Proxy to a view of an array, allowing selection along the first
     dimensions and fixing the trailing dimensions."""
@@ -283,13 +379,29 @@ class PartialArray(object):
         self.shape = _partial_shape(arr.shape, self._trailing_index)
         self.dtype = arr.dtype
 
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        out = self[...]
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
+
     def __getitem__(self, item):
         if self._trailing_index is None:
+            if (not isinstance(self._arr, np.ndarray) and
+                    _is_fancy_index(item)):
+                return _fancy_read(self._arr, item)
             return self._arr[item]
         else:
             item = _as_tuple(item)
             item += self._trailing_index
-            if len(item) != len(self._arr.shape):
+            if (len(item) != len(self._arr.shape) and
+                    not any(i is Ellipsis for i in item)):
                 raise ValueError("The array selection is invalid: "
                                  "{0}".format(str(item)))
+            if (not isinstance(self._arr, np.ndarray) and
+                    _is_fancy_index(item[0])):
+                return _fancy_read(self._arr, item[0], item[1:])
             return self._arr[item]
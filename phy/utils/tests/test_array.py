@@ -13,7 +13,8 @@ from pytest import raises
 from ..array import (_unique, _normalize, _index_of, _as_array, _as_tuple,
                      chunk_bounds, excerpts, data_chunk,
                      PartialArray, _partial_shape,
-                     _range_from_slice, _pad)
+                     _range_from_slice, _pad,
+                     _index_runs, _fancy_read)
 from ...io.mock.artificial import artificial_spike_clusters
 
 
@@ -279,3 +280,78 @@ def test_partial_array():
     ae(pa[0], arr[0, 1::3, 1])
     ae(pa[0:2], arr[0:2, 1::3, 1])
     ae(pa[[1, 2]], arr[[1, 2], 1::3, 1])
+
+
+def test_index_runs():
+    ae(_index_runs([]), np.zeros((0, 2)))
+    ae(_index_runs([3]), [[0, 0]])
+    ae(_index_runs([1, 2, 3, 5, 6, 9]), [[0, 2], [3, 4], [5, 5]])
+    ae(_index_runs([1, 2, 3, 5, 6, 9], max_gap=2), [[0, 4], [5, 5]])
+
+    # Indices in the same chunk are merged.
+    ae(_index_runs([1, 3, 5, 6, 9], chunk_rows=4), [[0, 1], [2, 3], [4, 4]])
+    ae(_index_runs([0, 3, 12, 17], chunk_rows=5), [[0, 1], [2, 2], [3, 3]])
+
+    # Maximum number of rows per run.
+    ae(_index_runs(np.arange(10), max_rows=4), [[0, 3], [4, 7], [8, 9]])
+
+
+def test_fancy_read():
+
+    class _Chunked(object):
+        """Mimic a chunked h5py dataset which records the reads."""
+        def __init__(self, arr, chunks):
+            self._arr = arr
+            self.shape = arr.shape
+            self.dtype = arr.dtype
+            self.chunks = chunks
+            self.reads = []
+
+        def __getitem__(self, item):
+            if isinstance(item[0], slice):
+                self.reads.append((item[0].start, item[0].stop))
+            else:
+                assert np.all(np.diff(item[0]) > 0)
+                self.reads.append(list(item[0]))
+            return self._arr[item]
+
+    # Rows of 32 KB.
+    arr = np.random.rand(100, 4096)
+    chunked = _Chunked(arr, (10, 4096))
+
+    indices = [55, 3, 7, 3, 12, 99, 56]
+    ae(_fancy_read(chunked, indices), arr[indices])
+    assert chunked.reads == [[12, 99], (3, 8), (55, 57)]
+
+    ae(_fancy_read(chunked, [], (1,)), arr[[], 1])
+    ae(_fancy_read(chunked, indices, (slice(1, 3, None),)),
+       arr[indices, 1:3])
+
+
+def test_partial_array_fancy():
+
+    class _IncreasingOnly(object):
+        """Mimic h5py datasets: only increasing unique indices are
+        accepted."""
+        def __init__(self, arr):
+            self._arr = arr
+            self.shape = arr.shape
+            self.dtype = arr.dtype
+
+        def __getitem__(self, item):
+            idx = _as_tuple(item)[0]
+            if isinstance(idx, np.ndarray):
+                assert np.all(np.diff(idx) > 0)
+            return self._arr[item]
+
+    arr = np.random.rand(10, 3, 2)
+
+    pa = PartialArray(_IncreasingOnly(arr))
+    assert len(pa) == 10
+    ae(pa[[5, 1, 1, 7]], arr[[5, 1, 1, 7]])
+    ae(pa[[]], arr[[]])
+    ae(np.asarray(pa), arr)
+
+    pa = PartialArray(_IncreasingOnly(arr), (1,))
+    ae(pa[[8, 2, 3], 0], arr[[8, 2, 3], 0, 1])
+    ae(pa[np.array([4, 0]), :], arr[[4, 0], :, 1])
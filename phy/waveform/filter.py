@@ -10,7 +10,8 @@ import numpy as np
 from scipy import signal
 
 from ..ext import six
-from ..utils.array import _as_array
+from ..utils.array import _as_array, chunk_bounds, excerpts
+from ..utils.logging import warn
 
 
 #------------------------------------------------------------------------------
@@ -18,16 +19,190 @@ from ..utils.array import _as_array
 #------------------------------------------------------------------------------
 
 def bandpass_filter(rate=None, low=None, high=None, order=None):
-    """Butterworth bandpass filter."""
-    # TODO: implement in a class instead.
+    """Butterworth bandpass filter.
+
+    Return the (b, a) polynomials. See also the `Filter` class, which uses
+    second-order sections.
+
+    """
     return signal.butter(order,
                          (low/(rate/2.), high/(rate/2.)),
                          'pass')
 
 
 def apply_filter(x, filter=None):
+    """Apply a zero-phase filter along the first axis.
+
+    The filter is either a (b, a) tuple or a `Filter` instance.
+
+    """
+    if isinstance(filter, Filter):
+        return filter(x)
     x = _as_array(x)
     if x.shape[0] == 0:
         return x
     b, a = filter
     return signal.filtfilt(b, a, x, axis=0)
+
+
+class Filter(object):
+    """Butterworth bandpass filter with second-order sections (SOS).
+
+    The coefficients are computed once. Calling the instance applies the
+    zero-phase filter along the first axis, whereas `filter()` applies a
+    causal single-pass filter whose state is carried over successive calls,
+    so that sequential chunks can be filtered without edge effects.
+
+    Parameters
+    ----------
+
+    rate : float
+        The sampling rate, in Hz.
+    low : float
+        The low cutoff frequency, in Hz.
+    high : float
+        The high cutoff frequency, in Hz.
+    order : int
+        The order of the Butterworth filter.
+    dtype : dtype
+        The data type used for the computations. Defaults to float32.
+
+    """
+    def __init__(self, rate=None, low=None, high=None, order=None,
+                 dtype=np.float32):
+        self.dtype = np.dtype(dtype)
+        sos = signal.butter(order,
+                            (low/(rate/2.), high/(rate/2.)),
+                            'bandpass', output='sos')
+        self.sos = sos.astype(self.dtype)
+        # Initial state of the causal filter for a unit step.
+        self._zi_step = signal.sosfilt_zi(sos).astype(self.dtype)
+        self._zi = None
+
+    def _as_array(self, x):
+        return np.asarray(_as_array(x), dtype=self.dtype)
+
+    def __call__(self, x):
+        """Apply the zero-phase filter along the first axis."""
+        x = self._as_array(x)
+        if x.shape[0] == 0:
+            return x
+        # Some versions of scipy return float64 arrays.
+        y = signal.sosfiltfilt(self.sos, x, axis=0)
+        return y.astype(self.dtype, copy=False)
+
+    def filter(self, x):
+        """Apply the causal filter along the first axis, starting from the
+        state at the end of the previous call."""
+        x = self._as_array(x)
+        if x.shape[0] == 0:
+            return x
+        if self._zi is None:
+            # Start in the steady state corresponding to the first sample.
+            shape = self._zi_step.shape + (1,) * (x.ndim - 1)
+            self._zi = self._zi_step.reshape(shape) * x[:1]
+        y, zi = signal.sosfilt(self.sos, x, axis=0, zi=self._zi)
+        self._zi = zi.astype(self.dtype, copy=False)
+        return y.astype(self.dtype, copy=False)
+
+    def reset(self):
+        """Reset the state of the causal filter."""
+        self._zi = None
+
+
+#------------------------------------------------------------------------------
+# Streaming filtering
+#------------------------------------------------------------------------------
+
+# Number of chunks used to estimate the amplitude of the filtered traces.
+_N_AMPLITUDE_EXCERPTS = 10
+
+
+def _filtered_amplitude(traces, filter=None, chunk_size=None,
+                        n_excerpts=None):
+    """Return the maximum absolute value of the filtered traces on chunks
+    regularly spaced across the recording."""
+    assert chunk_size is not None
+    if n_excerpts is None:
+        n_excerpts = _N_AMPLITUDE_EXCERPTS
+    amplitude = 0.
+    for start, end in excerpts(traces.shape[0], n_excerpts=n_excerpts,
+                               excerpt_size=chunk_size):
+        chunk = traces[start:end, ...]
+        if filter is not None:
+            chunk = filter(chunk)
+        if chunk.size:
+            amplitude = max(amplitude, float(np.abs(chunk).max()))
+    return amplitude
+
+
+def _int16_scale(sample, max_fraction=.25):
+    """Return the factor to apply to floating-point filtered traces before
+    converting them to int16, given a sample of the filtered traces."""
+    amplitude = np.abs(sample).max() if sample.size else 0
+    if amplitude == 0:
+        return 1.
+    return max_fraction * np.iinfo(np.int16).max / float(amplitude)
+
+
+def filter_traces(traces, out, filter=None, chunk_size=None, overlap=0,
+                  scale=1., start=0):
+    """Filter traces chunk by chunk and write them in an array-like.
+
+    The chunks overlap to avoid edge effects, and only the central part of
+    every filtered chunk is kept. This is a generator yielding the number
+    of samples written after every chunk: an interrupted pass can be
+    resumed with the last yielded value as `start`.
+
+    Parameters
+    ----------
+
+    traces : array-like
+        A (n_samples, n_channels) array-like, for example a memory-mapped
+        array or an HDF5 dataset.
+    out : array-like
+        A writable array-like with the same shape. Values are multiplied by
+        `scale`, and rounded and clipped if its data type is integral. A
+        warning is logged at the end if some samples were clipped.
+    filter : function
+        A function filtering a (n_samples, n_channels) array along the
+        first axis.
+    chunk_size : int
+        Number of samples in every chunk.
+    overlap : int
+        Number of overlapping samples between successive chunks.
+    scale : float
+        Factor applied to the filtered traces.
+    start : int
+        Number of samples already written by an interrupted pass.
+
+    """
+    assert chunk_size is not None
+    if chunk_size <= overlap:
+        raise ValueError("The chunk size needs to be larger than the "
+                         "overlap.")
+    n_samples = traces.shape[0]
+    dtype = np.dtype(out.dtype)
+    integral = np.issubdtype(dtype, np.integer)
+    n_clipped = 0
+    for s_start, s_end, keep_start, keep_end in chunk_bounds(n_samples,
+                                                             chunk_size,
+                                                             overlap=overlap):
+        keep_end = min(keep_end, n_samples)
+        if keep_end <= start:
+            continue
+        chunk = traces[s_start:s_end, ...]
+        if filter is not None:
+            chunk = filter(chunk)
+        chunk = chunk[keep_start - s_start:keep_end - s_start, ...] * scale
+        if integral:
+            info = np.iinfo(dtype)
+            chunk = np.round(chunk)
+            n_clipped += np.count_nonzero((chunk < info.min) |
+                                          (chunk > info.max))
+            chunk = np.clip(chunk, info.min, info.max)
+        out[keep_start:keep_end, ...] = chunk.astype(dtype)
+        yield keep_end
+    if n_clipped:
+        warn("{0:d} filtered samples were clipped to the range of "
+             "{1:s}.".format(n_clipped, dtype.name))
@@ -6,10 +6,12 @@
 # Imports
 #------------------------------------------------------------------------------
 
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 
 from ..ext import six
-from ..utils.array import _as_array, _pad
+from ..utils.array import _as_array, _index_runs
 
 
 #------------------------------------------------------------------------------
@@ -49,12 +51,85 @@ def _slice(index, n_samples, margin=None):
     return slice(max(0, index - before), index + after, None)
 
 
+def _cast(arr, dtype):
+    """Convert an array to a given dtype, rounding and clipping the values
+    when converting floating-point values to integers."""
+    if arr.dtype == dtype:
+        return arr
+    if (np.issubdtype(dtype, np.integer) and
+            not np.issubdtype(arr.dtype, np.integer)):
+        info = np.iinfo(dtype)
+        arr = np.clip(np.round(arr), info.min, info.max)
+    return arr.astype(dtype)
+
+
+# Maximum number of samples in a segment of merged extraction windows.
+_MAX_SEGMENT_SIZE = 2 ** 16
+
+# Default number of waveforms per batch in WaveformLoader.iter_batches().
+_BATCH_SIZE = 1024
+
+
+def _plan_segments(starts, length, max_gap=0, max_size=None):
+    """Merge the windows [start, start + length[ into contiguous segments.
+
+    Windows which overlap or are separated by at most `max_gap` samples
+    are merged, as long as the segments are smaller than `max_size`
+    samples.
+
+    Parameters
+    ----------
+
+    starts : array
+        The sorted start samples of the windows.
+    length : int
+        The number of samples in every window.
+
+    Returns
+    -------
+
+    segments : array
+        A (n_segments, 2) array with the start and stop samples of every
+        segment.
+    spike_segments : array
+        The segment index of every window.
+
+    """
+    if max_size is None:
+        max_size = _MAX_SEGMENT_SIZE
+    starts = _as_array(starts).astype(np.int64)
+    n = len(starts)
+    if n == 0:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    assert np.all(np.diff(starts) >= 0)
+    # A new segment begins when the gap to the previous window is too large.
+    new = np.ones(n, dtype=bool)
+    new[1:] = starts[1:] - (starts[:-1] + length) > max_gap
+    first = np.nonzero(new)[0]
+    last = np.r_[first[1:], n] - 1
+    # Split the segments which are too large.
+    too_large = np.nonzero(starts[last] + length - starts[first] >
+                           max_size)[0]
+    for segment in too_large:
+        seg_start = starts[first[segment]]
+        for i in range(first[segment] + 1, last[segment] + 1):
+            if starts[i] + length - seg_start > max_size:
+                new[i] = True
+                seg_start = starts[i]
+    spike_segments = np.cumsum(new) - 1
+    first = np.nonzero(new)[0]
+    last = np.r_[first[1:], n] - 1
+    segments = np.c_[starts[first], starts[last] + length]
+    return segments, spike_segments
+
+
 class WaveformLoader(object):
     """Load waveforms from filtered or unfiltered traces."""
 
     def __init__(self, traces=None, offset=0, filter=None,
                  n_samples=None, filter_margin=0,
-                 channels=None, scale_factor=None):
+                 channels=None, scale_factor=None, max_gap=None,
+                 n_workers=None, dtype=None):
         # A (possibly memmapped) array-like structure with traces.
         if traces is not None:
             self.traces = traces
@@ -62,6 +137,10 @@ class WaveformLoader(object):
             self._traces = None
         # Scale factor for the loaded waveforms.
         self._scale_factor = scale_factor
+        # Data type of the loaded waveforms. The scale factor is only applied
+        # to float32 and float64 waveforms: int16 and float16 waveforms are
+        # returned in the units of the traces.
+        self._dtype = np.dtype(dtype or np.float32)
         # Offset of the traces: time (in samples) of the first trace sample.
         self._offset = int(offset)
         # List of channels to use when loading the waveforms.
@@ -80,13 +159,56 @@ class WaveformLoader(object):
         # Number of samples in the extracted raw data chunk.
         self._n_samples_extract = (self.n_samples_waveforms +
                                    sum(self._filter_margin))
+        # Extraction windows separated by at most this number of samples
+        # are read and filtered together.
+        if max_gap is None:
+            max_gap = sum(self._filter_margin)
+        self._max_gap = max_gap
+        # Number of threads extracting the waveforms concurrently.
+        self._n_workers = max(1, n_workers or 1)
+        self._thread_pool = None
 
     @property
     def traces(self):
         return self._traces
 
+    @property
+    def dtype(self):
+        """Data type of the loaded waveforms."""
+        return self._dtype
+
+    @property
+    def scale_factor(self):
+        """Scale factor to apply to the loaded waveforms, or None if it
+        has already been applied."""
+        if self._apply_scale:
+            return None
+        return self._scale_factor
+
+    @property
+    def _apply_scale(self):
+        return (self._scale_factor is not None and
+                self._dtype in (np.float32, np.float64))
+
+    @property
+    def _pool(self):
+        """The pool of worker threads, created on first use."""
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPool(self._n_workers)
+        return self._thread_pool
+
+    def close(self):
+        """Shut down the worker threads. They are created again if more
+        waveforms are loaded."""
+        if self._thread_pool is not None:
+            self._thread_pool.close()
+            self._thread_pool.join()
+            self._thread_pool = None
+
     @traces.setter
     def traces(self, value):
+        # The array is used as is, so that memory-mapped arrays and HDF5
+        # datasets are never copied.
         self.n_samples_trace, self.n_channels_traces = value.shape
         self._traces = value
 
@@ -105,68 +227,241 @@ class WaveformLoader(object):
         else:
             return self.n_channels_traces
 
-    def _load_at(self, time):
-        """Load a waveform at a given time."""
-        time = int(time)
-        time_o = time - self._offset
+    def _check_times(self, times):
+        """Return the times relative to the first trace sample, and raise
+        an error if some are out of bounds."""
         ns = self.n_samples_trace
-        if not (0 <= time_o < ns):
-            raise ValueError("Invalid time {0:d}/{1:d}.".format(time_o,
-                                                                ns))
-        slice_extract = _slice(time_o,
-                               self.n_samples_before_after,
-                               self._filter_margin)
-        extract = self._traces[slice_extract, :]
-
-        # Pad the extracted chunk if needed.
-        if slice_extract.start <= 0:
-            extract = _pad(extract, self._n_samples_extract, 'left')
-        elif slice_extract.stop >= ns - 1:
-            extract = _pad(extract, self._n_samples_extract, 'right')
-
-        assert extract.shape[0] == self._n_samples_extract
-
-        # Filter the waveforms.
-        # TODO: do the filtering in a vectorized way for higher performance.
-        if self._filter is not None:
-            waveforms = self._filter(extract)
-        else:
-            waveforms = extract
-
-        # Remove the margin.
-        margin_before, margin_after = self._filter_margin
-        if margin_after > 0:
-            assert margin_before >= 0
-            waveforms = waveforms[margin_before:-margin_after, :]
+        times_o = times.astype(np.int64) - self._offset
+        invalid = (times_o < 0) | (times_o >= ns)
+        if np.any(invalid):
+            raise ValueError("Invalid time {0:d}/{1:d}.".format(
+                             times_o[invalid][0], ns))
+        return times_o
 
-        # Make a subselection with the specified channels.
+    def _channels_index(self):
         if self._channels is not None:
-            out = waveforms[..., self._channels]
+            return _as_array(self._channels)
         else:
-            out = waveforms
+            return slice(None, None, None)
+
+    def _read_channels(self, i_0, i_1):
+        """Read the samples [i_0, i_1[ of the selected channels.
+
+        Only the columns of the selected channels are read, with one
+        hyperslab per range of contiguous channels.
+
+        """
+        if self._channels is None:
+            return self._traces[i_0:i_1, :]
+        channels, inverse = np.unique(_as_array(self._channels),
+                                      return_inverse=True)
+        runs = channels[_index_runs(channels)]
+        data = [self._traces[i_0:i_1, c_0:c_1 + 1] for c_0, c_1 in runs]
+        data = data[0] if len(data) == 1 else np.hstack(data)
+        # Restore the order of the channels.
+        if np.array_equal(inverse, np.arange(len(inverse))):
+            return data
+        return data[:, inverse]
 
-        assert out.shape == (self.n_samples_waveforms,
-                             self.n_channels_waveforms)
+    def _load_segment(self, start, stop):
+        """Load the traces of the selected channels between two samples,
+        padded with zeros outside of the traces."""
+        ns = self.n_samples_trace
+        out = np.zeros((stop - start, self.n_channels_waveforms),
+                       dtype=self._traces.dtype)
+        i_0, i_1 = max(0, start), min(ns, stop)
+        if i_0 < i_1:
+            out[i_0 - start:i_1 - start, :] = self._read_channels(i_0, i_1)
         return out
 
-    def __getitem__(self, item):
-        """Load a number of waveforms."""
+    def _load_windows(self, starts):
+        """Load the raw data chunks starting at a number of samples.
+
+        Return a (n_spikes, n_samples_extract, n_channels_waveforms) array,
+        padded with zeros at the edges of the traces.
+
+        """
+        ns = self.n_samples_trace
+        n_extract = self._n_samples_extract
+        channels = self._channels_index()
+        # In-memory and memory-mapped traces: one fancy indexing operation.
+        if isinstance(self._traces, np.ndarray):
+            samples = starts[:, np.newaxis] + np.arange(n_extract)
+            outside = (samples < 0) | (samples >= ns)
+            samples = np.clip(samples, 0, ns - 1)
+            if isinstance(channels, slice):
+                windows = self._traces[samples, :]
+            else:
+                windows = self._traces[samples[..., np.newaxis], channels]
+            windows[outside] = 0
+            return windows
+        # Other array-like structures only support slices.
+        windows = np.zeros((len(starts), n_extract, self.n_channels_waveforms),
+                           dtype=self._traces.dtype)
+        for i, start in enumerate(starts):
+            windows[i, ...] = self._load_segment(start, start + n_extract)
+        return windows
+
+    def _filter_windows(self, windows):
+        """Filter all chunks with a single call to the filter function.
+
+        The chunks are concatenated along the second axis, so that the
+        filter needs to process every column independently.
+
+        """
+        n_spikes, n_extract, n_channels = windows.shape
+        block = windows.transpose((1, 0, 2)).reshape((n_extract, -1))
+        block = self._filter(block)
+        return block.reshape((n_extract, n_spikes, n_channels)).transpose(
+            (1, 0, 2))
+
+    def _load_isolated(self, starts):
+        """Load and filter waveforms with non-overlapping windows."""
+        windows = self._load_windows(starts)
+        if self._filter is not None:
+            windows = self._filter_windows(windows)
+        margin_before = self._filter_margin[0]
+        return windows[:, margin_before:margin_before +
+                       self.n_samples_waveforms, :]
+
+    def _load_merged(self, starts, segment):
+        """Load and filter a segment once, and extract the waveforms of
+        the windows it contains."""
+        seg_start, seg_stop = segment
+        data = self._load_segment(seg_start, seg_stop)
+        if self._filter is not None:
+            data = self._filter(data)
+        # Offsets of the waveforms in the segment.
+        offsets = starts - seg_start + self._filter_margin[0]
+        samples = offsets[:, np.newaxis] + np.arange(self.n_samples_waveforms)
+        return data[samples, :]
+
+    def _times(self, item):
+        """Convert a time or a list of times to an array of times."""
         if isinstance(item, slice):
-            raise NotImplementedError("Indexing with slices is not "
-                                      "implemented yet.")
+            # A slice would select every sample of the traces: spikes are
+            # selected with their ids, and slices of spike ids, with a
+            # SpikeLoader.
+            raise ValueError("The waveforms should be selected with spike "
+                             "times, not with a slice: use a SpikeLoader "
+                             "to select slices of spikes.")
         if not hasattr(item, '__len__'):
             item = [item]
+        return _as_array(item)
+
+    def iter_batches(self, item, batch_size=None):
+        """Load waveforms in batches, in time order.
+
+        This generator yields `(indices, waveforms)` tuples, where
+        `indices` are the positions of the loaded spikes in `item`. A batch
+        contains about `batch_size` waveforms: batches are only split
+        between merged segments, so that the waveforms are identical to the
+        ones returned by `loader[item]`.
+
+        Parameters
+        ----------
+
+        item : array-like
+            The times of the spikes.
+        batch_size : int
+            The number of waveforms per batch. Defaults to 1024.
+
+        """
+        if batch_size is None:
+            batch_size = _BATCH_SIZE
+        assert batch_size > 0
+        times = self._times(item)
+        n_spikes = len(times)
+        if n_spikes == 0:
+            return
+        times_o = self._check_times(times)
+        order = np.argsort(times_o, kind='mergesort')
+        before = self.n_samples_before_after[0] + self._filter_margin[0]
+        _, spike_segments = _plan_segments(times_o[order] - before,
+                                           self._n_samples_extract,
+                                           max_gap=self._max_gap)
+        # Positions of the first spike of every segment.
+        firsts = np.r_[0, np.nonzero(np.diff(spike_segments))[0] + 1, n_spikes]
+        i = 0
+        while i < n_spikes:
+            # Last segment starting before the end of the batch, or the next
+            # one if the segment is larger than the batch.
+            k = np.searchsorted(firsts, i + batch_size, side='right') - 1
+            j = firsts[k] if firsts[k] > i else firsts[k + 1]
+            indices = order[i:j]
+            yield indices, self[times[indices]]
+            i = j
+
+    def __getitem__(self, item):
+        """Load a number of waveforms.
+
+        Overlapping or nearby extraction windows are merged into
+        contiguous segments, which are read and filtered once. The
+        remaining isolated windows are gathered and filtered at once.
+
+        """
         # Ensure a list of time samples are being requested.
-        spikes = _as_array(item)
+        spikes = self._times(item)
         n_spikes = len(spikes)
         # Initialize the array.
-        # TODO: int16
         shape = (n_spikes, self.n_samples_waveforms,
                  self.n_channels_waveforms)
-        waveforms = np.empty(shape, dtype=np.float32)
-        # Load all spikes.
-        for i, time in enumerate(spikes):
-            waveforms[i, ...] = self._load_at(time)
-        if self._scale_factor is not None:
+        waveforms = np.empty(shape, dtype=self._dtype)
+        if n_spikes == 0:
+            return waveforms
+        times_o = self._check_times(spikes)
+        # Plan the segments with the sorted windows.
+        order = np.argsort(times_o, kind='mergesort')
+        before = self.n_samples_before_after[0] + self._filter_margin[0]
+        starts = times_o[order] - before
+        segments, spike_segments = _plan_segments(starts,
+                                                  self._n_samples_extract,
+                                                  max_gap=self._max_gap)
+        counts = np.bincount(spike_segments)
+        isolated = counts[spike_segments] == 1
+        # Every task loads some waveforms: (indices, function, args).
+        tasks = []
+        # The isolated spikes are loaded at once, in one batch per worker.
+        isolated = np.nonzero(isolated)[0]
+        for batch in np.array_split(isolated, self._n_workers):
+            if len(batch):
+                tasks.append((order[batch], self._load_isolated,
+                              (starts[batch],)))
+        # The segments with several spikes.
+        bounds = np.r_[0, np.cumsum(counts)]
+        for segment in np.nonzero(counts > 1)[0]:
+            i, j = bounds[segment], bounds[segment + 1]
+            tasks.append((order[i:j], self._load_merged,
+                          (starts[i:j], segments[segment])))
+
+        def _run(task):
+            # The tasks write disjoint parts of the output array.
+            indices, func, args = task
+            waveforms[indices] = _cast(func(*args), self._dtype)
+
+        if self._n_workers > 1 and len(tasks) > 1:
+            self._pool.map(_run, tasks)
+        else:
+            for task in tasks:
+                _run(task)
+        if self._apply_scale:
             waveforms *= self._scale_factor
         return waveforms
+
+
+def _iter_waveform_batches(waveforms, spikes, batch_size=None):
+    """Yield (spikes, waveforms) batches.
+
+    Waveform loaders with an `iter_batches()` method load the waveforms in
+    time order. Other array-like objects are read in consecutive batches.
+
+    """
+    if hasattr(waveforms, 'iter_batches'):
+        for indices, batch in waveforms.iter_batches(spikes,
+                                                     batch_size=batch_size):
+            yield spikes[indices], batch
+        return
+    batch_size = batch_size or _BATCH_SIZE
+    for i in range(0, len(spikes), batch_size):
+        batch = spikes[i:i + batch_size]
+        yield batch, waveforms[batch]
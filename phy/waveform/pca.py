@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""Principal component features of the waveforms."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from ..utils.array import _as_array
+from .loader import _iter_waveform_batches
+
+
+#------------------------------------------------------------------------------
+# PCA
+#------------------------------------------------------------------------------
+
+# Default number of spikes used to compute the principal components.
+_N_SPIKES_FIT = 10000
+
+
+def _subsample(n_spikes, n_spikes_fit):
+    """Return regularly spaced spikes."""
+    if n_spikes_fit is None or n_spikes <= n_spikes_fit:
+        return np.arange(n_spikes)
+    return np.unique(np.linspace(0, n_spikes - 1,
+                                 n_spikes_fit).astype(np.int64))
+
+
+def _covariance(waveforms, spikes, batch_size=None):
+    """Compute the (n_channels, n_samples, n_samples) covariance matrices of
+    the waveforms on every channel, by batches."""
+    n, s, ss = 0, None, None
+    for _, batch in _iter_waveform_batches(waveforms, spikes,
+                                           batch_size=batch_size):
+        # (n_channels, n_spikes, n_samples) array.
+        batch = np.asarray(batch, dtype=np.float64).transpose((2, 0, 1))
+        if s is None:
+            s = batch.sum(axis=1)
+            ss = np.einsum('cia,cib->cab', batch, batch)
+        else:
+            s += batch.sum(axis=1)
+            ss += np.einsum('cia,cib->cab', batch, batch)
+        n += batch.shape[1]
+    mean = s / n
+    return ss / n - mean[:, :, np.newaxis] * mean[:, np.newaxis, :]
+
+
+def compute_pcs(waveforms, n_pcs=None, spikes=None, batch_size=None):
+    """Compute the principal components of the waveforms on every channel.
+
+    Parameters
+    ----------
+
+    waveforms : array-like
+        A (n_spikes, n_samples, n_channels) array-like object, for example
+        a waveform loader.
+    n_pcs : int
+        Number of principal components per channel. Defaults to 3.
+    spikes : array-like
+        The spikes used to compute the principal components. Defaults to
+        all spikes.
+    batch_size : int
+        Number of waveforms loaded at once.
+
+    Returns
+    -------
+
+    pcs : array
+        A (n_pcs, n_samples, n_channels) array.
+
+    """
+    if n_pcs is None:
+        n_pcs = 3
+    if spikes is None:
+        spikes = np.arange(len(waveforms))
+    spikes = _as_array(spikes)
+    if len(spikes) == 0:
+        raise ValueError("At least one spike is required to compute the "
+                         "principal components.")
+    cov = _covariance(waveforms, spikes, batch_size=batch_size)
+    # The eigenvalues are in ascending order.
+    _, vectors = np.linalg.eigh(cov)
+    # (n_channels, n_samples, n_pcs) array with the largest components first.
+    pcs = vectors[:, :, ::-1][:, :, :n_pcs]
+    return pcs.transpose((2, 1, 0)).astype(np.float32)
+
+
+def project_pcs(waveforms, pcs):
+    """Project a (n_spikes, n_samples, n_channels) array of waveforms on the
+    principal components of every channel.
+
+    Return a (n_spikes, n_channels, n_pcs) array of features.
+
+    """
+    # One matrix product per channel, which releases the GIL.
+    features = np.matmul(np.transpose(waveforms, (2, 0, 1)),
+                         np.transpose(pcs, (2, 1, 0)))
+    return features.transpose((1, 0, 2))
+
+
+def pca_features(waveforms, n_pcs=None, n_spikes_fit=None, batch_size=None,
+                 n_workers=None):
+    """Compute the principal components features of all spikes by batches.
+
+    The principal components of every channel are computed on a regular
+    subsample of the spikes, and all spikes are then projected by batches.
+    This generator yields `(spikes, features)` tuples, where `features`
+    is a (n_spikes_batch, n_channels, n_pcs) array. When the waveforms are
+    loaded from the traces, the batches are in time order.
+
+    With several workers, the batches are projected in a pool of threads
+    while the next batches are loaded, and at most `n_workers` batches are
+    pending at any time.
+
+    Parameters
+    ----------
+
+    waveforms : array-like
+        A (n_spikes, n_samples, n_channels) array-like object, for example
+        a waveform loader.
+    n_pcs : int
+        Number of principal components per channel. Defaults to 3.
+    n_spikes_fit : int
+        Maximum number of spikes used to compute the principal components.
+        Defaults to 10000.
+    batch_size : int
+        Number of waveforms loaded at once.
+    n_workers : int
+        Number of threads projecting the batches. Defaults to 1.
+
+    """
+    if n_spikes_fit is None:
+        n_spikes_fit = _N_SPIKES_FIT
+    n_spikes = len(waveforms)
+    pcs = compute_pcs(waveforms, n_pcs=n_pcs,
+                      spikes=_subsample(n_spikes, n_spikes_fit),
+                      batch_size=batch_size)
+    batches = _iter_waveform_batches(waveforms, np.arange(n_spikes),
+                                     batch_size=batch_size)
+
+    def _project(spikes, batch):
+        return spikes, project_pcs(np.asarray(batch, dtype=np.float32), pcs)
+
+    if n_workers is None or n_workers <= 1:
+        for spikes, batch in batches:
+            yield _project(spikes, batch)
+        return
+    pool = ThreadPool(n_workers)
+    try:
+        pending = deque()
+        for spikes, batch in batches:
+            pending.append(pool.apply_async(_project, (spikes, batch)))
+            if len(pending) >= n_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
@@ -9,8 +9,11 @@
 
 import numpy as np
 from numpy.testing import assert_array_equal as ae
+from pytest import raises
 
-from ..filter import bandpass_filter, apply_filter
+from ..filter import (bandpass_filter, apply_filter, filter_traces,
+                      _int16_scale, _filtered_amplitude, Filter)
+from ...utils.logging import StringLogger, register, unregister
 
 
 #------------------------------------------------------------------------------
@@ -37,3 +40,97 @@ def test_apply_filter():
     assert np.abs(x_filtered[k:-k]).max() <= .1
 
     ae(apply_filter([], filter=filter), [])
+
+
+def test_filter_traces():
+    traces = np.random.randn(1000, 4)
+    filter = bandpass_filter(low=500., high=2000., order=3, rate=10000.)
+    filtered = apply_filter(traces, filter=filter)
+
+    def _filter(x):
+        return apply_filter(x, filter=filter)
+
+    # Float output.
+    out = np.zeros_like(traces)
+    done = list(filter_traces(traces, out, filter=_filter,
+                              chunk_size=400, overlap=200))
+    assert done[-1] == 1000
+    assert np.all(np.diff(done) > 0)
+    # The chunk edges are far enough from the kept samples.
+    assert np.allclose(out, filtered, atol=1e-3)
+
+    # int16 output, and resume after the second chunk.
+    scale = _int16_scale(filtered)
+    assert np.abs(filtered * scale).max() <= 32767
+    out_int = np.zeros(traces.shape, dtype=np.int16)
+    gen = filter_traces(traces, out_int, filter=_filter,
+                        chunk_size=400, overlap=200, scale=scale)
+    next(gen)
+    start = next(gen)
+    out_int[start:] = 0
+    list(filter_traces(traces, out_int, filter=_filter,
+                       chunk_size=400, overlap=200, scale=scale,
+                       start=start))
+    assert np.allclose(out_int / scale, filtered, atol=1e-3)
+
+    with raises(ValueError):
+        list(filter_traces(traces, out, chunk_size=100, overlap=100))
+    assert _int16_scale(np.zeros(3)) == 1.
+
+    # The clipped samples are reported.
+    logger = StringLogger(fmt='')
+    register(logger)
+    list(filter_traces(traces, out_int, filter=_filter,
+                       chunk_size=400, overlap=200, scale=scale))
+    assert 'clipped' not in str(logger)
+    list(filter_traces(traces, out_int, filter=_filter,
+                       chunk_size=400, overlap=200, scale=scale * 8))
+    assert 'clipped' in str(logger)
+    unregister(logger)
+
+
+def test_filtered_amplitude():
+    traces = np.random.randn(10000, 4)
+    # A loud event at the end of the recording.
+    traces[-5, 1] = 100.
+    assert _filtered_amplitude(traces, chunk_size=100) == 100.
+    assert _filtered_amplitude(traces, chunk_size=100, n_excerpts=2) == 100.
+    assert _filtered_amplitude(traces[:50], chunk_size=100) == \
+        np.abs(traces[:50]).max()
+
+
+def test_filter_class():
+    rate = 10000.
+    x = np.random.randn(2000, 3)
+    filter = Filter(rate=rate, low=500., high=2000., order=3)
+    assert filter.sos.shape == (3, 6)
+
+    # Zero-phase filter, in float32.
+    y = filter(x)
+    assert y.dtype == np.float32
+    ae(apply_filter(x, filter), y)
+    b_filter = bandpass_filter(rate=rate, low=500., high=2000., order=3)
+    y_ba = apply_filter(x, b_filter)
+    k = 100
+    assert np.allclose(y[k:-k], y_ba[k:-k], atol=1e-4)
+    assert filter(np.zeros((0, 3))).shape == (0, 3)
+
+    # Causal filter on successive chunks.
+    y_causal = filter.filter(x)
+    assert y_causal.dtype == np.float32
+    assert filter._zi.dtype == np.float32
+    filter.reset()
+    y_chunks = np.concatenate([filter.filter(x[i:i + 300])
+                               for i in range(0, 2000, 300)])
+    assert np.allclose(y_chunks, y_causal, atol=1e-5)
+
+    # The state is carried over until reset.
+    assert not np.allclose(filter.filter(x[:300]), y_causal[:300])
+    filter.reset()
+    assert np.allclose(filter.filter(x[:300]), y_causal[:300])
+
+    # Float64 processing.
+    filter = Filter(rate=rate, low=500., high=2000., order=3,
+                    dtype=np.float64)
+    assert filter(x).dtype == np.float64
+    assert filter.filter(x[:, 0]).shape == (2000,)
@@ -8,6 +8,7 @@
 #------------------------------------------------------------------------------
 
 import os
+import os.path as op
 
 import numpy as np
 from numpy.testing import assert_array_equal as ae
@@ -15,7 +16,9 @@ import numpy.random as npr
 from pytest import raises
 
 from ...io.mock.artificial import artificial_traces
-from ..loader import _slice, WaveformLoader
+from ...io.h5 import open_h5
+from ...utils.tempdir import TemporaryDirectory
+from ..loader import _slice, _plan_segments, WaveformLoader
 from ..filter import bandpass_filter, apply_filter
 
 
@@ -46,7 +49,7 @@ def test_loader():
 
     # Extract a waveform.
     t = spike_times[10]
-    waveform = loader._load_at(t)
+    waveform = loader[[t]][0]
     assert waveform.shape == (n_samples, n_channels)
     ae(waveform, traces[t - 20:t + 20, :])
 
@@ -79,12 +82,10 @@ def test_edges():
 
     # Invalid time.
     with raises(ValueError):
-        loader._load_at(200000)
+        loader[[200000]]
 
-    assert loader._load_at(0).shape == (n_samples, n_channels)
-    assert loader._load_at(5).shape == (n_samples, n_channels)
-    assert loader._load_at(n_samples_trace-5).shape == (n_samples, n_channels)
-    assert loader._load_at(n_samples_trace-1).shape == (n_samples, n_channels)
+    for t in (0, 5, n_samples_trace - 5, n_samples_trace - 1):
+        assert loader[[t]].shape == (1, n_samples, n_channels)
 
 
 def test_loader_channels():
@@ -106,7 +107,8 @@ def test_loader_channels():
     assert loader[3].shape == (1, n_samples, 3)
     assert loader[995].shape == (1, n_samples, 3)
 
-    with raises(NotImplementedError):
+    # Slices would select every sample of the traces.
+    with raises(ValueError):
         loader[500:510]
 
 
@@ -129,7 +131,261 @@ def test_loader_filter():
                             filter_margin=5)
 
     t = spike_times[5]
-    waveform_filtered = loader._load_at(t)
+    waveform_filtered = loader[[t]][0]
     traces_filtered = my_filter(traces)
     traces_filtered[t - 20:t + 20, :]
     assert np.allclose(waveform_filtered, traces_filtered[t - 20:t + 20, :])
+
+
+def test_loader_batch():
+    n_samples_trace, n_channels = 1000, 10
+    n_samples = 40
+
+    traces = artificial_traces(n_samples_trace, n_channels)
+    b_filter = bandpass_filter(rate=1000, low=50, high=200, order=3)
+
+    def _check(traces, channels=None):
+        loader = WaveformLoader(traces,
+                                n_samples=n_samples,
+                                filter=lambda x: apply_filter(x, b_filter),
+                                filter_margin=10,
+                                channels=channels,
+                                scale_factor=.5)
+        # Include spikes close to the edges. The windows are isolated, so
+        # that loading them together or one by one gives the same result.
+        times = [0, 500, 200, n_samples_trace - 1]
+        waveforms = loader[times]
+        assert waveforms.shape == (len(times), n_samples,
+                                   loader.n_channels_waveforms)
+        for i, time in enumerate(times):
+            assert np.allclose(waveforms[i], loader[[time]][0], atol=1e-5)
+        # The scale factor is applied.
+        t = 500
+        filtered = apply_filter(traces[t - 30:t + 30], b_filter)
+        channels = channels if channels is not None else slice(None)
+        assert np.allclose(waveforms[1], .5 * filtered[10:50][:, channels],
+                           atol=1e-5)
+        assert loader[[]].shape == (0, n_samples,
+                                    loader.n_channels_waveforms)
+        with raises(ValueError):
+            loader[[10, n_samples_trace]]
+
+    _check(traces)
+    _check(traces, channels=[5, 1, 2])
+
+    # HDF5 traces.
+    with TemporaryDirectory() as tempdir:
+        with open_h5(op.join(tempdir, 'test.h5'), 'w') as f:
+            f.write('/traces', traces)
+            _check(f.read('/traces'))
+            _check(f.read('/traces'), channels=[5, 1, 2])
+
+
+def test_plan_segments():
+    segments, spike_segments = _plan_segments([], 10)
+    assert segments.shape == (0, 2)
+    assert len(spike_segments) == 0
+
+    starts = [0, 5, 10, 30, 45, 100, 100, 200]
+    segments, spike_segments = _plan_segments(starts, 10)
+    ae(segments, [[0, 20], [30, 40], [45, 55], [100, 110], [200, 210]])
+    ae(spike_segments, [0, 0, 0, 1, 2, 3, 3, 4])
+
+    # Nearby windows.
+    segments, spike_segments = _plan_segments(starts, 10, max_gap=10)
+    ae(segments, [[0, 55], [100, 110], [200, 210]])
+    ae(spike_segments, [0, 0, 0, 0, 0, 1, 1, 2])
+
+    # Maximum segment size.
+    segments, spike_segments = _plan_segments(starts, 10, max_gap=10,
+                                              max_size=30)
+    ae(segments, [[0, 20], [30, 55], [100, 110], [200, 210]])
+    ae(spike_segments, [0, 0, 0, 1, 1, 2, 2, 3])
+
+
+def test_loader_merged():
+    n_samples_trace, n_channels = 1000, 10
+    n_samples = 40
+
+    traces = artificial_traces(n_samples_trace, n_channels)
+
+    # With a pointwise filter, merging the windows does not change the
+    # waveforms.
+    def my_filter(x):
+        return x * x
+
+    loader = WaveformLoader(traces,
+                            n_samples=n_samples,
+                            filter=my_filter,
+                            filter_margin=5,
+                            channels=[2, 4, 0])
+    times = [500, 3, 510, 0, 800, 510, 999, 990, 200]
+    waveforms = loader[times]
+    assert waveforms.shape == (len(times), n_samples, 3)
+    for i, time in enumerate(times):
+        assert np.allclose(waveforms[i], loader[[time]][0])
+
+    # With a real filter, the merged windows are filtered together.
+    b_filter = bandpass_filter(rate=1000, low=50, high=200, order=3)
+    loader = WaveformLoader(traces,
+                            n_samples=n_samples,
+                            filter=lambda x: apply_filter(x, b_filter),
+                            filter_margin=10)
+    waveforms = loader[[490, 500]]
+    # The margin is 5 samples before and after.
+    filtered = apply_filter(traces[465:525], b_filter)
+    assert np.allclose(waveforms[0], filtered[5:45], atol=1e-5)
+    assert np.allclose(waveforms[1], filtered[15:55], atol=1e-5)
+
+
+def test_loader_workers():
+    n_samples_trace, n_channels = 5000, 10
+    n_samples = 40
+
+    traces = artificial_traces(n_samples_trace, n_channels)
+    b_filter = bandpass_filter(rate=1000, low=50, high=200, order=3)
+    times = npr.randint(low=0, high=n_samples_trace, size=200)
+
+    def _loader(n_workers):
+        return WaveformLoader(traces,
+                              n_samples=n_samples,
+                              filter=lambda x: apply_filter(x, b_filter),
+                              filter_margin=10,
+                              channels=[1, 3, 5],
+                              scale_factor=.5,
+                              n_workers=n_workers)
+
+    waveforms = _loader(None)[times]
+    loader = _loader(4)
+    # The order of the spikes is kept.
+    ae(loader[times], waveforms)
+    ae(loader[times[::-1]], waveforms[::-1])
+    ae(loader[times[:1]], _loader(1)[times[:1]])
+    assert loader[[]].shape == (0, n_samples, 3)
+
+    # The worker threads are shut down and created again if needed.
+    assert loader._thread_pool is not None
+    loader.close()
+    assert loader._thread_pool is None
+    ae(loader[times], waveforms)
+    loader.close()
+    loader.close()
+
+
+class _RecordingTraces(object):
+    """Array-like wrapper recording the slices that are read."""
+    def __init__(self, arr):
+        self._arr = arr
+        self.shape = arr.shape
+        self.dtype = arr.dtype
+        self.reads = []
+
+    def __len__(self):
+        return len(self._arr)
+
+    def __getitem__(self, item):
+        self.reads.append(item)
+        return self._arr[item]
+
+
+def test_loader_channel_runs():
+    n_samples_trace, n_channels = 2000, 32
+    n_samples = 40
+
+    arr = artificial_traces(n_samples_trace, n_channels)
+    traces = _RecordingTraces(arr)
+    channels = [12, 3, 4, 5, 20, 21, 4]
+    times = [100, 1000, 1500]
+
+    loader = WaveformLoader(traces, n_samples=n_samples, channels=channels)
+    waveforms = loader[times]
+    expected = WaveformLoader(arr, n_samples=n_samples,
+                              channels=channels)[times]
+    ae(waveforms, expected)
+
+    # Only the three runs of contiguous channels are read.
+    cols = set((item[1].start, item[1].stop) for item in traces.reads)
+    assert cols == set([(3, 6), (12, 13), (20, 22)])
+
+    # Same thing with a single spike.
+    traces.reads = []
+    assert np.allclose(loader[[1000]][0], expected[1])
+    cols = set((item[1].start, item[1].stop) for item in traces.reads)
+    assert cols == set([(3, 6), (12, 13), (20, 22)])
+
+
+def test_loader_iter_batches():
+    n_samples_trace, n_channels = 5000, 10
+    n_samples = 40
+
+    traces = artificial_traces(n_samples_trace, n_channels)
+    b_filter = bandpass_filter(rate=1000, low=50, high=200, order=3)
+    times = npr.randint(low=0, high=n_samples_trace, size=200)
+
+    loader = WaveformLoader(traces,
+                            n_samples=n_samples,
+                            filter=lambda x: apply_filter(x, b_filter),
+                            filter_margin=10,
+                            channels=[1, 3, 5])
+    waveforms = loader[times]
+
+    out = np.zeros_like(waveforms)
+    n_loaded = 0
+    last = -1
+    for indices, batch in loader.iter_batches(times, batch_size=16):
+        assert len(indices) == len(batch)
+        # The batches are in time order.
+        assert times[indices].min() >= last
+        last = times[indices].max()
+        out[indices] = batch
+        n_loaded += len(indices)
+    assert n_loaded == len(times)
+    ae(out, waveforms)
+
+    assert list(loader.iter_batches([])) == []
+    with raises(ValueError):
+        list(loader.iter_batches(slice(1000, 1100)))
+    with raises(ValueError):
+        list(loader.iter_batches([10, n_samples_trace]))
+
+
+def test_loader_int16():
+    n_samples_trace, n_channels = 1000, 10
+    n_samples = 40
+
+    traces = (1000 * artificial_traces(n_samples_trace,
+                                       n_channels)).astype(np.int16)
+    times = [0, 200, 210, 500, n_samples_trace - 1]
+
+    # Without filter, the int16 traces are copied as is.
+    loader = WaveformLoader(traces, n_samples=n_samples, channels=[2, 5],
+                            dtype=np.int16, scale_factor=.5)
+    waveforms = loader[times]
+    assert waveforms.dtype == np.int16
+    assert loader.scale_factor == .5
+    ae(waveforms[2], traces[190:230, [2, 5]])
+
+    # The scale factor is applied to float32 waveforms.
+    loader = WaveformLoader(traces, n_samples=n_samples, channels=[2, 5],
+                            scale_factor=.5)
+    assert loader.scale_factor is None
+    ae(loader[times], .5 * waveforms)
+
+    # With filter, the waveforms are filtered in float32 and rounded.
+    b_filter = bandpass_filter(rate=1000, low=50, high=200, order=3)
+
+    def _loader(dtype):
+        return WaveformLoader(traces, n_samples=n_samples,
+                              filter=lambda x: apply_filter(x, b_filter),
+                              filter_margin=10,
+                              dtype=dtype,
+                              scale_factor=.5)
+
+    waveforms = _loader(None)[times]
+    assert waveforms.dtype == np.float32
+    for dtype in (np.int16, np.float16):
+        loader = _loader(dtype)
+        waveforms_compact = loader[times]
+        assert waveforms_compact.dtype == dtype
+        assert np.allclose(waveforms_compact * loader.scale_factor,
+                           waveforms, atol=1.)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of PCA functions."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from pytest import raises
+
+from ...io.mock.artificial import artificial_waveforms
+from ..pca import _subsample, compute_pcs, project_pcs, pca_features
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_subsample():
+    ae(_subsample(5, None), np.arange(5))
+    ae(_subsample(5, 10), np.arange(5))
+    ae(_subsample(11, 3), [0, 5, 10])
+
+
+def test_compute_pcs():
+    n_spikes, n_samples, n_channels = 200, 20, 4
+    waveforms = artificial_waveforms(n_spikes, n_samples, n_channels)
+    # The waveforms on the second channel lie along one direction.
+    direction = np.sin(np.linspace(0, np.pi, n_samples))
+    waveforms[:, :, 1] = (np.random.normal(size=(n_spikes, 1)) *
+                          direction)
+
+    pcs = compute_pcs(waveforms, n_pcs=3, batch_size=32)
+    assert pcs.shape == (3, n_samples, n_channels)
+    # The principal components of every channel are orthonormal.
+    for channel in range(n_channels):
+        gram = np.dot(pcs[:, :, channel], pcs[:, :, channel].T)
+        assert np.allclose(gram, np.eye(3), atol=1e-5)
+    first = pcs[0, :, 1]
+    assert np.allclose(np.abs(np.dot(first, direction)),
+                       np.linalg.norm(direction), atol=1e-4)
+
+    # Same components with a batch size of 1. The last components of the
+    # second channel are degenerate.
+    pcs_bis = compute_pcs(waveforms, n_pcs=3, batch_size=1)
+    assert np.allclose(np.abs(pcs_bis[..., [0, 2, 3]]),
+                       np.abs(pcs[..., [0, 2, 3]]), atol=1e-4)
+    assert np.allclose(np.abs(pcs_bis[0, :, 1]), np.abs(first), atol=1e-4)
+
+    with raises(ValueError):
+        compute_pcs(waveforms, spikes=[])
+
+
+def test_pca_features():
+    n_spikes, n_samples, n_channels = 100, 20, 4
+    waveforms = artificial_waveforms(n_spikes, n_samples, n_channels)
+
+    pcs = compute_pcs(waveforms, n_pcs=2)
+    features = project_pcs(waveforms, pcs)
+    assert features.shape == (n_spikes, n_channels, 2)
+    assert np.allclose(features[3, 1, 0],
+                       np.dot(waveforms[3, :, 1], pcs[0, :, 1]))
+
+    out = np.zeros_like(features)
+    n = 0
+    for spikes, batch in pca_features(waveforms, n_pcs=2, batch_size=16):
+        out[spikes] = batch
+        n += len(spikes)
+    assert n == n_spikes
+    assert np.allclose(out, features, atol=1e-4)
+
+    # Projection in several threads.
+    batches = list(pca_features(waveforms, n_pcs=2, batch_size=16,
+                                n_workers=3))
+    ae(np.concatenate([spikes for spikes, _ in batches]), np.arange(n_spikes))
+    assert np.allclose(np.concatenate([batch for _, batch in batches]),
+                       features, atol=1e-4)